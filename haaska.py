@@ -22,16 +22,32 @@
 # SOFTWARE.
 
 import os
+import sys
 import json
+import time
 import logging
 import operator
+import ssl
 import requests
 import colorsys
 import datetime
+import re
 import uuid
+import random
+import fnmatch
+import gc
+import threading
+import hashlib
+import marshal
+import struct
+import tempfile
+import heapq
+import contextlib
+import collections
+import concurrent.futures
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 # Imports for v3 validation
-from validation import validate_message
+from validation import validate_message, get_validator, ValidationError
 
 # Disable warning about Insecure Request
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -62,37 +78,1560 @@ DISPLAY_CATEGORIES = {
     'automation': 'ACTIVITY_TRIGGER'
 }
 
-class HomeAssistant(object):
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+class NullMetrics(object):
+    # Used when metrics are disabled; every operation is a no-op so the
+    # instrumented code paths cost a method call and nothing more.
+    _timer = _NullContext()
+
+    def timer(self, name):
+        return self._timer
+
+    def add_time(self, name, ms):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+    def set_dimensions(self, **dimensions):
+        pass
+
+    def set_property(self, name, value):
+        pass
+
+    def emit(self):
+        pass
+
+
+class Metrics(NullMetrics):
+    UNITS = {'ms': 'Milliseconds', 'bytes': 'Bytes', 'count': 'Count'}
+
+    def __init__(self, namespace='haaska', stream=None):
+        self.namespace = namespace
+        self.stream = stream or sys.stdout
+        self.dimensions = {}
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, (time.perf_counter() - start) * 1000.0)
+
+    def _add(self, name, value, unit):
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+    def add_time(self, name, ms):
+        self._add(name + '_ms', ms, 'ms')
+
+    def incr(self, name, value=1):
+        unit = 'bytes' if name.endswith('_bytes') else 'count'
+        self._add(name, value, unit)
+
+    def set_dimensions(self, **dimensions):
+        self.dimensions.update(
+            {k: v for k, v in dimensions.items() if v is not None})
+
+    def set_property(self, name, value):
+        # Logged with the metrics but not a metric itself
+        self.properties[name] = value
+
+    def to_emf(self):
+        # CloudWatch Embedded Metric Format: one JSON object per line
+        # which CloudWatch Logs turns into metrics without any API calls.
+        doc = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [sorted(self.dimensions.keys())],
+                    'Metrics': [{'Name': k, 'Unit': self.UNITS[self.units[k]]}
+                                for k in sorted(self.values.keys())]
+                }]
+            }
+        }
+        doc.update(self.properties)
+        doc.update(self.dimensions)
+        doc.update({k: round(v, 3) if isinstance(v, float) else v
+                    for k, v in self.values.items()})
+        return doc
+
+    def emit(self):
+        self.stream.write(json.dumps(self.to_emf(), sort_keys=True) + '\n')
+        self.stream.flush()
+
+
+class NullTracer(object):
+    # Default tracer: spans are shared no-op context managers.
+    _span = _NullContext()
+
+    def span(self, name, **attributes):
+        return self._span
+
+    def flush(self):
+        pass
+
+
+class Span(object):
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start_ns = int(time.time() * 1e9)
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.end_ns = int(time.time() * 1e9)
+
+    def to_otlp(self):
+        def otlp_value(v):
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': str(v)}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': str(v)}
+
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': k, 'value': otlp_value(v)}
+                           for k, v in sorted(self.attributes.items())
+                           if v is not None],
+            'status': {'code': 2, 'message': self.error} if self.error
+            else {'code': 1}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class Tracer(NullTracer):
+    def __init__(self, exporter, service_name='haaska'):
+        self.exporter = exporter
+        self.service_name = service_name
+        self.trace_id = uuid.uuid4().hex
+        self.finished = []
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        stack = self._stack()
+        parent_id = stack[-1].span_id if stack else None
+        span = Span(name, self.trace_id, parent_id, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            stack.pop()
+            span.end()
+            self.finished.append(span)
+
+    def flush(self):
+        if self.finished:
+            spans, self.finished = self.finished, []
+            self.exporter.export(self.service_name, spans)
+
+
+class OTLPFileExporter(object):
+    # Appends one OTLP/JSON ExportTraceServiceRequest per line, the format
+    # written by the OpenTelemetry Collector's file exporter, so traces can
+    # be loaded into any OTLP-capable tool for offline analysis. writer is
+    # a CaptureWriter, which rotates the file so /tmp doesn't fill up.
+    def __init__(self, writer):
+        self.writer = writer
+
+    def export(self, service_name, spans):
+        doc = {'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name',
+                 'value': {'stringValue': service_name}}]},
+            'scopeSpans': [{
+                'scope': {'name': 'haaska'},
+                'spans': [span.to_otlp() for span in spans]
+            }]
+        }]}
+        self.writer.write(doc)
+
+
+class Profiler(object):
+    # cProfile wrapper used by the sampled profiling mode. The raw profile
+    # is written to profile_dir for offline analysis with pstats/snakeviz,
+    # and a top-N summary is logged so hot spots are visible in CloudWatch.
+    # Only the newest keep profiles are left in profile_dir.
+    def __init__(self, label, directory, top, keep):
+        self.label = label
+        self.directory = directory
+        self.top = top
+        self.keep = keep
+        self.profile = None
+
+    def __enter__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        import io
+        import pstats
+        filename = os.path.join(self.directory, 'haaska-%s-%d.prof' % (
+            self.label, int(time.time() * 1000)))
+        try:
+            self.profile.dump_stats(filename)
+            self._trim()
+        except (IOError, OSError):
+            logger.exception('Unable to write profile to %s', filename)
+            filename = None
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        logger.info('Profile for %s (%s):\n%s', self.label, filename,
+                    out.getvalue())
+        return False
+
+    def _trim(self):
+        profiles = [os.path.join(self.directory, name)
+                    for name in os.listdir(self.directory)
+                    if name.startswith('haaska-') and name.endswith('.prof')]
+        profiles.sort(key=os.path.getmtime)
+        for path in profiles[:max(len(profiles) - self.keep, 0)]:
+            os.remove(path)
+
+
+def sampled(every):
+    # Each mode draws on its own, so modes sampled at the same rate don't
+    # always land on the same invocation, and a container that only lives
+    # for a few invocations is sampled as often as a long-lived one.
+    return every > 0 and random.random() < 1.0 / every
+
+
+def profiler_for(config, namespace, name, memory=None):
+    # Not while tracing memory: tracemalloc's bookkeeping would dominate
+    # the profile.
+    if isinstance(memory, MemoryTracer):
+        return _NullContext()
+    label = '%s.%s' % (namespace, name)
+    matched = any(fnmatch.fnmatchcase(label, pattern)
+                  for pattern in config.profile_filter)
+    if not (matched or sampled(config.profile_every)):
+        return _NullContext()
+    return Profiler(label, config.profile_dir, config.profile_top,
+                    config.profile_keep)
+
+
+class MemoryTracer(object):
+    # tracemalloc wrapper used by the memory tracing mode. Records the peak
+    # of memory traced while handling a directive, the lines that allocated
+    # most of what is still held at the end, and how the number of objects
+    # changed by type, and adds them to the invocation's metrics log.
+    def __init__(self, label, metrics, top, frames):
+        self.label = label
+        self.metrics = metrics
+        self.top = top
+        self.frames = frames
+        self.started = False
+        self.objects = None
+
+    def _count_objects(self):
+        return collections.Counter(type(o).__name__ for o in gc.get_objects())
+
+    def __enter__(self):
+        import tracemalloc
+        self.objects = self._count_objects()
+        if tracemalloc.is_tracing():
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        else:
+            tracemalloc.start(self.frames)
+            self.started = True
+        return self
+
+    def __exit__(self, *exc):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        if self.started:
+            tracemalloc.stop()
+        sites = ['%s:%d %dB %dx' % (s.traceback[0].filename.rsplit('/', 1)[-1],
+                                    s.traceback[0].lineno, s.size, s.count)
+                 for s in snapshot.statistics('lineno')[:self.top]]
+        objects = self._count_objects()
+        growth = objects - self.objects
+        report = {'peak_bytes': peak,
+                  'current_bytes': current,
+                  'objects': sum(objects.values()),
+                  'top_allocations': sites,
+                  'object_growth': dict(growth.most_common(self.top))}
+        self.metrics.incr('memory_peak_bytes', peak)
+        self.metrics.incr('memory_current_bytes', current)
+        self.metrics.incr('objects', report['objects'])
+        self.metrics.set_property('memory', report)
+        logger.info('Memory for %s: %s', self.label,
+                    json.dumps(report, sort_keys=True))
+        return False
+
+
+def memory_tracer_for(config, namespace, name, metrics):
+    label = '%s.%s' % (namespace, name)
+    matched = any(fnmatch.fnmatchcase(label, pattern)
+                  for pattern in config.memory_filter)
+    if not (matched or sampled(config.memory_every)):
+        return _NullContext()
+    return MemoryTracer(label, metrics, config.memory_top,
+                        config.memory_frames)
+
+
+# Keys whose values are credentials, removed from captured directives
+CAPTURE_REDACTED = frozenset(['token', 'code', 'accessToken',
+                              'correlationToken', 'access_token',
+                              'refresh_token', 'password', 'api_password'])
+CAPTURE_MAX_CALLS = 50
+
+
+def anonymize(value):
+    if isinstance(value, dict):
+        return {k: 'REDACTED' if k in CAPTURE_REDACTED else anonymize(v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize(v) for v in value]
+    return value
+
+
+class CaptureWriter(object):
+    # Appends one JSON record per line (captured directives, traces),
+    # rotating the file to .1, .2, ... once it reaches max_bytes; "-" writes
+    # to stdout, which ends up in CloudWatch Logs.
+    def __init__(self, filename, max_bytes, backups):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.filename, i)):
+                os.replace('%s.%d' % (self.filename, i),
+                           '%s.%d' % (self.filename, i + 1))
+        if self.backups:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        if self.filename == '-':
+            sys.stdout.write(line)
+            return
+        with self.lock:
+            try:
+                if self.max_bytes and os.path.exists(self.filename) and \
+                        os.path.getsize(self.filename) + len(line) > \
+                        self.max_bytes:
+                    self._rotate()
+                with open(self.filename, 'a') as f:
+                    f.write(line)
+            except (IOError, OSError):
+                logger.exception('Unable to write to %s', self.filename)
+
+
+_writers = {}
+
+
+def rotating_writer(filename, max_bytes, backups):
+    # One writer, and so one lock, per file
+    key = (filename, max_bytes, backups)
+    if key not in _writers:
+        _writers[key] = CaptureWriter(*key)
+    return _writers[key]
+
+
+def capture_writer(config):
+    return rotating_writer(config.capture_file, config.capture_max_bytes,
+                           config.capture_backups)
+
+
+def capture_for(config, namespace, name):
+    label = '%s.%s' % (namespace, name)
+    matched = any(fnmatch.fnmatchcase(label, pattern)
+                  for pattern in config.capture_filter)
+    return matched or sampled(config.capture_every)
+
+
+def capture_record(request, calls, response, elapsed):
+    record = {'time': datetime.datetime.utcnow().strftime(
+                  '%Y-%m-%dT%H:%M:%S.%fZ'),
+              'directive': anonymize(request),
+              'calls': calls[:CAPTURE_MAX_CALLS],
+              'ms': round(elapsed * 1000.0, 3)}
+    if len(calls) > CAPTURE_MAX_CALLS:
+        record['calls_dropped'] = len(calls) - CAPTURE_MAX_CALLS
+    if response is not None:
+        header = response['event']['header']
+        record['response'] = '%s.%s' % (header['namespace'], header['name'])
+        if header['name'] == 'ErrorResponse':
+            record['error'] = response['event']['payload'].get('type')
+    return record
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    # Time budget for one invocation. Every Home Assistant request takes its
+    # timeouts from what is left, and refuses to start when too little is
+    # left for it to plausibly complete.
+    def __init__(self, budget_ms=None, min_request_ms=0):
+        self.min_request = min_request_ms / 1000.0
+        self.expires = None
+        if budget_ms is not None:
+            self.expires = time.monotonic() + budget_ms / 1000.0
+
+    @classmethod
+    def from_context(cls, context, config):
+        budgets = []
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            budgets.append(context.get_remaining_time_in_millis() -
+                           config.deadline_reserve_ms)
+        if config.deadline_ms:
+            budgets.append(config.deadline_ms)
+        return cls(min(budgets) if budgets else None, config.min_request_ms)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    def timeout(self, connect, read):
+        remaining = self.remaining()
+        if remaining is None:
+            return (connect, read)
+        if remaining < self.min_request:
+            raise DeadlineExceeded('%.0fms left, %.0fms required' % (
+                remaining * 1000.0, self.min_request * 1000.0))
+        return (min(connect, remaining),
+                remaining if read is None else min(read, remaining))
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    # Tracks consecutive failures talking to one Home Assistant instance.
+    # Once open, requests fail immediately until reset_timeout has passed;
+    # then a single cheap probe decides whether to close it again.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self, probe):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = CircuitBreaker.HALF_OPEN
+            if probe():
+                self._close()
+                return True
+            self._trip()
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self._close()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == CircuitBreaker.HALF_OPEN or
+                    (self.threshold and self.failures >= self.threshold)):
+                self._trip()
+
+    def _close(self):
+        if self.state != CircuitBreaker.CLOSED:
+            logger.info('Home Assistant reachable again, closing breaker')
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+
+    def _trip(self):
+        if self.state != CircuitBreaker.OPEN:
+            logger.warning('Home Assistant unreachable after %d failures, '
+                           'opening breaker for %ss', self.failures,
+                           self.reset_timeout)
+        self.state = CircuitBreaker.OPEN
+        self.opened_at = time.monotonic()
+
+
+class LatencyModel(object):
+    # Smoothed latency and mean deviation of Home Assistant GETs, updated
+    # the way TCP estimates its retransmission timeout (RFC 6298).
+    ALPHA = 0.125
+    BETA = 0.25
+
+    def __init__(self, min_samples=5):
+        self.min_samples = min_samples
+        self.samples = 0
+        self.srtt = None
+        self.rttvar = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = seconds
+                self.rttvar = seconds / 2.0
+            else:
+                self.rttvar = ((1 - self.BETA) * self.rttvar +
+                               self.BETA * abs(self.srtt - seconds))
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * seconds
+            self.samples += 1
+
+    def hedge_delay(self):
+        # Roughly the p95 of recent requests
+        if self.samples < self.min_samples:
+            return None
+        return self.srtt + 2 * self.rttvar
+
+    def timeout(self, floor):
+        if self.samples < self.min_samples:
+            return None
+        return max(floor, self.srtt + 4 * self.rttvar)
+
+
+class Overloaded(Exception):
+    pass
+
+
+# Admission priorities, most urgent first. A user waiting on a light beats
+# Alexa polling for state, which beats a background discovery.
+CONTROL = 0
+STATE = 1
+DISCOVERY = 2
+PRIORITY_NAMES = ('control', 'state', 'discovery')
+
+
+def directive_priority(namespace, name):
+    if namespace == 'Alexa.Discovery':
+        return DISCOVERY
+    if name == 'ReportState':
+        return STATE
+    return CONTROL
+
+
+class Limiter(object):
+    # A token bucket for the request rate combined with a cap on requests in
+    # flight; a rate or concurrency of 0 is unlimited. Waiters are admitted
+    # in priority order, then first come first served, and give up with
+    # Overloaded once their timeout has passed.
+    def __init__(self, rate=0, burst=1, concurrency=0):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.concurrency = concurrency
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.waiting = []
+        self.sequence = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _ready(self):
+        return (not self.concurrency or self.in_flight < self.concurrency) \
+            and (not self.rate or self.tokens >= 1)
+
+    def acquire(self, priority, timeout):
+        with self.cond:
+            self.sequence += 1
+            ticket = (priority, self.sequence)
+            heapq.heappush(self.waiting, ticket)
+            give_up = time.monotonic() + timeout
+            try:
+                while True:
+                    self._refill()
+                    if self.waiting[0] == ticket and self._ready():
+                        heapq.heappop(self.waiting)
+                        if self.rate:
+                            self.tokens -= 1
+                        self.in_flight += 1
+                        # The next waiter may be admissible too
+                        self.cond.notify_all()
+                        return
+                    wait = give_up - time.monotonic()
+                    if wait <= 0:
+                        raise Overloaded('%d requests in flight, %d queued' %
+                                         (self.in_flight, len(self.waiting)))
+                    if self.rate and self.tokens < 1:
+                        wait = min(wait, (1 - self.tokens) / self.rate)
+                    self.cond.wait(wait)
+            except BaseException:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self.cond.notify_all()
+                raise
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+
+_dynamodb = None
+
+
+def dynamodb_client():
+    global _dynamodb
+    if _dynamodb is None:
+        import boto3
+        _dynamodb = boto3.client('dynamodb')
+    return _dynamodb
+
+
+class SharedRateLimit(object):
+    # A request rate shared by every container, counted per second in a
+    # DynamoDB table (partition key window, TTL attribute expires). Limiter
+    # only sees its own container, so this is what keeps a retry storm
+    # spread over many containers from swamping Home Assistant. Priorities
+    # only order waiters within a container. If the table can't be reached
+    # requests are let through rather than failed.
+    def __init__(self, table, name, rate, client=None):
+        self.table = table
+        self.name = name
+        self.rate = rate
+        self.client = client
+
+    def _client(self):
+        if self.client is None:
+            self.client = dynamodb_client()
+        return self.client
+
+    def _take(self, window):
+        client = self._client()
+        try:
+            client.update_item(
+                TableName=self.table,
+                Key={'window': {'S': '%s#%d' % (self.name, window)}},
+                UpdateExpression='ADD requests :one SET expires = :expires',
+                ConditionExpression='attribute_not_exists(requests) '
+                                    'OR requests < :rate',
+                ExpressionAttributeValues={
+                    ':one': {'N': '1'}, ':rate': {'N': str(self.rate)},
+                    ':expires': {'N': str(window + 60)}})
+            return True
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        except Exception:
+            logger.exception('Shared rate limit unavailable')
+            return True
+
+    def acquire(self, priority, timeout):
+        give_up = time.monotonic() + timeout
+        while True:
+            now = time.time()
+            if self._take(int(now)):
+                return
+            wait = give_up - time.monotonic()
+            if wait <= 0:
+                raise Overloaded('more than %d requests per second to %s' %
+                                 (self.rate, self.name))
+            time.sleep(min(wait, int(now) + 1 - now))
+
+    def release(self):
+        pass
+
+
+class Admission(object):
+    # Limits requests to one Home Assistant instance, overall and per entity
+    # domain, so a burst of directives queues up here rather than swamping
+    # a small host.
+    def __init__(self, config):
+        self.wait = config.admission_wait
+        self.limiter = None
+        if config.max_requests_per_second or config.max_concurrent_requests:
+            self.limiter = Limiter(config.max_requests_per_second,
+                                   config.request_burst,
+                                   config.max_concurrent_requests)
+        self.shared = None
+        if config.admission_table and config.shared_requests_per_second:
+            self.shared = SharedRateLimit(config.admission_table, config.url,
+                                          config.shared_requests_per_second)
+        self.domains = {}
+        for domain, limits in config.domain_limits.items():
+            self.domains[domain] = Limiter(limits.get('rate', 0),
+                                           limits.get('burst', 1),
+                                           limits.get('concurrency', 0))
+
+    def acquire(self, domain, priority, deadline):
+        # Returns the limiters to release once the request has completed.
+        timeout = self.wait.get(PRIORITY_NAMES[priority], 1.0)
+        remaining = deadline.remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining - deadline.min_request)
+        acquired = []
+        try:
+            for limiter in (self.domains.get(domain), self.limiter,
+                            self.shared):
+                if limiter is not None:
+                    limiter.acquire(priority, timeout)
+                    acquired.append(limiter)
+        except Overloaded:
+            self.release(acquired)
+            raise
+        return acquired
+
+    def release(self, acquired):
+        for limiter in acquired:
+            limiter.release()
+
+    @contextlib.contextmanager
+    def admit(self, domain, priority, deadline):
+        acquired = self.acquire(domain, priority, deadline)
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+
+def request_domain(relurl):
+    # services/light/turn_on and states/light.kitchen both concern "light"
+    parts = relurl.split('/')
+    if len(parts) > 1 and parts[0] in ('services', 'states'):
+        return parts[1].split('.', 1)[0]
+    return None
+
+
+class DiskCache(object):
+    # Values kept in files under a directory that outlives the process (/tmp
+    # in Lambda), so a re-initialized process can restore what the last one
+    # knew. Each file holds one marshalled value behind a header with the
+    # format version and the time it was written. Files are written to a
+    # temporary name and renamed into place, so readers never see a partial
+    # one; the oldest are removed once the directory exceeds max_bytes.
+    MAGIC = b'HAASKA'
+    VERSION = 1
+    HEADER = struct.Struct('<6sBBd')
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.bin')
+
+    def get(self, key):
+        # Returns (time written, value), or None when missing or unreadable
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if len(data) < self.HEADER.size:
+            return None
+        magic, version, marshal_version, written = \
+            self.HEADER.unpack_from(data)
+        if (magic, version, marshal_version) != \
+                (self.MAGIC, self.VERSION, marshal.version):
+            return None
+        try:
+            return written, marshal.loads(data[self.HEADER.size:])
+        except (EOFError, ValueError, TypeError):
+            logger.warning('Ignoring corrupt cache entry %s', key)
+            return None
+
+    def put(self, key, value, written=None):
+        written = time.time() if written is None else written
+        data = self.HEADER.pack(self.MAGIC, self.VERSION, marshal.version,
+                                written) + marshal.dumps(value)
+        if len(data) > self.max_bytes:
+            logger.warning('Not caching %s: %d bytes', key, len(data))
+            return False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self._trim()
+        except (IOError, OSError):
+            logger.exception('Writing cache entry %s failed', key)
+            return False
+        return True
+
+    def _trim(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(os.path.join(self.directory, name))
+            total -= size
+
+
+class LRUCache(object):
+    def __init__(self, capacity, on_evict=None):
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            evicted = []
+            while len(self.items) > max(self.capacity, 1):
+                evicted.append(self.items.popitem(last=False)[1])
+        if self.on_evict:
+            for value in evicted:
+                self.on_evict(value)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ResponseCache(object):
+    # Responses to recently handled directives, keyed on messageId, so a
+    # retried directive is answered without executing it twice. A retry
+    # that arrives while the original is still running waits for it.
+    class Entry(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.response = None
+            self.expires = None
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _purge(self):
+        # Drops expired responses, then the oldest remembered ones while
+        # over capacity. Directives still running are never dropped, or a
+        # retry would execute them a second time.
+        now = time.monotonic()
+        finished = []
+        for key, entry in list(self.entries.items()):
+            if not entry.done.is_set():
+                continue
+            if entry.expires is None or entry.expires <= now:
+                del self.entries[key]
+            else:
+                finished.append(key)
+        excess = len(self.entries) - self.capacity
+        for key in finished[:max(excess, 0)]:
+            del self.entries[key]
+
+    def begin(self, key, wait=None):
+        # Returns (response, None) for a repeated directive, otherwise
+        # (None, entry) where entry must be passed to finish().
+        while True:
+            with self.lock:
+                self._purge()
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = ResponseCache.Entry()
+                    self.entries[key] = entry
+                    self._purge()
+                    return None, entry
+            if not entry.done.wait(wait):
+                return None, None
+            if entry.response is not None:
+                return entry.response, None
+
+    def finish(self, entry, key, response, ttl):
+        cacheable = (response is not None and
+                     response['event']['header']['name'] != 'ErrorResponse')
+        with self.lock:
+            if cacheable:
+                entry.response = response
+                entry.expires = time.monotonic() + ttl
+            elif self.entries.get(key) is entry:
+                del self.entries[key]
+            entry.done.set()
+
+
+_responses = ResponseCache(256)
+
+
+class SharedResponses(object):
+    # ResponseCache only spans one container, and Alexa may deliver a retry
+    # to another one. With idempotency_table set, directives are also
+    # claimed in a DynamoDB table (partition key messageId, TTL attribute
+    # expires): the first container to claim a messageId executes it and
+    # stores the response, the others wait for it. Failed directives are
+    # released so a retry runs them again.
+    POLL = 0.1
+
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client
+
+    def _client(self):
+        if self.client is None:
+            self.client = dynamodb_client()
+        return self.client
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    def begin(self, message_id, key, ttl, wait=None):
+        # Returns (response, claimed). (None, False) means the directive
+        # should run without being recorded: the claim belongs to another
+        # directive with the same messageId, or waiting for it timed out.
+        client = self._client()
+        digest = self.digest(key)
+        give_up = None if wait is None else time.monotonic() + wait
+        while True:
+            now = int(time.time())
+            try:
+                client.put_item(
+                    TableName=self.table,
+                    Item={'messageId': {'S': message_id},
+                          'digest': {'S': digest},
+                          'expires': {'N': str(now + ttl)}},
+                    ConditionExpression='attribute_not_exists(messageId) '
+                                        'OR expires < :now',
+                    ExpressionAttributeValues={':now': {'N': str(now)}})
+                return None, True
+            except client.exceptions.ConditionalCheckFailedException:
+                pass
+            item = client.get_item(
+                TableName=self.table, ConsistentRead=True,
+                Key={'messageId': {'S': message_id}}).get('Item')
+            if item is None or int(item['expires']['N']) < now:
+                continue
+            if item['digest']['S'] != digest:
+                return None, False
+            if 'response' in item:
+                return json.loads(item['response']['S']), False
+            if give_up is not None and time.monotonic() >= give_up:
+                return None, False
+            time.sleep(self.POLL)
+
+    def finish(self, message_id, key, response, ttl):
+        client = self._client()
+        cacheable = (response is not None and
+                     response['event']['header']['name'] != 'ErrorResponse')
+        if cacheable:
+            client.put_item(
+                TableName=self.table,
+                Item={'messageId': {'S': message_id},
+                      'digest': {'S': self.digest(key)},
+                      'expires': {'N': str(int(time.time()) + ttl)},
+                      'response': {'S': json.dumps(response)}})
+        else:
+            client.delete_item(TableName=self.table,
+                               Key={'messageId': {'S': message_id}})
+
+
+_shared_responses = {}
+
+
+def shared_responses(config):
+    if config.idempotency_table not in _shared_responses:
+        _shared_responses[config.idempotency_table] = \
+            SharedResponses(config.idempotency_table)
+    return _shared_responses[config.idempotency_table]
+
+
+class WebSocketError(Exception):
+    pass
+
+
+class ConnectionLost(WebSocketError):
+    pass
+
+
+class ServiceCalls(object):
+    # Service calls pipelined over one authenticated Home Assistant
+    # WebSocket connection. A call is written as soon as it is made and its
+    # result is matched back by message id, so any number of calls can be in
+    # flight at once without a request/response cycle and headers for each.
+    IDLE_TIMEOUT = 30.0
+
+    def __init__(self, config):
+        self.url = re.sub('^http', 'ws', config.url.rstrip('/')) + \
+            '/websocket'
+        self.password = config.password
+        if config.ssl_verify is False:
+            self.sslopt = {'cert_reqs': ssl.CERT_NONE}
+        elif isinstance(config.ssl_verify, str):
+            self.sslopt = {'ca_certs': config.ssl_verify}
+        else:
+            self.sslopt = {}
+        self.lock = threading.Lock()
+        self.ws = None
+        self.pending = None
+        self.next_id = 1
+        self.last_used = 0
+        self.retry_after = 0
+
+    def _connect(self, timeout):
+        # After a failed attempt, calls go over REST for a while instead of
+        # paying for a connection attempt each.
+        if time.monotonic() < self.retry_after:
+            raise WebSocketError('%s unavailable' % self.url)
+        self.retry_after = time.monotonic() + self.IDLE_TIMEOUT
+        try:
+            import websocket
+        except ImportError:
+            raise WebSocketError('websocket-client is not installed')
+        try:
+            ws = websocket.create_connection(self.url, timeout=timeout,
+                                             sslopt=self.sslopt)
+        except Exception as e:
+            raise WebSocketError('cannot connect to %s: %s' % (self.url, e))
+        try:
+            msg = json.loads(ws.recv())
+            if msg.get('type') == 'auth_required':
+                # Same credential as the x-ha-access header of the REST API.
+                ws.send(json.dumps({'type': 'auth',
+                                    'api_password': self.password}))
+                msg = json.loads(ws.recv())
+        except Exception as e:
+            ws.close()
+            raise WebSocketError('handshake with %s failed: %s' %
+                                 (self.url, e))
+        if msg.get('type') != 'auth_ok':
+            ws.close()
+            raise WebSocketError('authentication failed: %s' %
+                                 msg.get('message', msg.get('type')))
+        ws.settimeout(None)
+        self.retry_after = 0
+        self.ws = ws
+        self.pending = {}
+        threading.Thread(target=self._read, args=(ws, self.pending),
+                         daemon=True).start()
+
+    def _read(self, ws, pending):
+        try:
+            while True:
+                msg = json.loads(ws.recv())
+                if msg.get('type') != 'result':
+                    continue
+                future = pending.pop(msg.get('id'), None)
+                if future is None:
+                    continue
+                if msg.get('success'):
+                    future.set_result(msg.get('result'))
+                else:
+                    error = msg.get('error') or {}
+                    future.set_exception(WebSocketError('%s: %s' % (
+                        error.get('code'), error.get('message'))))
+        except Exception as e:
+            with self.lock:
+                if self.ws is ws:
+                    self.ws = None
+                failed = list(pending.values())
+                pending.clear()
+            for future in failed:
+                future.set_exception(ConnectionLost(
+                    'connection to %s lost: %s' % (self.url, e)))
+
+    def _close(self):
+        ws, self.ws = self.ws, None
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def connect(self, timeout):
+        with self.lock:
+            if self.ws is None:
+                self._connect(timeout)
+            self.last_used = time.monotonic()
+
+    def call(self, domain, service, data, connect_timeout):
+        # Returns a future for the result of the call once it has been sent.
+        future = concurrent.futures.Future()
+        with self.lock:
+            # A connection left idle across frozen invocations may have been
+            # dropped without us noticing; don't trust it with a call.
+            if time.monotonic() - self.last_used > self.IDLE_TIMEOUT:
+                self._close()
+            for attempt in range(2):
+                if self.ws is None:
+                    self._connect(connect_timeout)
+                msg_id = self.next_id
+                self.next_id += 1
+                self.pending[msg_id] = future
+                try:
+                    self.ws.send(json.dumps({'id': msg_id,
+                                             'type': 'call_service',
+                                             'domain': domain,
+                                             'service': service,
+                                             'service_data': data}))
+                    break
+                except Exception as e:
+                    self.pending.pop(msg_id, None)
+                    self._close()
+                    if attempt:
+                        raise WebSocketError('sending to %s failed: %s' %
+                                             (self.url, e))
+            self.last_used = time.monotonic()
+        return future
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+class Backend(object):
+    # Everything about one Home Assistant instance that is worth keeping
+    # across warm invocations: its connection pool, circuit breaker and
+    # latency model.
     def __init__(self, config):
-        self.config = config
-        self.url = config.url.rstrip('/')
         agent_str = 'Home Assistant Alexa Smart Home Skill - %s - %s'
         agent_fmt = agent_str % (os.environ['AWS_DEFAULT_REGION'],
                                  requests.utils.default_user_agent())
         self.session = requests.Session()
         self.session.headers = {'x-ha-access': config.password,
                                 'content-type': 'application/json',
+                                'Accept-Encoding':
+                                    accept_encoding(config.compression),
                                 'User-Agent': agent_fmt}
         self.session.verify = config.ssl_verify
+        self.breaker = CircuitBreaker(config.breaker_threshold,
+                                      config.breaker_reset_timeout)
+        self.latency = LatencyModel()
+        self.service_calls = ServiceCalls(config)
+        self.admission = Admission(config)
+
+    def close(self):
+        self.session.close()
+        self.service_calls.close()
+
+
+_backends = LRUCache(64, on_evict=Backend.close)
+
+
+def get_backend(config):
+    key = (config.url, config.password, str(config.ssl_verify))
+    backend = _backends.get(key)
+    if backend is None:
+        backend = Backend(config)
+        _backends.put(key, backend)
+    return backend
+
+
+# Work fanned out across backends (discovery, warm-up) runs on one pool,
+# and the hedged requests that work makes on another. Sharing a pool would
+# let the fanned out tasks take every worker and then wait on requests that
+# can never start.
+_executor = None
+_request_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+    return _executor
+
+
+def get_request_executor():
+    global _request_executor
+    if _request_executor is None:
+        _request_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=8)
+    return _request_executor
+
+
+def accept_encoding(compression):
+    # Whatever urllib3 can decode here: gzip and deflate, plus br when a
+    # brotli module is installed.
+    if not compression:
+        return 'identity'
+    try:
+        from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+    except ImportError:
+        return 'gzip, deflate'
+    return ACCEPT_ENCODING
+
+
+def response_sizes(r):
+    # Bytes received over the wire, before any decompression, and after it.
+    # urllib3 decompresses as the body streams in, so the compressed body is
+    # never held in full.
+    decoded = len(r.content)
+    try:
+        wire = r.raw.tell()
+    except AttributeError:
+        wire = decoded
+    return wire, decoded
+
+
+class UnknownBackend(Exception):
+    pass
+
+
+# Separates the backend name from the entity in endpointIds of entities that
+# don't live on the default Home Assistant instance, e.g. garage#light:porch
+BACKEND_SEPARATOR = '#'
+
+
+def parse_endpoint_id(endpoint_id):
+    backend, _, entity = endpoint_id.rpartition(BACKEND_SEPARATOR)
+    return backend or None, entity.replace(':', '.')
+
+
+# Reads returning every entity at once. They are many times larger and
+# slower than the single entity reads the latency model learns from, so
+# they are neither hedged nor held to its timeout; only the deadline
+# bounds them.
+BULK_GETS = frozenset(['states'])
+
+
+class HomeAssistant(object):
+    RETRYABLE_ERRORS = (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout)
+
+    def __init__(self, config, metrics=None, tracer=None, deadline=None,
+                 name=None, priority=CONTROL):
+        self.config = config
+        self.name = name
+        self.priority = priority
+        self.metrics = metrics or NullMetrics()
+        self.tracer = tracer or NullTracer()
+        self.deadline = deadline or Deadline()
+        self.url = config.url.rstrip('/')
+        self._backends = {}
+        self.deferred = []
+        # Set to a list to record the calls made to Home Assistant
+        self.calls = None
+        backend = get_backend(config)
+        self.session = backend.session
+        self.breaker = backend.breaker
+        self.latency = backend.latency
+        self.service_calls = backend.service_calls
+        self.admission = backend.admission
 
     def build_url(self, relurl):
         return '%s/%s' % (self.config.url, relurl)
 
+    def for_backend(self, name):
+        # Additional Home Assistant instances are configured under
+        # "backends"; the unnamed backend is the one described by url.
+        if not name:
+            return self
+        if name not in self._backends:
+            if name not in self.config.backends:
+                raise UnknownBackend(name)
+            config = self.config.derive(self.config.backends[name])
+            backend = HomeAssistant(config, self.metrics, self.tracer,
+                                    self.deadline, name, self.priority)
+            backend.deferred = self.deferred
+            backend.calls = self.calls
+            self._backends[name] = backend
+        return self._backends[name]
+
+    def backends(self):
+        return [self] + [self.for_backend(name)
+                         for name in sorted(self.config.backends)]
+
+    def endpoint_id(self, entity_id):
+        endpoint_id = entity_id.replace('.', ':')
+        if self.name:
+            endpoint_id = self.name + BACKEND_SEPARATOR + endpoint_id
+        return endpoint_id
+
+    def _probe(self):
+        self.metrics.incr('ha_probes')
+        timeout = self.config.connect_timeout
+        try:
+            r = self.session.get(self.build_url(''),
+                                 timeout=self.deadline.timeout(timeout,
+                                                               timeout))
+            return r.status_code < 500
+        except (DeadlineExceeded, requests.exceptions.RequestException):
+            return False
+
+    def available(self):
+        return self.breaker.allow(self._probe)
+
+    def _check_breaker(self):
+        if not self.available():
+            self.metrics.incr('breaker_rejected')
+            raise CircuitOpen('Home Assistant at %s is unavailable' %
+                              self.url)
+
+    @contextlib.contextmanager
+    def _captured(self, method, relurl, d=None):
+        call = {'method': method, 'path': relurl}
+        if self.calls is None:
+            yield call
+            return
+        if self.name:
+            call['backend'] = self.name
+        if d is not None:
+            call['body'] = anonymize(d)
+        start = time.perf_counter()
+        try:
+            yield call
+        except Exception as e:
+            call['error'] = type(e).__name__
+            raise
+        finally:
+            call['ms'] = round((time.perf_counter() - start) * 1000.0, 3)
+            self.calls.append(call)
+
+    def _admit(self, relurl):
+        try:
+            return self.admission.acquire(request_domain(relurl),
+                                          self.priority, self.deadline)
+        except Overloaded:
+            self.metrics.incr('ha_shed')
+            raise
+
+    def _request(self, method, relurl, expect_timeout=False, retried=False,
+                 **kwargs):
+        acquired = self._admit(relurl)
+        try:
+            r = self.session.request(method, self.build_url(relurl),
+                                     **kwargs)
+        except requests.exceptions.ReadTimeout:
+            # A read timeout on a fire-and-forget POST still means the
+            # request reached Home Assistant. Retried requests only count
+            # against the breaker once their retries are used up.
+            if expect_timeout:
+                self.breaker.record_success()
+            elif not retried:
+                self.breaker.record_failure()
+            raise
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.admission.release(acquired)
+        if r.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return r
+
     def get(self, relurl):
-        r = self.session.get(self.build_url(relurl))
-        r.raise_for_status()
-        return r.json()
+        self._check_breaker()
+        with self.tracer.span('HTTP GET', **{'http.method': 'GET',
+                                             'http.target': relurl}) as span, \
+                self.metrics.timer('ha_get'), \
+                self._captured('GET', relurl) as call:
+            r = self._get_with_retries(relurl)
+            call['status'] = r.status_code
+            span.set_attribute('http.status_code', r.status_code)
+            wire, decoded = response_sizes(r)
+            span.set_attribute('http.response_content_length', wire)
+            span.set_attribute(
+                'http.response_content_length_uncompressed', decoded)
+            r.raise_for_status()
+            return r.json()
+
+    # GETs are idempotent, so unlike POSTs to services/ they may be hedged
+    # and retried.
+    def _get_with_retries(self, relurl):
+        attempt = 0
+        while True:
+            try:
+                r = self._hedged_get(relurl)
+                if r.status_code < 500 or attempt >= self.config.get_retries:
+                    return r
+            except HomeAssistant.RETRYABLE_ERRORS as e:
+                if attempt >= self.config.get_retries:
+                    if isinstance(e, requests.exceptions.ReadTimeout):
+                        self.breaker.record_failure()
+                    raise
+            attempt += 1
+            # Full jitter exponential backoff, never past the deadline
+            delay = random.uniform(0, self.config.retry_backoff * 2 ** attempt)
+            remaining = self.deadline.remaining()
+            if remaining is not None and \
+                    remaining - delay < self.deadline.min_request:
+                raise DeadlineExceeded('no budget left to retry %s' % relurl)
+            self.metrics.incr('ha_retries')
+            time.sleep(delay)
+            self._check_breaker()
+
+    def _hedged_get(self, relurl):
+        hedge_delay = None
+        if self.config.hedge_requests and relurl not in BULK_GETS:
+            hedge_delay = self.latency.hedge_delay()
+        if hedge_delay is None:
+            return self._timed_get(relurl)
+
+        first = get_request_executor().submit(self._timed_get, relurl)
+        done, _ = concurrent.futures.wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        self.metrics.incr('ha_hedges')
+        second = get_request_executor().submit(self._timed_get, relurl)
+        try:
+            for f in concurrent.futures.as_completed(
+                    [first, second], timeout=self.deadline.remaining()):
+                if f.exception() is None:
+                    return f.result()
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceeded('no response to %s' % relurl)
+        return first.result()
+
+    def _count_received(self, relurl, r):
+        wire, decoded = response_sizes(r)
+        self.metrics.incr('ha_rx_wire_bytes', wire)
+        self.metrics.incr('ha_rx_bytes', decoded)
+        logger.debug('HA %s: %d bytes received, %d decoded (%s)', relurl,
+                     wire, decoded,
+                     r.headers.get('Content-Encoding', 'identity'))
+
+    def _timed_get(self, relurl):
+        bulk = relurl in BULK_GETS
+        read_timeout = None
+        if not bulk:
+            read_timeout = self.latency.timeout(self.config.min_read_timeout)
+        timeout = self.deadline.timeout(self.config.connect_timeout,
+                                        read_timeout)
+        start = time.perf_counter()
+        r = self._request('GET', relurl, retried=True, timeout=timeout)
+        self.metrics.incr('ha_requests')
+        self._count_received(relurl, r)
+        if r.status_code < 500 and not bulk:
+            self.latency.observe(time.perf_counter() - start)
+        return r
+
+    def _post_websocket(self, relurl, d, wait):
+        # Returns whether the call was sent, and its result if waited for.
+        # A call that never left is safe to repeat over REST.
+        domain, _, service = relurl[len('services/'):].partition('/')
+        connect_timeout, _ = self.deadline.timeout(
+            self.config.connect_timeout, None)
+        with self.tracer.span('WS call_service',
+                              **{'haaska.domain': domain,
+                                 'haaska.service': service}), \
+                self.metrics.timer('ha_post'), \
+                self._captured('WS', relurl, d) as call:
+            acquired = self._admit(relurl)
+            try:
+                future = self.service_calls.call(domain, service, d,
+                                                 connect_timeout)
+            except WebSocketError as e:
+                self.admission.release(acquired)
+                logger.warning('Falling back to REST for %s: %s', relurl, e)
+                self.metrics.incr('ws_fallbacks')
+                call['error'] = type(e).__name__
+                return False, None
+            # Calls stay admitted until Home Assistant has answered them,
+            # whether or not the caller waits.
+            future.add_done_callback(
+                lambda f: self.admission.release(acquired))
+            self.metrics.incr('ha_requests')
+            self.breaker.record_success()
+            if not wait:
+                return True, None
+            try:
+                return True, future.result(self.deadline.remaining())
+            except concurrent.futures.TimeoutError:
+                raise DeadlineExceeded('no result for %s' % relurl)
 
     def post(self, relurl, d, wait=False):
+        if self.config.websocket and relurl.startswith('services/'):
+            self._check_breaker()
+            sent, result = self._post_websocket(relurl, d, wait)
+            if sent:
+                return result
         read_timeout = None if wait else 1.00 #0.01
         r = None
+        data = json.dumps(d)
+        self._check_breaker()
+        timeout = self.deadline.timeout(self.config.connect_timeout,
+                                        read_timeout)
         try:
             logger.debug('HA post calling %s with %s', relurl, str(d))
-            r = self.session.post(self.build_url(relurl),
-                                  data=json.dumps(d),
-                                  timeout=(None, read_timeout))
+            with self.tracer.span('HTTP POST',
+                                  **{'http.method': 'POST',
+                                     'http.target': relurl}) as span, \
+                    self.metrics.timer('ha_post'), \
+                    self._captured('POST', relurl, d) as call:
+                self.metrics.incr('ha_requests')
+                self.metrics.incr('ha_tx_bytes', len(data))
+                r = self._request('POST', relurl, expect_timeout=not wait,
+                                  data=data, timeout=timeout)
+                self._count_received(relurl, r)
+                call['status'] = r.status_code
+                span.set_attribute('http.status_code', r.status_code)
             r.raise_for_status()
         except requests.exceptions.ReadTimeout:
+            if wait:
+                raise
             # Allow response timeouts after request was sent
             logger.debug('HA post for %s sent without waiting for response',
                          relurl)
@@ -107,19 +1646,32 @@ class ConnectedHomeCall(object):
         self.name = name
         if self.name == 'ReportState':
             self.response_name = 'StateReport'
+        elif self.name == 'Discover':
+            self.response_name = 'Discover.Response'
         else:
             self.response_name = 'Response'
-            
-        self.namespace = 'Alexa'
+
+        if namespace != 'Alexa.Discovery':
+            self.namespace = 'Alexa'
         self.ha = ha
         self.payload = payload
         self.endpoint = endpoint
         self.entity = None
         self.context_properties = []
+        self.time_of_sample = None
         self.correlationToken = correlationToken
+        self.init_error = None
+        self.deferred = None
         if self.endpoint and ('endpointId' in self.endpoint):
-            self.entity = mk_entity(ha, self.endpoint['endpointId']
-                                    .replace(':', '.'))
+            backend, entity_id = parse_endpoint_id(
+                self.endpoint['endpointId'])
+            try:
+                self.ha = ha.for_backend(backend)
+            except UnknownBackend:
+                self.init_error = ConnectedHomeCall.ErrorResponse(
+                    'NO_SUCH_ENDPOINT', 'unknown backend %s' % backend)
+                return
+            self.entity = mk_entity(self.ha, entity_id)
         
 
     class ConnectedHomeException(Exception):
@@ -132,7 +1684,25 @@ class ConnectedHomeCall(object):
             self.error_name = 'ValueOutOfRangeError'
             self.payload = {'minimumValue': minValue, 'maximumValue': maxValue}
 
+    class ErrorResponse(ConnectedHomeException):
+        def __init__(self, error_type, message=''):
+            self.error_name = 'ErrorResponse'
+            self.payload = {'type': error_type, 'message': message}
+
+    UNREACHABLE_ERRORS = (DeadlineExceeded, CircuitOpen, ConnectionLost,
+                          requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout)
+
     def invoke(self, name):
+        entity_id = self.entity.entity_id if self.entity else None
+        with self.ha.tracer.span('%s.%s' % (type(self).__name__, name),
+                                 **{'alexa.name': name,
+                                    'haaska.entity_id': entity_id}) as span:
+            r = self._invoke(name)
+            span.set_attribute('alexa.response', self.response_name)
+            return r
+
+    def _invoke(self, name):
         logger.debug('invoking ConnectedHomeCall %s %s', self.namespace, name)
         r = {'event': {}}
         try:
@@ -142,13 +1712,17 @@ class ConnectedHomeCall(object):
                        'messageId': get_uuid(),
                        "correlationToken": self.correlationToken}
             
-            payload = operator.attrgetter(name)(self)()
+            if self.init_error:
+                raise self.init_error
+            with self.ha.metrics.timer('handler'):
+                payload = operator.attrgetter(name)(self)()
+            r['event']['header']['name'] = self.response_name
             if payload:
                 r['event']['payload'] = payload
             else:
                 r['event']['payload'] = {}
 
-            if self.endpoint:
+            if self.endpoint and not self.deferred:
                 r['event']['endpoint'] = {
                     "endpointId": self.endpoint['endpointId']
                     } 
@@ -159,98 +1733,110 @@ class ConnectedHomeCall(object):
             logger.debug('response payload: %s', str(r['event']['payload']))
         except ConnectedHomeCall.ConnectedHomeException as e:
             logger.exception('ConnectedHomeCall failed: %s, %s', e.error_name, e.payload)
-            self.response_name = e.error_name
-            r['event']['payload'] = e.payload
+            self._set_error(r, e)
+        except Overloaded as e:
+            logger.warning('Shedding %s: %s', name, e)
+            self._set_error(r, ConnectedHomeCall.ErrorResponse(
+                'RATE_LIMIT_EXCEEDED', str(e)))
+        except ConnectedHomeCall.UNREACHABLE_ERRORS as e:
+            logger.exception('Home Assistant unreachable')
+            self._set_error(r, ConnectedHomeCall.ErrorResponse(
+                'BRIDGE_UNREACHABLE', str(e)))
         except Exception:
             logger.exception('ConnectedHomeCall failed unexpectedly')
-            self.response_name = 'DriverInternalError'
-            r['event']['payload'] = {}
+            self._set_error(r, ConnectedHomeCall.ConnectedHomeException())
 
         return r
 
+    def add_property(self, namespace, name, value):
+        # All the properties in a response share one timeOfSample
+        if self.time_of_sample is None:
+            self.time_of_sample = get_utc_timestamp()
+        self.context_properties.append({
+            "namespace": namespace,
+            "name": name,
+            "value": value,
+            "timeOfSample": self.time_of_sample,
+            "uncertaintyInMilliseconds": 200
+        })
+
+    def defer(self, action):
+        # Slow actuators (locks, covers, ...) take seconds to reach the
+        # requested state. Rather than claiming it immediately, answer with
+        # a DeferredResponse and report the real outcome to the Alexa event
+        # gateway once Home Assistant shows the state change.
+        if not self.ha.config.deferred_responses or \
+                not hasattr(self.entity, 'expected_states'):
+            return None
+        states = self.entity.expected_states(action)
+        if not states:
+            return None
+        self.deferred = {'endpoint': self.endpoint,
+                         'correlationToken': self.correlationToken,
+                         'action': action,
+                         'states': states}
+        self.ha.deferred.append(self.deferred)
+        self.response_name = 'DeferredResponse'
+        return {'estimatedDeferralInSeconds':
+                self.ha.config.deferred_estimate}
+
+    def _set_error(self, r, e):
+        self.response_name = e.error_name
+        r['event']['header']['namespace'] = 'Alexa'
+        r['event']['header']['name'] = e.error_name
+        r['event']['payload'] = e.payload
+        if self.endpoint:
+            r['event']['endpoint'] = {
+                "endpointId": self.endpoint['endpointId']
+            }
+        r.pop('context', None)
+
 
 class Alexa(object):
     class ReportState(ConnectedHomeCall):
         def ReportState(self):
+            if not self.ha.available():
+                self.add_property("Alexa.EndpointHealth", "connectivity",
+                                  {"value": "UNREACHABLE"})
+                return
+
             if hasattr(self.entity, 'get_current_temperature'):
                 state = self.ha.get('states/' + self.entity.entity_id)
                 scale = get_temp_scale(state['attributes']['unit_of_measurement'])
                 temperature = self.entity.get_current_temperature(state)
-                self.context_properties.append({
-                    "namespace": "Alexa.TemperatureSensor",
-                    "name": "temperature",
-                    "value": {
-                        "value": temperature,
-                        "scale": scale
-                    },
-                    "timeOfSample": get_utc_timestamp(),
-                    "uncertaintyInMilliseconds": 200
-                })
+                self.add_property("Alexa.TemperatureSensor", "temperature",
+                                  {"value": temperature, "scale": scale})
             
             if hasattr(self.entity, 'get_temperature'):
                 state = self.ha.get('states/' + self.entity.entity_id)
                 scale = get_temp_scale(state['attributes']['unit_of_measurement'])
                 temperature, mode = self.entity.get_temperature(state)
-                self.context_properties.append({
-                    "namespace": "Alexa.ThermostatController",
-                    "name": "targetSetpoint",
-                    "value": {
-                        "value": temperature,
-                        "scale": scale
-                    },
-                    "timeOfSample": get_utc_timestamp(),
-                    "uncertaintyInMilliseconds": 200
-                })
-                self.context_properties.append({
-                    "namespace": "Alexa.ThermostatController",
-                    "name": "thermostatMode",
-                    "value": mode.upper(),
-                    "timeOfSample": get_utc_timestamp(),
-                    "uncertaintyInMilliseconds": 200
-                })
+                self.add_property("Alexa.ThermostatController",
+                                  "targetSetpoint",
+                                  {"value": temperature, "scale": scale})
+                self.add_property("Alexa.ThermostatController",
+                                  "thermostatMode", mode.upper())
             
             if hasattr(self.entity, 'get_lock_state'):
                 lock_state = self.entity.get_lock_state().upper()
-                self.context_properties.append({
-                    "namespace": "Alexa.LockController",
-                    "name": "lockState",
-                    "value": lock_state,
-                    "timeOfSample": get_utc_timestamp(),
-                    "uncertaintyInMilliseconds": 200
-                })
+                self.add_property("Alexa.LockController", "lockState",
+                                  lock_state)
             
             if (hasattr(self.entity, 'turn_on') or hasattr(self.entity, 'turn_off')) and not hasattr(self.entity, 'get_temperature'):
                 state = self.ha.get('states/' + self.entity.entity_id)
                 device_state = state.get('state').upper()
-                self.context_properties.append({
-                    "namespace": "Alexa.PowerController",
-                    "name": "powerState",
-                    "value": device_state,
-                    "timeOfSample": get_utc_timestamp(),
-                    "uncertaintyInMilliseconds": 200
-                })
+                self.add_property("Alexa.PowerController", "powerState",
+                                  device_state)
             
             if hasattr(self.entity, 'get_percentage'):
                 state = self.ha.get('states/' + self.entity.entity_id)
                 percentage = self.entity.get_percentage()
-                self.context_properties.append({
-                    "namespace": "Alexa.PercentageController",
-                    "name": "percentage",
-                    "value": percentage,
-                    "timeOfSample": get_utc_timestamp(),
-                    "uncertaintyInMilliseconds": 200
-                })
+                self.add_property("Alexa.PercentageController", "percentage",
+                                  int(round(percentage)))
                 
             # Report EndpointHealth for ALL items
-            self.context_properties.append({
-                "namespace": "Alexa.EndpointHealth",
-                "name": "connectivity",
-                "value": {
-                    "value": "OK"
-                },
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.EndpointHealth", "connectivity",
+                              {"value": "OK"})
 
     class Discovery(ConnectedHomeCall):
         def Discover(self):
@@ -262,23 +1848,17 @@ class Alexa(object):
     class PowerController(ConnectedHomeCall):
         def TurnOn(self):
             self.entity.turn_on()
-            self.context_properties.append({
-                "namespace": "Alexa.PowerController",
-                "name": "powerState",
-                "value": "ON",
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            deferred = self.defer('TurnOn')
+            if deferred:
+                return deferred
+            self.add_property("Alexa.PowerController", "powerState", "ON")
 
         def TurnOff(self):
             self.entity.turn_off()
-            self.context_properties.append({
-                "namespace": "Alexa.PowerController",
-                "name": "powerState",
-                "value": "OFF",
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            deferred = self.defer('TurnOff')
+            if deferred:
+                return deferred
+            self.add_property("Alexa.PowerController", "powerState", "OFF")
 
     class BrightnessController(ConnectedHomeCall):
         def AdjustBrightness(self):
@@ -287,36 +1867,21 @@ class Alexa(object):
             brightness += delta
             brightness = check_value(brightness, 0.0, 100.0)
             self.entity.set_percentage(brightness)
-            self.context_properties.append({
-                "namespace": "Alexa.BrightnessController",
-                "name": "brightness",
-                "value": brightness,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.BrightnessController", "brightness",
+                              int(round(brightness)))
             
         def SetBrightness(self):
             brightness = self.payload['brightness']
             self.entity.set_percentage(brightness)
-            self.context_properties.append({
-                "namespace": "Alexa.BrightnessController",
-                "name": "brightness",
-                "value": brightness,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.BrightnessController", "brightness",
+                              brightness)
 
     class PercentageController(ConnectedHomeCall):
         def SetPercentage(self):
             percentage = self.payload['percentage']
             self.entity.set_percentage(percentage)
-            self.context_properties.append({
-                "namespace": "Alexa.PercentageController",
-                "name": "percentage",
-                "value": percentage,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.PercentageController", "percentage",
+                              percentage)
 
         def AdjustPercentage(self):
             delta = self.payload['percentageDelta']
@@ -324,49 +1889,29 @@ class Alexa(object):
             percentage += delta
             percentage = check_value(percentage, 0.0, 100.0)
             self.entity.set_percentage(percentage)
-            self.context_properties.append({
-                "namespace": "Alexa.PercentageController",
-                "name": "percentage",
-                "value": percentage,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.PercentageController", "percentage",
+                              int(round(percentage)))
 
     class ColorTemperatureController(ConnectedHomeCall):
         def DecreaseColorTemperature(self):
             currentColorTemp = self.entity.get_color_temperature()
             newColorTemp = currentColorTemp - 500
             self.entity.set_color_temperature(newColorTemp)
-            self.context_properties.append({
-                "namespace": "Alexa.ColorTemperatureController",
-                "name": "colorTemperatureInKelvin",
-                "value": newColorTemp,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.ColorTemperatureController",
+                              "colorTemperatureInKelvin", newColorTemp)
 
         def IncreaseColorTemperature(self):
             currentColorTemp = self.entity.get_color_temperature()
             newColorTemp = currentColorTemp + 500
             self.entity.set_color_temperature(newColorTemp)
-            self.context_properties.append({
-                "namespace": "Alexa.ColorTemperatureController",
-                "name": "colorTemperatureInKelvin",
-                "value": newColorTemp,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.ColorTemperatureController",
+                              "colorTemperatureInKelvin", newColorTemp)
 
         def SetColorTemperature(self):
             colorTemp = self.payload['colorTemperatureInKelvin']
-            self.entity.set_color_temperature(temp)
-            self.context_properties.append({
-                "namespace": "Alexa.ColorTemperatureController",
-                "name": "colorTemperatureInKelvin",
-                "value": colorTemp,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.entity.set_color_temperature(colorTemp)
+            self.add_property("Alexa.ColorTemperatureController",
+                              "colorTemperatureInKelvin", colorTemp)
 
     class PowerLevelController(ConnectedHomeCall):
         def AdjustPowerLevel(self):
@@ -375,24 +1920,14 @@ class Alexa(object):
             val += delta
             val = check_value(val, 0.0, 100.0)
             self.entity.set_percentage(val)
-            self.context_properties.append({
-                "namespace": "Alexa.PowerLevelController",
-                "name": "powerLevel",
-                "value": val,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.PowerLevelController", "powerLevel",
+                              int(round(val)))
         
         def SetPowerLevel(self):
             percentage = self.payload['powerLevel']
             self.entity.set_percentage(percentage)
-            self.context_properties.append({
-                "namespace": "Alexa.PowerLevelController",
-                "name": "powerLevel",
-                "value": percentage,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.PowerLevelController", "powerLevel",
+                              percentage)
 
     class ThermostatController(ConnectedHomeCall):
         def SetTargetTemperature(self):
@@ -418,23 +1953,10 @@ class Alexa(object):
             
             self.entity.set_temperature(new_temp, mode.lower(), state)
             
-            self.context_properties.append({
-                "namespace": "Alexa.ThermostatController",
-                "name": "targetSetpoint",
-                "value": {
-                    "value": new_temp,
-                    "scale": scale
-                },
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
-            self.context_properties.append({
-                "namespace": "Alexa.ThermostatController",
-                "name": "thermostatMode",
-                "value": mode.upper(),
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.ThermostatController", "targetSetpoint",
+                              {"value": new_temp, "scale": scale})
+            self.add_property("Alexa.ThermostatController", "thermostatMode",
+                              mode.upper())
             
         def AdjustTargetTemperature(self):
             state = self.ha.get('states/' + self.entity.entity_id)
@@ -444,7 +1966,8 @@ class Alexa(object):
             max_temp = convert_temp(state['attributes']['max_temp'], unit)
             temperature, mode = self.entity.get_temperature(state)
         
-            new_temp = op(temperature,float(self.payload['targetSetpointDelta']['value']))
+            delta = float(self.payload['targetSetpointDelta']['value'])
+            new_temp = temperature + delta
             # Clamp the allowed temperature for relative adjustments
             if temperature != max_temp and temperature != min_temp:
                 new_temp = check_value(new_temp, min_temp, max_temp)
@@ -462,23 +1985,10 @@ class Alexa(object):
             
             self.entity.set_temperature(new_temp, mode.lower(), state)
                             
-            self.context_properties.append({
-                "namespace": "Alexa.ThermostatController",
-                "name": "targetSetpoint",
-                "value": {
-                    "value": new_temp,
-                    "scale": scale
-                },
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
-            self.context_properties.append({
-                "namespace": "Alexa.ThermostatController",
-                "name": "thermostatMode",
-                "value": mode.upper(),
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.ThermostatController", "targetSetpoint",
+                              {"value": new_temp, "scale": scale})
+            self.add_property("Alexa.ThermostatController", "thermostatMode",
+                              mode.upper())
             
         def SetThermostatMode(self):
             mode = self.payload['thermostatMode']['value']
@@ -488,70 +1998,39 @@ class Alexa(object):
             else:
                 self.entity.turn_off()
             
-            self.context_properties.append({
-                "namespace": "Alexa.ThermostatController",
-                "name": "thermostatMode",
-                "value": mode,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.ThermostatController", "thermostatMode",
+                              mode)
 
     class TemperatureSensor(ConnectedHomeCall):
         def ReportState(self):
             state = self.ha.get('states/' + self.entity.entity_id)
             scale = get_temp_scale(state['attributes']['unit_of_measurement'])
             temperature = self.entity.get_current_temperature(state)
-            self.context_properties.append({
-                "namespace": "Alexa.TemperatureSensor",
-                "name": "temperature",
-                "value": {
-                    "value": temperature,
-                    "scale": scale
-                },
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.TemperatureSensor", "temperature",
+                              {"value": temperature, "scale": scale})
 
     class LockController(ConnectedHomeCall):
         def Lock(self):
-            self.entity.set_lock_state(self.payload["lockState"])
-            self.context_properties.append({
-                "namespace": "Alexa.LockController",
-                "name": "lockState",
-                "value": "LOCKED",
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.entity.set_lock_state("LOCKED")
+            deferred = self.defer('Lock')
+            if deferred:
+                return deferred
+            self.add_property("Alexa.LockController", "lockState", "LOCKED")
         
         def Unlock(self):
-            self.entity.set_lock_state(self.payload["lockState"])
-            self.context_properties.append({
-                "namespace": "Alexa.LockController",
-                "name": "lockState",
-                "value": "UNOCKED",
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.entity.set_lock_state("UNLOCKED")
+            deferred = self.defer('Unlock')
+            if deferred:
+                return deferred
+            self.add_property("Alexa.LockController", "lockState", "UNLOCKED")
     class Speaker(ConnectedHomeCall):
         def SetVolume(self):
             volume = self.payload['volume']['value']
             volume = check_value(volume, 0.0, 100.0)
             self.entity.set_volume(volume)
             mute_state = self.entity.get_mute()
-            self.context_properties.append({
-                "namespace": "Alexa.Speaker",
-                "name": "volume",
-                "value": volume,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
-            self.context_properties.append({
-                "namespace": "Alexa.Speaker",
-                "name": "muted",
-                "value": mute_state,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.Speaker", "volume", int(round(volume)))
+            self.add_property("Alexa.Speaker", "muted", mute_state)
         
         def AdjustVolume(self):
             delta = self.payload['volume']['value']
@@ -560,39 +2039,15 @@ class Alexa(object):
             volume = check_value(volume, 0.0, 100.0)
             self.entity.set_volume(volume)
             mute_state = self.entity.get_mute()
-            self.context_properties.append({
-                "namespace": "Alexa.Speaker",
-                "name": "volume",
-                "value": volume,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
-            self.context_properties.append({
-                "namespace": "Alexa.Speaker",
-                "name": "muted",
-                "value": mute_state,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.Speaker", "volume", int(round(volume)))
+            self.add_property("Alexa.Speaker", "muted", mute_state)
         
         def SetMute(self):
             mute = self.payload['mute']['value']
             mute_state = self.entity.set_mute(mute)
             volume = self.entity.get_volume()
-            self.context_properties.append({
-                "namespace": "Alexa.Speaker",
-                "name": "volume",
-                "value": volume,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
-            self.context_properties.append({
-                "namespace": "Alexa.Speaker",
-                "name": "muted",
-                "value": mute_state,
-                "timeOfSample": get_utc_timestamp(),
-                "uncertaintyInMilliseconds": 200
-            })
+            self.add_property("Alexa.Speaker", "volume", int(round(volume)))
+            self.add_property("Alexa.Speaker", "muted", mute_state)
         
     class PlaybackController(ConnectedHomeCall):
         def FastForward(self):
@@ -627,24 +2082,484 @@ def invoke(namespace, name, ha, payload, endpoint, correlationToken):
     make_class = operator.attrgetter(namespace)
     logger.debug('Calling invoke %s, %s, %s, %s, %s, %s', namespace, name, ha,
                  payload, endpoint, correlationToken)
-    obj = make_class(allowed)(namespace, name, ha, payload, endpoint, correlationToken)
-    return obj.invoke(name)
-
-def discover_appliances(ha):
-    def entity_domain(x):
-        return x['entity_id'].split('.', 1)[0]
-
-    def is_supported_entity(x):
-        return entity_domain(x) in ha.config.exposed_domains
+    with ha.tracer.span('invoke', **{'alexa.namespace': namespace,
+                                     'alexa.name': name}):
+        obj = make_class(allowed)(namespace, name, ha, payload, endpoint,
+                                  correlationToken)
+        return obj.invoke(name)
+
+
+class EntityFilter(object):
+    # Decides which Home Assistant entities are exposed to Alexa. All rules
+    # are compiled up front into hash sets and one combined regex per rule
+    # list, so each entity costs a few dict/set lookups and at most two
+    # regex matches regardless of how many rules are configured.
+    #
+    # Precedence: exposed_domains, entity_overrides, exclude rules, the
+    # haaska_hidden/hidden attributes, include rules, expose_by_default.
+    def __init__(self, config):
+        self.domains = frozenset(config.exposed_domains)
+        self.overrides = dict(config.entity_overrides)
+        self.include_ids, self.include_re = \
+            self.compile_patterns(config.include_entities)
+        self.exclude_ids, self.exclude_re = \
+            self.compile_patterns(config.exclude_entities)
+        self.include_attrs = self.compile_attributes(
+            config.include_attributes)
+        self.exclude_attrs = self.compile_attributes(
+            config.exclude_attributes)
+        self.expose_by_default = config.expose_by_default
+
+    @staticmethod
+    def compile_patterns(patterns):
+        exact = set()
+        regexes = []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                regexes.append(pattern[3:])
+            elif any(c in pattern for c in '*?['):
+                regexes.append(fnmatch.translate(pattern))
+            else:
+                exact.add(pattern)
+        combined = None
+        if regexes:
+            combined = re.compile('|'.join('(?:%s)' % r for r in regexes))
+        return frozenset(exact), combined
+
+    @staticmethod
+    def compile_attributes(rules):
+        return [(attr, frozenset(values if isinstance(values, list)
+                                 else [values]))
+                for attr, values in sorted(rules.items())]
+
+    @staticmethod
+    def match_id(entity_id, ids, regex):
+        return entity_id in ids or (regex is not None and
+                                    regex.match(entity_id) is not None)
+
+    @staticmethod
+    def match_attributes(attributes, rules):
+        for attr, values in rules:
+            value = attributes.get(attr)
+            if value is not None and not isinstance(value, (list, dict)) \
+                    and value in values:
+                return True
+        return False
+
+    def __call__(self, x):
+        entity_id = x['entity_id']
+        if entity_id.split('.', 1)[0] not in self.domains:
+            return False
+
+        override = self.overrides.get(entity_id)
+        if override is not None:
+            return override
 
-    def is_exposed_entity(x):
         attr = x['attributes']
+        if self.match_id(entity_id, self.exclude_ids, self.exclude_re) or \
+                self.match_attributes(attr, self.exclude_attrs):
+            return False
         if 'haaska_hidden' in attr:
             return not attr['haaska_hidden']
         elif 'hidden' in attr:
             return not attr['hidden']
-        else:
-            return ha.config.expose_by_default
+        if self.match_id(entity_id, self.include_ids, self.include_re) or \
+                self.match_attributes(attr, self.include_attrs):
+            return True
+        return self.expose_by_default
+
+
+SNAPSHOT_VERSION = 1
+_snapshots = {}
+# Holds the discovery results and the endpoints known to Alexa per home,
+# sized by max_tenants in event_handler().
+_cached = LRUCache(128)
+_disk_caches = {}
+
+
+def config_digest(config):
+    return hashlib.sha256(json.dumps(config.opts, sort_keys=True,
+                                     default=str).encode('utf-8')).hexdigest()
+
+
+def disk_cache(config):
+    if not config.cache_dir:
+        return None
+    if config.cache_dir not in _disk_caches:
+        _disk_caches[config.cache_dir] = DiskCache(config.cache_dir,
+                                                   config.cache_max_bytes)
+    return _disk_caches[config.cache_dir]
+
+
+def cache_get(config, kind, max_age=None):
+    # Per configuration values kept in memory and, when cache_dir is set,
+    # on disk for the next process in this container.
+    key = '%s:%s' % (kind, config_digest(config))
+    entry = _cached.get(key)
+    if entry is None and disk_cache(config) is not None:
+        entry = disk_cache(config).get(key)
+        if entry is not None:
+            _cached.put(key, entry)
+    if entry is None or \
+            (max_age is not None and time.time() - entry[0] > max_age):
+        return None
+    return entry[1]
+
+
+def cache_put(config, kind, value):
+    key = '%s:%s' % (kind, config_digest(config))
+    entry = (time.time(), value)
+    _cached.put(key, entry)
+    if disk_cache(config) is not None:
+        disk_cache(config).put(key, value, entry[0])
+
+
+def build_snapshot(config, states=None):
+    # Discovery results precomputed at build time (make snapshot) and
+    # bundled into haaska.zip, so a cold container can answer Discover
+    # without fetching and converting every state first. states is a saved
+    # GET /api/states of the default backend to build from instead of a
+    # live Home Assistant.
+    ha = HomeAssistant(config, priority=DISCOVERY)
+    if states is None:
+        endpoints = discover_live(ha)
+    else:
+        endpoints = discover_backend(ha, states)
+    return {'version': SNAPSHOT_VERSION,
+            'created': get_utc_timestamp(),
+            'config': config_digest(config),
+            'endpoints': endpoints}
+
+
+def write_snapshot(config_file, filename, states_file=None):
+    states = None
+    if states_file:
+        with open(states_file) as f:
+            states = json.load(f)
+    snapshot = build_snapshot(Configuration(config_file), states)
+    with open(filename, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    return len(snapshot['endpoints'])
+
+
+def load_snapshot(config):
+    filename = config.discovery_snapshot
+    if not filename:
+        return None
+    if filename not in _snapshots:
+        snapshot = None
+        try:
+            with open(filename) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            logger.exception('Ignoring unreadable discovery snapshot %s',
+                             filename)
+        if snapshot is not None and \
+                snapshot.get('version') != SNAPSHOT_VERSION:
+            snapshot = None
+        _snapshots[filename] = snapshot
+    snapshot = _snapshots[filename]
+    if snapshot is None or snapshot['config'] != config_digest(config):
+        return None
+    return snapshot
+
+
+def reconcile_discovery(ha, endpoints, missing=()):
+    # Keep-warm events bring what Discover is answered from up to date with
+    # Home Assistant. This can't run behind a Discover response instead:
+    # Lambda freezes the process as soon as the handler returns.
+    if not missing and ha.config.discovery_cache_ttl > 0:
+        cache_put(ha.config, 'discovery', endpoints)
+    snapshot = load_snapshot(ha.config)
+    if snapshot is not None:
+        changed, removed = discovery_delta(
+            {e['endpointId']: e for e in snapshot['endpoints']}, endpoints,
+            missing)
+        if changed or removed:
+            logger.warning('Discovery snapshot from %s is stale (%d '
+                           'endpoints added or changed, %d removed); '
+                           'rebuild it with make snapshot',
+                           snapshot['created'], len(changed), len(removed))
+    try:
+        sync_discovery(ha, endpoints, missing)
+    except Exception:
+        logger.exception('Sending discovery updates failed')
+
+
+def snapshot_age(snapshot):
+    created = datetime.datetime.strptime(snapshot['created'][:19],
+                                         '%Y-%m-%dT%H:%M:%S')
+    return (datetime.datetime.utcnow() - created).total_seconds()
+
+
+# Configurations whose container has already answered from the snapshot
+_snapshot_served = set()
+
+
+def discover_appliances(ha):
+    # Answer from live results of this container, or the process before
+    # it, up to discovery_cache_ttl old; keep-warm events refresh them. A
+    # cold container with no such results answers its first Discover from
+    # the bundled snapshot, as long as that is under snapshot_max_age.
+    # Anything else discovers live, so a device added to Home Assistant is
+    # found by the next Discover after that even without keep-warm events.
+    config = ha.config
+    endpoints = None
+    if config.discovery_cache_ttl > 0:
+        endpoints = cache_get(config, 'discovery', config.discovery_cache_ttl)
+    if endpoints is None:
+        snapshot = load_snapshot(config)
+        digest = config_digest(config)
+        if snapshot is not None and digest not in _snapshot_served and \
+                (not config.snapshot_max_age or
+                 snapshot_age(snapshot) < config.snapshot_max_age):
+            _snapshot_served.add(digest)
+            ha.metrics.incr('discovery_snapshot')
+            endpoints = snapshot['endpoints']
+    if endpoints is None:
+        endpoints, missing = discover_backends(ha)
+        # Only kept when something will answer from it
+        if not missing and config.discovery_cache_ttl > 0:
+            cache_put(config, 'discovery', endpoints)
+    else:
+        ha.metrics.incr('discovery_cached')
+    if config.discovery_updates:
+        # This is now what Alexa knows about; later changes are sent as
+        # deltas.
+        cache_put(config, 'known', endpoints)
+    return endpoints
+
+
+def discover_live(ha):
+    return discover_backends(ha)[0]
+
+
+def discover_backends(ha):
+    # Returns the endpoints found and the names of backends that couldn't be
+    # discovered (None being the default backend).
+    backends = ha.backends()
+    if len(backends) == 1:
+        return discover_backend(ha), set()
+
+    # Query every backend at once and merge in configuration order. A
+    # backend that hasn't answered within discovery_timeout (or the
+    # deadline) is left out rather than failing the whole discovery.
+    timeout = ha.config.discovery_timeout
+    remaining = ha.deadline.remaining()
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    futures = [(b, get_executor().submit(discover_backend, b))
+               for b in backends]
+    concurrent.futures.wait([f for _, f in futures], timeout=timeout)
+
+    endpoints = []
+    missing = set()
+    for backend, future in futures:
+        if not future.done():
+            logger.warning('Discovery of backend %s timed out, reporting '
+                           'partial results', backend.name or 'default')
+            ha.metrics.incr('discovery_partial')
+            missing.add(backend.name)
+            continue
+        try:
+            endpoints.extend(future.result())
+        except Exception:
+            logger.exception('Discovery of backend %s failed',
+                             backend.name or 'default')
+            ha.metrics.incr('discovery_partial')
+            missing.add(backend.name)
+    return endpoints, missing
+
+
+# Most endpoints Alexa accepts in one discovery event
+DISCOVERY_EVENT_ENDPOINTS = 300
+
+
+def discovery_delta(known, endpoints, missing=()):
+    # Endpoints that are new or differ in any way (name, description,
+    # capabilities, ...) from what is known, and the ids of those that are
+    # gone. Endpoints of backends that couldn't be discovered aren't gone.
+    current = {e['endpointId']: e for e in endpoints}
+    changed = [e for i, e in current.items() if known.get(i) != e]
+    removed = [i for i in known if i not in current and
+               parse_endpoint_id(i)[0] not in missing]
+    return changed, removed
+
+
+def discovery_event(name, endpoints):
+    return {'event': {'header': {'namespace': 'Alexa.Discovery',
+                                 'name': name,
+                                 'payloadVersion': '3',
+                                 'messageId': get_uuid()},
+                      'payload': {'endpoints': endpoints}}}
+
+
+def sync_discovery(ha, endpoints, missing=()):
+    # Tell Alexa about what changed since the endpoints it last heard of,
+    # with AddOrUpdateReport and DeleteReport events, instead of leaving it
+    # to the next full discovery.
+    if not ha.config.discovery_updates:
+        return [], []
+    known = cache_get(ha.config, 'known')
+    if known is None:
+        # Until this container answers a Discover, assume Alexa knows what
+        # was deployed with it; without a snapshot there's nothing to
+        # compare with.
+        snapshot = load_snapshot(ha.config)
+        if snapshot is None:
+            return [], []
+        known = snapshot['endpoints']
+    known = collections.OrderedDict((e['endpointId'], e) for e in known)
+    changed, removed = discovery_delta(known, endpoints, missing)
+    step = DISCOVERY_EVENT_ENDPOINTS
+    for i in range(0, len(changed), step):
+        send_event(ha.config, discovery_event('AddOrUpdateReport',
+                                              changed[i:i + step]))
+    for i in range(0, len(removed), step):
+        send_event(ha.config, discovery_event(
+            'DeleteReport',
+            [{'endpointId': endpoint_id}
+             for endpoint_id in removed[i:i + step]]))
+    # Only once Alexa has accepted the events; otherwise they are sent again
+    # next time.
+    known.update((e['endpointId'], e) for e in changed)
+    for endpoint_id in removed:
+        del known[endpoint_id]
+    if changed or removed:
+        cache_put(ha.config, 'known', list(known.values()))
+        logger.info('Sent discovery updates: %d added or updated, %d '
+                    'removed', len(changed), len(removed))
+        ha.metrics.incr('discovery_updates', len(changed) + len(removed))
+    return changed, removed
+
+
+def discover_backend(ha, states=None):
+    if states is None:
+        states = ha.get('states')
+    workers = discovery_workers(ha.config, len(states))
+    if workers > 1:
+        with ha.metrics.timer('discovery_parallel'):
+            endpoints = build_endpoints_parallel(ha, states, workers)
+        if endpoints is not None:
+            return endpoints
+        ha.metrics.incr('discovery_parallel_failed')
+    return build_endpoints(ha, states)
+
+
+def discovery_workers(config, count):
+    # Building endpoints is pure Python, so only separate processes can
+    # spread it over the cores Lambda allots with more memory. Forking and
+    # sending the endpoints back costs more than it saves below
+    # discovery_parallel_min entities, and no worker is given fewer than a
+    # thousand. Only the main thread forks: from a pool thread, another
+    # thread could be holding a lock (a connection pool's, the WebSocket
+    # reader's, logging's) that the child then waits on forever.
+    if threading.current_thread() is not threading.main_thread():
+        return 1
+    if not config.discovery_parallel_min or \
+            count < config.discovery_parallel_min:
+        return 1
+    workers = config.discovery_workers
+    if not workers:
+        try:
+            workers = len(os.sched_getaffinity(0))
+        except AttributeError:
+            workers = os.cpu_count() or 1
+        # Loading the endpoints back is left to this process and costs
+        # about half as much as building them, so below four cores there
+        # is too little to gain.
+        if workers < 4:
+            return 1
+    return max(1, min(workers, count // 1000))
+
+
+def _build_chunk(ha, states, conn):
+    # Endpoints are sent marshalled, which is quicker both ways than pickle
+    # for plain dicts and lists.
+    try:
+        result = (True, build_endpoints(ha, states))
+    except Exception as e:
+        result = (False, '%s: %s' % (type(e).__name__, e))
+    conn.send_bytes(marshal.dumps(result))
+    conn.close()
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # Building or loading tens of thousands of endpoints allocates enough
+    # containers to set off repeated full collections, which find nothing
+    # to free but take as long again as the work itself.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def build_endpoints_parallel(ha, states, workers):
+    # Each worker builds the endpoints for a contiguous slice of states,
+    # which it inherits by forking rather than having it pickled, and the
+    # results are joined in slice order, so the endpoints come out in the
+    # same order as building them serially. Processes talk over plain
+    # pipes since Lambda has no /dev/shm for multiprocessing's queues and
+    # pools. Returns None if any slice couldn't be built in time.
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    size = -(-len(states) // workers)
+    timeout = ha.config.discovery_timeout
+    remaining = ha.deadline.remaining()
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    give_up = time.monotonic() + timeout
+    jobs = []
+    delivered = 0
+    try:
+        for i in range(0, len(states), size):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_build_chunk,
+                                      args=(ha, states[i:i + size], sender),
+                                      daemon=True)
+            process.start()
+            sender.close()
+            jobs.append((process, receiver))
+
+        endpoints = []
+        for process, receiver in jobs:
+            if not receiver.poll(max(give_up - time.monotonic(), 0)):
+                logger.warning('Parallel discovery timed out after %.1fs',
+                               timeout)
+                return None
+            data = receiver.recv_bytes()
+            delivered += 1
+            with _gc_paused():
+                ok, result = marshal.loads(data)
+            if not ok:
+                logger.warning('Parallel discovery failed: %s', result)
+                return None
+            endpoints.extend(result)
+        return endpoints
+    except (OSError, EOFError) as e:
+        logger.warning('Parallel discovery failed: %s', e)
+        return None
+    finally:
+        # Workers that sent their slice are exiting; the others are stuck
+        # or failed and are not waited for.
+        for i, (process, receiver) in enumerate(jobs):
+            receiver.close()
+            if i < delivered:
+                process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
+
+
+def build_endpoints(ha, states):
+    def entity_domain(x):
+        return x['entity_id'].split('.', 1)[0]
 
     def mk_appliance(x):
         features = 0
@@ -653,7 +2568,7 @@ def discover_appliances(ha):
         entity = mk_entity(ha, x['entity_id'], features)
         o = {}
         # this needs to be unique and has limitations on allowed characters ("^[a-zA-Z0-9_\\-=#;:?@&]*$"):
-        o['endpointId'] = x['entity_id'].replace('.', ':')
+        o['endpointId'] = ha.endpoint_id(x['entity_id'])
         o['manufacturerName'] = 'Unknown'
         if 'haaska_name' in x['attributes']:
             o['friendlyName'] = x['attributes']['haaska_name']
@@ -675,9 +2590,9 @@ def discover_appliances(ha):
  
         return o
 
-    states = ha.get('states')
-    return [mk_appliance(x) for x in states if is_supported_entity(x) and
-            is_exposed_entity(x)]
+    is_exposed_entity = EntityFilter(ha.config)
+    with _gc_paused():
+        return [mk_appliance(x) for x in states if is_exposed_entity(x)]
 
 def supported_features(payload):
     try:
@@ -701,8 +2616,28 @@ def get_temp_scale(unit):
     else:
         return 'FAHRENHEIT'
 
-def get_utc_timestamp():
-    return datetime.datetime.strftime(datetime.datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%f")[:-4] + "Z"
+
+_timestamp_prefix = (None, None)
+
+
+def get_utc_timestamp(now=None):
+    # ISO 8601 to the hundredth of a second. The part up to the seconds is
+    # formatted once per second rather than through strftime every time.
+    # Microseconds are rounded like datetime.utcfromtimestamp before being
+    # truncated, so the result is what strftime('%f')[:-4] gave.
+    global _timestamp_prefix
+    if now is None:
+        now = time.time()
+    seconds = int(now)
+    micros = round((now - seconds) * 1000000)
+    if micros >= 1000000:
+        seconds += 1
+        micros -= 1000000
+    second, prefix = _timestamp_prefix
+    if second != seconds:
+        prefix = '%04d-%02d-%02dT%02d:%02d:%02d.' % time.gmtime(seconds)[:6]
+        _timestamp_prefix = (seconds, prefix)
+    return '%s%02dZ' % (prefix, micros // 10000)
 
 def get_uuid():
     return str(uuid.uuid4())
@@ -714,6 +2649,7 @@ def check_value(value, minValue=None, maxValue=None):
         return minValue
     elif value >= maxValue:
         return maxValue
+    return value
 
 def mk_entity(ha, entity_id, supported_features=0):
     entity_domain = entity_id.split('.', 1)[0]
@@ -730,7 +2666,10 @@ class Entity(object):
 
     def _call_service(self, service, data={}):
         data['entity_id'] = self.entity_id
-        self.ha.post('services/' + service, data)
+        with self.ha.tracer.span('call_service',
+                                 **{'haaska.service': service,
+                                    'haaska.entity_id': self.entity_id}):
+            self.ha.post('services/' + service, data)
 
     def get_model_name(self):
         return None
@@ -960,6 +2899,9 @@ class GarageDoorEntity(ToggleEntity):
     def turn_off(self):
         self._call_service('garage_door/close')
 
+    def expected_states(self, action):
+        return {'TurnOn': ['open'], 'TurnOff': ['closed']}.get(action)
+
 
 class CoverEntity(ToggleEntity):
     def turn_on(self):
@@ -968,6 +2910,9 @@ class CoverEntity(ToggleEntity):
     def turn_off(self):
         self._call_service('cover/close_cover')
 
+    def expected_states(self, action):
+        return {'TurnOn': ['open'], 'TurnOff': ['closed']}.get(action)
+
 
 class LockEntity(Entity):
     def set_lock_state(self, state):
@@ -980,6 +2925,9 @@ class LockEntity(Entity):
         state = self.ha.get('states/' + self.entity_id)
         return state['state']
 
+    def expected_states(self, action):
+        return {'Lock': ['locked'], 'Unlock': ['unlocked']}.get(action)
+
 
 class ScriptEntity(ToggleEntity):
     def turn_off(self):
@@ -1036,6 +2984,15 @@ class MediaPlayerEntity(ToggleEntity):
         vol = val / 100.0
         self._call_service('media_player/volume_set', {'volume_level': vol})
 
+    def get_mute(self):
+        state = self.ha.get('states/' + self.entity_id)
+        return state['attributes'].get('is_volume_muted', False)
+
+    def set_mute(self, mute):
+        self._call_service('media_player/volume_mute',
+                           {'is_volume_muted': mute})
+        return mute
+
 
 class ClimateEntity(Entity):
     def turn_on(self):
@@ -1055,6 +3012,10 @@ class ClimateEntity(Entity):
     def turn_off(self):
         self._call_service('climate/set_operation_mode',
                            {'operation_mode': 'off'})
+
+    def expected_states(self, action):
+        return {'TurnOn': ['auto', 'cool', 'heat'],
+                'TurnOff': ['off']}.get(action)
                            
     def aux_heat_on(self):
         self._call_service('climate/set_aux_heat',
@@ -1134,6 +3095,14 @@ DOMAINS = {
 }
 
 
+DERIVED_EXCLUDED_KEYS = ('tenants', 'tenants_dir', 'max_tenants',
+                         'backends')
+# Never inherited by a derived configuration, so a home or backend that
+# only sets its url can't be sent another home's credentials.
+CREDENTIAL_KEYS = ('password', 'ha_passwd', 'lwa_refresh_token',
+                   'event_gateway_token')
+
+
 class Configuration(object):
     def __init__(self, filename=None, optsDict=None):
         self._json = {}
@@ -1160,7 +3129,115 @@ class Configuration(object):
 
         opts['expose_by_default'] = self.get(['expose_by_default'],
                                              default=True)
+        opts['entity_overrides'] = self.get(['entity_overrides'], default={})
+        opts['include_entities'] = self.get(['include_entities'], default=[])
+        opts['exclude_entities'] = self.get(['exclude_entities'], default=[])
+        opts['include_attributes'] = self.get(['include_attributes'],
+                                              default={})
+        opts['exclude_attributes'] = self.get(['exclude_attributes'],
+                                              default={})
+        opts['backends'] = self.get(['backends'], default={})
+        opts['discovery_workers'] = self.get(['discovery_workers'],
+                                             default=0)
+        opts['discovery_parallel_min'] = self.get(
+            ['discovery_parallel_min'], default=20000)
+        opts['discovery_timeout'] = self.get(['discovery_timeout'],
+                                             default=6.0)
+        opts['tenants'] = self.get(['tenants'], default={})
+        opts['tenants_dir'] = self.get(['tenants_dir'], default=None)
+        opts['max_tenants'] = self.get(['max_tenants'], default=64)
         opts['debug'] = self.get(['debug'], default=False)
+        opts['metrics'] = self.get(['metrics'], default=False)
+        opts['metrics_namespace'] = self.get(['metrics_namespace'],
+                                             default='haaska')
+        opts['tracing'] = self.get(['tracing'], default=False)
+        opts['tracing_file'] = self.get(['tracing_file'],
+                                        default='/tmp/haaska-traces.jsonl')
+        opts['tracing_max_bytes'] = self.get(['tracing_max_bytes'],
+                                             default=10 * 1024 * 1024)
+        opts['tracing_backups'] = self.get(['tracing_backups'], default=2)
+        opts['profile_every'] = self.get(['profile_every'], default=0)
+        opts['profile_filter'] = self.get(['profile_filter'], default=[])
+        opts['profile_dir'] = self.get(['profile_dir'], default='/tmp')
+        opts['profile_top'] = self.get(['profile_top'], default=25)
+        opts['profile_keep'] = self.get(['profile_keep'], default=10)
+        opts['memory_every'] = self.get(['memory_every'], default=0)
+        opts['memory_filter'] = self.get(['memory_filter'], default=[])
+        opts['memory_top'] = self.get(['memory_top'], default=10)
+        opts['memory_frames'] = self.get(['memory_frames'], default=1)
+        opts['capture_every'] = self.get(['capture_every'], default=0)
+        opts['capture_filter'] = self.get(['capture_filter'], default=[])
+        opts['capture_file'] = self.get(['capture_file'],
+                                        default='/tmp/haaska-capture.jsonl')
+        opts['capture_max_bytes'] = self.get(['capture_max_bytes'],
+                                             default=10 * 1024 * 1024)
+        opts['capture_backups'] = self.get(['capture_backups'], default=2)
+        opts['validate_every'] = self.get(['validate_every'], default=0)
+        opts['idempotency_ttl'] = self.get(['idempotency_ttl'], default=30)
+        opts['idempotency_table'] = self.get(['idempotency_table'],
+                                             default=None)
+        opts['idempotency_size'] = self.get(['idempotency_size'],
+                                            default=256)
+        opts['connect_timeout'] = self.get(['connect_timeout'], default=3.05)
+        opts['deadline_ms'] = self.get(['deadline_ms'], default=0)
+        opts['deadline_reserve_ms'] = self.get(['deadline_reserve_ms'],
+                                               default=250)
+        opts['min_request_ms'] = self.get(['min_request_ms'], default=50)
+        opts['get_retries'] = self.get(['get_retries'], default=2)
+        opts['retry_backoff'] = self.get(['retry_backoff'], default=0.05)
+        opts['hedge_requests'] = self.get(['hedge_requests'], default=True)
+        opts['min_read_timeout'] = self.get(['min_read_timeout'],
+                                            default=0.5)
+        opts['breaker_threshold'] = self.get(['breaker_threshold'], default=3)
+        opts['breaker_reset_timeout'] = self.get(['breaker_reset_timeout'],
+                                                 default=30)
+        opts['compression'] = self.get(['compression'], default=True)
+        opts['websocket'] = self.get(['websocket'], default=False)
+        opts['discovery_updates'] = self.get(['discovery_updates'],
+                                             default=False)
+        opts['cache_dir'] = self.get(['cache_dir'], default='/tmp/haaska')
+        opts['cache_max_bytes'] = self.get(['cache_max_bytes'],
+                                           default=16 * 1024 * 1024)
+        opts['discovery_cache_ttl'] = self.get(['discovery_cache_ttl'],
+                                               default=0)
+        opts['discovery_snapshot'] = self.get(['discovery_snapshot'],
+                                              default='discovery.json')
+        opts['snapshot_max_age'] = self.get(['snapshot_max_age'],
+                                            default=7 * 24 * 3600)
+        opts['max_concurrent_requests'] = self.get(
+            ['max_concurrent_requests'], default=0)
+        opts['max_requests_per_second'] = self.get(
+            ['max_requests_per_second'], default=0)
+        opts['request_burst'] = self.get(['request_burst'], default=10)
+        opts['domain_limits'] = self.get(['domain_limits'], default={})
+        opts['admission_table'] = self.get(['admission_table'],
+                                           default=None)
+        opts['shared_requests_per_second'] = self.get(
+            ['shared_requests_per_second'], default=0)
+        opts['admission_wait'] = self.get(
+            ['admission_wait'],
+            default={'control': 2.0, 'state': 0.5, 'discovery': 5.0})
+        opts['deferred_responses'] = self.get(['deferred_responses'],
+                                              default=False)
+        opts['deferred_mode'] = self.get(['deferred_mode'], default='lambda')
+        opts['deferred_estimate'] = self.get(['deferred_estimate'], default=7)
+        opts['deferred_timeout'] = self.get(['deferred_timeout'], default=60)
+        opts['deferred_poll_interval'] = self.get(['deferred_poll_interval'],
+                                                  default=0.5)
+        opts['event_gateway_url'] = self.get(
+            ['event_gateway_url'],
+            default='https://api.amazonalexa.com/v3/events')
+        opts['event_gateway_token'] = self.get(['event_gateway_token'],
+                                               default=None)
+        opts['lwa_token_url'] = self.get(
+            ['lwa_token_url'], default='https://api.amazon.com/auth/o2/token')
+        opts['lwa_profile_url'] = self.get(
+            ['lwa_profile_url'], default='https://api.amazon.com/user/profile')
+        opts['lwa_client_id'] = self.get(['lwa_client_id'], default=None)
+        opts['lwa_client_secret'] = self.get(['lwa_client_secret'],
+                                             default=None)
+        opts['lwa_refresh_token'] = self.get(['lwa_refresh_token'],
+                                             default=None)
         self.opts = opts
 
     def __getattr__(self, name):
@@ -1175,16 +3252,326 @@ class Configuration(object):
     def dump(self):
         return json.dumps(self.opts, indent=2, separators=(',', ': '))
 
+    def derive(self, overrides):
+        # A configuration for another Home Assistant instance: this one's
+        # settings with the given overrides, minus the per-home sections and
+        # credentials.
+        opts = {k: v for k, v in self._json.items()
+                if k not in DERIVED_EXCLUDED_KEYS and
+                k not in CREDENTIAL_KEYS}
+        opts.update(overrides)
+        return Configuration(optsDict=opts)
+
+
+_configs = {}
+
+
+def load_config(filename):
+    # config.json ships with the function and doesn't change while a
+    # container is warm; parse it once rather than on every invocation.
+    mtime = os.stat(filename).st_mtime
+    cached = _configs.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Configuration(filename))
+        _configs[filename] = cached
+    return cached[1]
+
+
+class UnknownTenant(Exception):
+    pass
+
+
+class TenantLookupFailed(Exception):
+    pass
+
+
+def directive_token(directive):
+    # Control and state directives carry the token on the endpoint,
+    # Discover on the payload and AcceptGrant on the grantee.
+    payload = directive.get('payload') or {}
+    for holder in (directive.get('endpoint') or {}, payload,
+                   payload.get('grantee') or {}):
+        scope = holder.get('scope', holder)
+        if scope.get('token'):
+            return scope['token']
+    return None
+
+
+_tenant_configs = LRUCache(64)
+_identities = LRUCache(1024)
+
+# Login with Amazon access tokens are valid for an hour
+IDENTITY_TTL = 3600
+TENANT_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+def token_identity(config, token):
+    # Account linking access tokens are refreshed every hour or so, so homes
+    # are told apart by the Amazon user a token belongs to, looked up once
+    # per token through the Login with Amazon profile API.
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    cached = _identities.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    try:
+        r = requests.get(config.lwa_profile_url,
+                         timeout=(config.connect_timeout, 5),
+                         headers={'Authorization': 'Bearer ' + token})
+    except requests.exceptions.RequestException as e:
+        raise TenantLookupFailed('profile lookup failed: %s' % e)
+    if r.status_code in (400, 401, 403):
+        raise UnknownTenant('token rejected by Login with Amazon')
+    if r.status_code >= 300:
+        raise TenantLookupFailed('profile lookup failed with HTTP %d' %
+                                 r.status_code)
+    user_id = r.json().get('user_id')
+    if not user_id or not TENANT_ID.match(user_id):
+        raise UnknownTenant('profile has no usable user_id')
+    _identities.put(key, (user_id, time.monotonic() + IDENTITY_TTL))
+    return user_id
+
+
+def tenant_config(config, directive):
+    # Without tenants configured, config.json describes the only home.
+    # Otherwise the Amazon user id behind the directive's bearer token
+    # selects a set of overrides, from the tenants map or a <user id>.json
+    # file in tenants_dir, which is layered over config.json.
+    if not (config.tenants or config.tenants_dir):
+        return config
+    token = directive_token(directive)
+    if token is None:
+        raise UnknownTenant('directive carries no bearer token')
+    user_id = token_identity(config, token)
+    _tenant_configs.capacity = config.max_tenants
+    tenant = _tenant_configs.get(user_id)
+    if tenant is not None:
+        return tenant
+
+    overrides = config.tenants.get(user_id)
+    if overrides is None and config.tenants_dir:
+        filename = os.path.join(config.tenants_dir, user_id + '.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                overrides = json.load(f)
+    if overrides is None:
+        raise UnknownTenant('no tenant for user %s' % user_id)
+
+    tenant = config.derive(overrides)
+    _tenant_configs.put(user_id, tenant)
+    return tenant
+
+
+def error_response(directive, error_type, message):
+    header = directive.get('header', {})
+    r = {'event': {
+        'header': {'namespace': 'Alexa',
+                   'name': 'ErrorResponse',
+                   'payloadVersion': '3',
+                   'messageId': get_uuid(),
+                   'correlationToken': header.get('correlationToken')},
+        'payload': {'type': error_type, 'message': message}
+    }}
+    endpoint = directive.get('endpoint')
+    if endpoint and 'endpointId' in endpoint:
+        r['event']['endpoint'] = {'endpointId': endpoint['endpointId']}
+    return r
+
+
+_gateway_tokens = {}
+
+
+def gateway_token(config):
+    # Events sent to the Alexa event gateway are authorized with a Login
+    # with Amazon token for the skill, refreshed as it expires.
+    if config.event_gateway_token:
+        return config.event_gateway_token
+    # Each home links the skill with its own refresh token; the client id
+    # is the skill's and the same for all of them.
+    cached = _gateway_tokens.get(config.lwa_refresh_token)
+    if cached and cached[1] > time.time() + 60:
+        return cached[0]
+    r = requests.post(config.lwa_token_url, timeout=config.connect_timeout,
+                      data={'grant_type': 'refresh_token',
+                            'refresh_token': config.lwa_refresh_token,
+                            'client_id': config.lwa_client_id,
+                            'client_secret': config.lwa_client_secret})
+    r.raise_for_status()
+    token = r.json()
+    _gateway_tokens[config.lwa_refresh_token] = (
+        token['access_token'], time.time() + token.get('expires_in', 3600))
+    return token['access_token']
+
+
+def send_event(config, event):
+    token = gateway_token(config)
+    scope = {'type': 'BearerToken', 'token': token}
+    if 'endpoint' in event['event']:
+        event['event']['endpoint']['scope'] = scope
+    else:
+        event['event']['payload']['scope'] = scope
+    r = requests.post(config.event_gateway_url, data=json.dumps(event),
+                      timeout=(config.connect_timeout, 10),
+                      headers={'Authorization': 'Bearer ' + token,
+                               'Content-Type': 'application/json'})
+    r.raise_for_status()
+    return r
+
+
+def dispatch_deferred(config, context, job):
+    event = {'haaska': 'deferred', 'job': job}
+    if config.deferred_mode == 'thread':
+        # Only useful outside Lambda, which freezes the process once the
+        # handler returns.
+        threading.Thread(target=event_handler, args=(event, None)).start()
+        return
+    import boto3
+    boto3.client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event).encode('utf-8'))
+
+
+def complete_deferred(ha, job):
+    # Poll with exponential backoff until the entity reaches one of the
+    # expected states, then send the final response for the original
+    # directive, built from a real state report.
+    endpoint = job['endpoint']
+    backend, entity_id = parse_endpoint_id(endpoint['endpointId'])
+    # invoke() routes the endpoint to its backend itself, so it gets the
+    # root instance; only the polling talks to the backend directly.
+    polled = ha.for_backend(backend)
+    give_up = time.monotonic() + ha.config.deferred_timeout
+    remaining = ha.deadline.remaining()
+    if remaining is not None:
+        give_up = min(give_up, time.monotonic() + remaining)
+    interval = ha.config.deferred_poll_interval
+    state = None
+    while True:
+        try:
+            state = polled.get('states/' + entity_id)['state']
+        except Exception:
+            logger.exception('Polling %s for deferred %s failed', entity_id,
+                             job['action'])
+        if state in job['states']:
+            break
+        if time.monotonic() + interval >= give_up:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, 5.0)
+
+    if state in job['states']:
+        response = invoke('Alexa', 'ReportState', ha, {}, endpoint,
+                          job['correlationToken'])
+        if response['event']['header']['name'] == 'StateReport':
+            response['event']['header']['name'] = 'Response'
+    else:
+        logger.warning('%s did not reach %s after %s (state %s)', entity_id,
+                       job['states'], job['action'], state)
+        response = error_response(
+            {'header': {'correlationToken': job['correlationToken']},
+             'endpoint': endpoint},
+            'ENDPOINT_UNREACHABLE',
+            '%s did not complete, state is %s' % (job['action'], state))
+    response['event']['header']['messageId'] = get_uuid()
+    response['event']['endpoint'] = {'endpointId': endpoint['endpointId']}
+    send_event(ha.config, response)
+    return response
+
+
+def warm_up(config, metrics, tracer, deadline):
+    # Scheduled keep-warm events get everything a directive would otherwise
+    # set up on first use out of the way: modules that are imported lazily,
+    # compiled validators, a connection to each Home Assistant instance
+    # with its latency model seeded by a states fetch, and fresh discovery
+    # results.
+    ha = HomeAssistant(config, metrics, tracer, deadline, priority=DISCOVERY)
+
+    def prime(backend):
+        states = backend.get('states')
+        if backend.config.websocket:
+            backend.service_calls.connect(backend.config.connect_timeout)
+        return discover_backend(backend, states)
+
+    futures = [(b, get_executor().submit(prime, b)) for b in ha.backends()]
+
+    load_snapshot(config)
+    if config.profile_every:
+        import cProfile  # noqa: F401
+        import pstats  # noqa: F401
+    if config.memory_every:
+        import tracemalloc  # noqa: F401
+    deferred_lambda = (config.deferred_responses and
+                       config.deferred_mode == 'lambda')
+    if config.idempotency_table or config.admission_table or deferred_lambda:
+        import boto3  # noqa: F401
+    if config.validate_every:
+        get_validator('Alexa.Discovery', 'Discover', 'Discover.Response')
+        get_validator('Alexa', 'ReportState', 'StateReport')
+        get_validator('Alexa', 'ReportState', 'ErrorResponse')
+
+    timeout = config.discovery_timeout
+    remaining = deadline.remaining()
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    concurrent.futures.wait([f for _, f in futures], timeout=timeout)
+    primed = []
+    endpoints = []
+    missing = set()
+    for backend, future in futures:
+        name = backend.name or 'default'
+        if not future.done():
+            logger.warning('Warming up backend %s timed out', name)
+            missing.add(backend.name)
+        elif future.exception() is not None:
+            logger.warning('Warming up backend %s failed: %s', name,
+                           future.exception())
+            missing.add(backend.name)
+        else:
+            primed.append(name)
+            endpoints.extend(future.result())
+
+    # Scheduled events double as the trigger for refreshing discovery
+    if primed:
+        reconcile_discovery(ha, endpoints, missing)
+    return {'warm': True, 'backends': primed}
+
+
 def event_handler(request, context):
     #Main Lambda handler.
     #Only expects v3 requests (as we are only user) so no neeed to handle v2 requests
+    metrics = NullMetrics()
+    tracer = NullTracer()
+    start = time.perf_counter()
     try:
-        config = Configuration('config.json')
+        config = load_config('config.json')
         if config.debug:
             logger.setLevel(logging.DEBUG)
-        
-        ha = HomeAssistant(config)
-        
+        if config.metrics:
+            metrics = Metrics(config.metrics_namespace)
+            metrics.add_time('config',
+                             (time.perf_counter() - start) * 1000.0)
+        if config.tracing:
+            tracer = Tracer(OTLPFileExporter(rotating_writer(
+                config.tracing_file, config.tracing_max_bytes,
+                config.tracing_backups)))
+
+        if request.get('haaska') == 'warmup' or \
+                request.get('detail-type') == 'Scheduled Event':
+            deadline = Deadline.from_context(context, config)
+            metrics.set_dimensions(namespace='haaska', name='WarmUp')
+            return warm_up(config, metrics, tracer, deadline)
+
+        if request.get('haaska') == 'deferred':
+            # Internal event dispatched by an earlier invocation that
+            # answered with a DeferredResponse.
+            job = request['job']
+            ha_config = tenant_config(config, job)
+            deadline = Deadline.from_context(context, config)
+            ha = HomeAssistant(ha_config, metrics, tracer, deadline,
+                               priority=STATE)
+            metrics.set_dimensions(namespace='Alexa', name='Deferred')
+            return complete_deferred(ha, job)
+
         logger.debug('Directive:')
         logger.debug(json.dumps(request, indent=4, sort_keys=True))
         
@@ -1197,21 +3584,114 @@ def event_handler(request, context):
         
         payload = directive.get('payload')
         endpoint = directive.get('endpoint')
+        metrics.set_dimensions(namespace=namespace, name=name)
+
+        try:
+            ha_config = tenant_config(config, directive)
+        except UnknownTenant as e:
+            logger.error('Rejecting %s.%s: %s', namespace, name, e)
+            return error_response(directive,
+                                  'INVALID_AUTHORIZATION_CREDENTIAL', str(e))
+        except TenantLookupFailed as e:
+            logger.error('Unable to identify home for %s.%s: %s', namespace,
+                         name, e)
+            return error_response(directive, 'INTERNAL_ERROR', str(e))
+
+        deadline = Deadline.from_context(context, config)
+        _backends.capacity = config.max_tenants
+        _cached.capacity = 2 * config.max_tenants
+        with metrics.timer('session'):
+            ha = HomeAssistant(ha_config, metrics, tracer, deadline,
+                               priority=directive_priority(namespace, name))
         
         logger.debug('calling request_handler for %s, payload: %s', name,
                  str({k: v for k, v in payload.items()
                     if k != u'accessToken'}))
         
-        response = invoke(namespace, name, ha, payload, endpoint, correlationToken)
+        entry = None
+        claimed = False
+        if config.idempotency_ttl > 0:
+            cache_key = (header.get('messageId'), correlationToken,
+                         directive_token(directive))
+            _responses.capacity = config.idempotency_size
+            cached, entry = _responses.begin(cache_key, deadline.remaining())
+            if entry is not None and config.idempotency_table:
+                try:
+                    cached, claimed = shared_responses(config).begin(
+                        header.get('messageId'), cache_key,
+                        config.idempotency_ttl, deadline.remaining())
+                except Exception:
+                    logger.exception('Claiming %s failed',
+                                     header.get('messageId'))
+                    claimed = False
+                if cached is not None:
+                    _responses.finish(entry, cache_key, cached,
+                                      config.idempotency_ttl)
+            if cached is not None:
+                logger.info('Answering repeated %s.%s %s from cache',
+                            namespace, name, header.get('messageId'))
+                metrics.incr('idempotent_hits')
+                return cached
+
+        capturing = capture_for(config, namespace, name)
+        if capturing:
+            ha.calls = []
+        response = None
+        invoked = time.perf_counter()
+        try:
+            memory = memory_tracer_for(config, namespace, name, metrics)
+            with profiler_for(config, namespace, name, memory), memory, \
+                    metrics.timer('invoke'):
+                response = invoke(namespace, name, ha, payload, endpoint,
+                                  correlationToken)
+        finally:
+            if entry is not None:
+                _responses.finish(entry, cache_key, response,
+                                  config.idempotency_ttl)
+            if claimed:
+                try:
+                    shared_responses(config).finish(
+                        header.get('messageId'), cache_key, response,
+                        config.idempotency_ttl)
+                except Exception:
+                    logger.exception('Recording %s failed',
+                                     header.get('messageId'))
+            if capturing:
+                capture_writer(config).write(capture_record(
+                    request, ha.calls, response,
+                    time.perf_counter() - invoked))
         
+        for job in ha.deferred:
+            try:
+                dispatch_deferred(config, context, job)
+            except Exception:
+                logger.exception('Dispatching deferred %s failed',
+                                 job['action'])
+
         logger.debug("Response:")
         logger.debug(json.dumps(response, indent=4, sort_keys=True))
         
-        logger.debug("Validate response")
-        #validate_message(request, response)
+        if sampled(config.validate_every):
+            logger.debug("Validate response")
+            try:
+                with metrics.timer('validate'):
+                    validate_message(request, response)
+            except ValidationError as e:
+                logger.error('Invalid %s.%s response: %s', namespace, name, e)
+                metrics.incr('validation_errors')
+            except Exception:
+                # Validation is diagnostic only and must never cost the
+                # response, whatever the validator trips over.
+                logger.exception('Validating %s.%s response failed',
+                                 namespace, name)
+                metrics.incr('validation_errors')
         
         return response
         
     except ValueError as error:
         logger.error(error)
         raise
+    finally:
+        metrics.add_time('total', (time.perf_counter() - start) * 1000.0)
+        metrics.emit()
+        tracer.flush()
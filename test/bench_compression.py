@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Benchmark for fetching /api/states with and without compression, over a
+# link of the given bandwidth (0 for unthrottled).
+# $ python bench_compression.py [entity count] [Mbit/s]
+
+import os
+import sys
+import gzip
+import json
+import time
+import zlib
+import random
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+sys.path.insert(0, '..')
+import haaska  # noqa: E402
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DOMAINS = ['light', 'switch', 'sensor', 'binary_sensor', 'media_player',
+           'climate', 'cover', 'lock', 'automation', 'script', 'group']
+ROOMS = ['kitchen', 'living_room', 'bedroom', 'garage', 'office', 'porch']
+
+
+def make_states(count, seed=1):
+    # Roughly the shape and size of real states, context and all.
+    rnd = random.Random(seed)
+    states = []
+    for i in range(count):
+        domain = rnd.choice(DOMAINS)
+        room = rnd.choice(ROOMS)
+        changed = '2026-10-%02dT%02d:%02d:%02d.%06d+00:00' % (
+            rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59),
+            rnd.randint(0, 59), rnd.randint(0, 999999))
+        states.append({
+            'entity_id': '%s.%s_%d' % (domain, room, i),
+            'state': rnd.choice(['on', 'off', 'unavailable', '21.5']),
+            'attributes': {'friendly_name': '%s %s %d' % (
+                               room.replace('_', ' ').title(), domain, i),
+                           'supported_features': rnd.randint(0, 255),
+                           'brightness': rnd.randint(0, 255),
+                           'icon': 'mdi:%s' % domain},
+            'last_changed': changed,
+            'last_updated': changed,
+            'context': {'id': '%032x' % rnd.getrandbits(128),
+                        'parent_id': None, 'user_id': None}})
+    return states
+
+
+ENCODERS = [('identity', lambda body: body),
+            ('gzip', lambda body: gzip.compress(body, 6)),
+            ('deflate', lambda body: zlib.compress(body, 6))]
+if brotli is not None:
+    ENCODERS.append(('br', lambda body: brotli.compress(body, quality=4)))
+
+
+def serve(bodies, mbps):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            encoding = self.headers.get('Accept-Encoding', 'identity')
+            encoding = encoding.split(',')[0].strip()
+            body = bodies[encoding]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+            self.end_headers()
+            chunk = 64 * 1024
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i:i + chunk])
+                if mbps:
+                    time.sleep(min(chunk, len(body) - i) * 8 / (mbps * 1e6))
+
+    class Server(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class ByteCounter(haaska.NullMetrics):
+    def __init__(self):
+        self.counts = {}
+
+    def incr(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    mbps = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+    body = json.dumps(make_states(count)).encode('utf-8')
+    bodies = {name: encode(body) for name, encode in ENCODERS}
+    server = serve(bodies, mbps)
+    url = 'http://127.0.0.1:%d/api' % server.server_port
+
+    print('%d entities, %s' % (count, '%g Mbit/s' % mbps if mbps
+                               else 'unthrottled'))
+    print('%-9s %10s %10s %7s %10s' % ('encoding', 'wire', 'decoded',
+                                       'ratio', 'GET states'))
+    for name, _ in ENCODERS:
+        config = haaska.Configuration(optsDict={'url': url,
+                                                'hedge_requests': False})
+        metrics = ByteCounter()
+        ha = haaska.HomeAssistant(config, metrics)
+        ha.session.headers['Accept-Encoding'] = name
+        best = None
+        for _ in range(3):
+            metrics.counts = {}
+            start = time.perf_counter()
+            states = ha.get('states')
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert len(states) == count
+        wire = metrics.counts['ha_rx_wire_bytes']
+        decoded = metrics.counts['ha_rx_bytes']
+        print('%-9s %10d %10d %6.1fx %7.1f ms' % (
+            name, wire, decoded, decoded / float(wire), best * 1000.0))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+    main()
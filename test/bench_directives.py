@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Microbenchmarks for the per-directive hot path: every directive handler
+# in haaska.Alexa end to end through invoke(), against an in-process fake
+# Home Assistant, plus the helpers each of them calls.
+# $ python bench_directives.py [--output results.json] [filter]
+# $ python bench_directives.py --compare REV_A [REV_B]
+#
+# Comparison mode benchmarks each revision's haaska.py in fresh processes,
+# alternating between them for a few rounds, and flags cases whose median
+# and fastest run both got slower by more than --threshold, so a single
+# noisy repeat doesn't count as a regression.
+
+import os
+import sys
+import json
+import timeit
+import inspect
+import argparse
+import tempfile
+import importlib
+import statistics
+import subprocess
+
+haaska = None
+
+STATES = {
+    'light.kitchen': {'brightness': 128, 'color_temp': 300,
+                      'supported_features': 147},
+    'switch.porch': {},
+    'fan.bedroom': {'speed': 'medium', 'speed_list': ['low', 'medium',
+                                                      'high']},
+    'cover.garage': {'current_position': 40},
+    'lock.front_door': {},
+    'input_number.volume': {'min': 0, 'max': 100, 'step': 1},
+    'climate.hallway': {'unit_of_measurement': u'°C', 'temperature': 21,
+                        'current_temperature': 20.5, 'min_temp': 7,
+                        'max_temp': 35, 'operation_mode': 'heat',
+                        'operation_list': ['heat', 'cool', 'auto', 'off']},
+    'media_player.tv': {'volume_level': 0.4, 'is_volume_muted': False,
+                        'supported_features': 21437},
+}
+
+# (namespace, name, entity, payload) for each directive handler
+CASES = [
+    ('Alexa', 'ReportState', 'light.kitchen', {}),
+    ('Alexa.Discovery', 'Discover', None,
+     {'scope': {'type': 'BearerToken', 'token': 'token'}}),
+    ('Alexa.PowerController', 'TurnOn', 'switch.porch', {}),
+    ('Alexa.PowerController', 'TurnOff', 'switch.porch', {}),
+    ('Alexa.BrightnessController', 'SetBrightness', 'light.kitchen',
+     {'brightness': 42}),
+    ('Alexa.BrightnessController', 'AdjustBrightness', 'light.kitchen',
+     {'brightnessDelta': -10}),
+    ('Alexa.PercentageController', 'SetPercentage', 'input_number.volume',
+     {'percentage': 70}),
+    ('Alexa.PercentageController', 'AdjustPercentage', 'input_number.volume',
+     {'percentageDelta': 10}),
+    ('Alexa.ColorTemperatureController', 'SetColorTemperature',
+     'light.kitchen', {'colorTemperatureInKelvin': 4000}),
+    ('Alexa.ColorTemperatureController', 'IncreaseColorTemperature',
+     'light.kitchen', {}),
+    ('Alexa.ColorTemperatureController', 'DecreaseColorTemperature',
+     'light.kitchen', {}),
+    ('Alexa.PowerLevelController', 'SetPowerLevel', 'fan.bedroom',
+     {'powerLevel': 50}),
+    ('Alexa.PowerLevelController', 'AdjustPowerLevel', 'fan.bedroom',
+     {'powerLevelDelta': 25}),
+    ('Alexa.ThermostatController', 'SetTargetTemperature',
+     'climate.hallway', {'targetSetpoint': {'value': 22.5,
+                                            'scale': 'CELSIUS'}}),
+    ('Alexa.ThermostatController', 'AdjustTargetTemperature',
+     'climate.hallway', {'targetSetpointDelta': {'value': -1.0,
+                                                 'scale': 'CELSIUS'}}),
+    ('Alexa.ThermostatController', 'SetThermostatMode', 'climate.hallway',
+     {'thermostatMode': {'value': 'HEAT'}}),
+    ('Alexa.TemperatureSensor', 'ReportState', 'climate.hallway', {}),
+    ('Alexa.LockController', 'Lock', 'lock.front_door', {}),
+    ('Alexa.LockController', 'Unlock', 'lock.front_door', {}),
+    ('Alexa.Speaker', 'SetVolume', 'media_player.tv',
+     {'volume': {'value': 30}}),
+    ('Alexa.Speaker', 'AdjustVolume', 'media_player.tv',
+     {'volume': {'value': 5}}),
+    ('Alexa.Speaker', 'SetMute', 'media_player.tv', {'mute': {'value': True}}),
+] + [('Alexa.PlaybackController', name, 'media_player.tv', {})
+     for name in ('FastForward', 'Next', 'Pause', 'Play', 'Previous',
+                  'Rewind', 'StartOver', 'Stop')] + [
+    ('Alexa.RemoteVideoPlayer', name, 'media_player.tv',
+     {'entities': [{'type': 'Video', 'value': 'Big Buck Bunny'}]})
+    for name in ('SearchAndPlay', 'SearchAndDisplayResults')]
+
+
+def make_fake(config):
+    class FakeHomeAssistant(haaska.HomeAssistant):
+        # Answers from STATES and swallows service calls, so what is timed
+        # is haaska's own work.
+        def get(self, relurl):
+            if relurl == 'states':
+                return [self.state(e) for e in STATES]
+            return self.state(relurl[len('states/'):])
+
+        def state(self, entity_id):
+            attributes = dict(STATES[entity_id])
+            attributes.setdefault('friendly_name', entity_id)
+            return {'entity_id': entity_id, 'state': 'on',
+                    'attributes': attributes}
+
+        def post(self, relurl, d, wait=False):
+            return None
+
+        def available(self):
+            return True
+
+    return FakeHomeAssistant(config)
+
+
+def handlers():
+    found = set()
+    for ns, cls in vars(haaska.Alexa).items():
+        if not inspect.isclass(cls):
+            continue
+        namespace = 'Alexa' if ns == 'ReportState' else 'Alexa.' + ns
+        for name, fn in vars(cls).items():
+            if callable(fn) and not name.startswith('_'):
+                found.add((namespace, name))
+    return found
+
+
+def directive_case(ha, namespace, name, entity_id, payload):
+    endpoint = None
+    if entity_id:
+        endpoint = {'endpointId': entity_id.replace('.', ':'),
+                    'scope': {'type': 'BearerToken', 'token': 'token'}}
+
+    def run():
+        return haaska.invoke(namespace, name, ha, payload, endpoint,
+                             'correlation')
+    return run
+
+
+def cases(ha):
+    yield 'get_utc_timestamp', haaska.get_utc_timestamp
+    yield 'get_uuid', haaska.get_uuid
+    yield 'check_value', lambda: haaska.check_value(42.0, 0.0, 100.0)
+    yield 'convert_temp', lambda: haaska.convert_temp(70.0, u'°F', u'°C')
+    yield 'mk_entity', lambda: haaska.mk_entity(ha, 'light.kitchen', 147)
+    yield 'ConnectedHomeCall', lambda: haaska.Alexa.PowerController(
+        'Alexa.PowerController', 'TurnOn', ha, {},
+        {'endpointId': 'switch:porch'}, 'correlation')
+    for namespace, name, entity_id, payload in CASES:
+        yield ('%s.%s' % (namespace, name),
+               directive_case(ha, namespace, name, entity_id, payload))
+
+
+def bench(fn, repeats, min_time, warmup):
+    # Enough calls per repeat to take min_time, after warmup seconds of
+    # calls to settle caches, and timeit's garbage collector pause.
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    timer.timeit(max(1, int(number * warmup / min_time)))
+    times = [t / number for t in timer.repeat(repeats, number)]
+    return {'median': statistics.median(times), 'min': min(times),
+            'stdev': statistics.stdev(times) if repeats > 1 else 0.0,
+            'number': number, 'repeats': repeats}
+
+
+def failed(result):
+    if not isinstance(result, dict) or 'event' not in result:
+        return False
+    return result['event']['header']['name'] not in (
+        'Response', 'StateReport', 'Discover.Response', 'DeferredResponse')
+
+
+def run(args):
+    global haaska
+    sys.path.insert(0, args.tree)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+    haaska = importlib.import_module('haaska')
+    haaska.logger.disabled = True
+
+    config = haaska.Configuration(optsDict={'cache_dir': '',
+                                            'discovery_snapshot': ''})
+    ha = make_fake(config)
+    covered = set((c[0], c[1]) for c in CASES)
+    for namespace, name in sorted(handlers() - covered):
+        print('warning: no case for %s.%s' % (namespace, name),
+              file=sys.stderr)
+
+    results = {}
+    for label, fn in cases(ha):
+        if args.filter and args.filter not in label:
+            continue
+        try:
+            result = fn()
+        except Exception as e:
+            # Cases the revision under test doesn't have
+            print('skipping %s: %r' % (label, e), file=sys.stderr)
+            continue
+        stats = bench(fn, args.repeats, args.min_time, args.warmup)
+        stats['error'] = failed(result)
+        results[label] = stats
+        if not args.quiet:
+            print('%-58s %9.2f us  +-%5.1f%%%s' % (
+                label, stats['median'] * 1e6,
+                100.0 * stats['stdev'] / stats['median'],
+                '  (error response)' if stats['error'] else ''))
+    return results
+
+
+def checkout(revision, directory):
+    root = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+                                   universal_newlines=True).strip()
+    archive = subprocess.Popen(['git', '-C', root, 'archive', revision],
+                               stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', directory],
+                          stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise SystemExit('cannot check out %s' % revision)
+
+
+def measure_revision(revision, args):
+    # Each revision runs in its own interpreter so they can't share state
+    with tempfile.TemporaryDirectory() as tree:
+        if revision is None:
+            tree = os.path.abspath(args.tree)
+        else:
+            checkout(revision, tree)
+        command = [sys.executable, os.path.abspath(__file__), '--quiet',
+                   '--tree', tree, '--output', '-',
+                   '--repeats', str(args.repeats),
+                   '--min-time', str(args.min_time),
+                   '--warmup', str(args.warmup)]
+        if args.filter:
+            command.append(args.filter)
+        print('benchmarking %s' % (revision or 'working tree'),
+              file=sys.stderr)
+        return json.loads(subprocess.check_output(command, cwd=tree))
+
+
+def best(results, more):
+    for label, stats in more.items():
+        if label not in results or stats['median'] < results[label]['median']:
+            results[label] = stats
+
+
+def compare(args):
+    # Alternate between the revisions and keep each case's best round, so a
+    # slow patch on a shared machine doesn't land on one side only.
+    revisions = [args.compare[0],
+                 args.compare[1] if len(args.compare) > 1 else None]
+    before, after = {}, {}
+    for _ in range(args.rounds):
+        best(before, measure_revision(revisions[0], args))
+        best(after, measure_revision(revisions[1], args))
+    regressions = 0
+    print('%-58s %10s %10s %8s' % ('', 'before', 'after', 'change'))
+    for label in sorted(set(before) & set(after)):
+        a, b = before[label], after[label]
+        change = b['median'] / a['median'] - 1.0
+        regressed = (change > args.threshold and
+                     b['min'] / a['min'] - 1.0 > args.threshold)
+        regressions += regressed
+        print('%-58s %8.2fus %8.2fus %+7.1f%%%s' % (
+            label, a['median'] * 1e6, b['median'] * 1e6, change * 100.0,
+            '  REGRESSION' if regressed else ''))
+    for label in sorted(set(before) ^ set(after)):
+        print('%-58s only %s' % (label, 'before' if label in before
+                                 else 'after'))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filter', nargs='?',
+                        help='only cases whose name contains this')
+    parser.add_argument('--tree', default='..',
+                        help='directory containing the haaska.py to test')
+    parser.add_argument('--output', help='write results as JSON, - for '
+                        'standard output')
+    parser.add_argument('--compare', nargs='+', metavar='REV',
+                        help='compare two revisions, or one against the '
+                        'working tree')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='times each revision is benchmarked')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown flagged as a regression')
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='seconds per repeat')
+    parser.add_argument('--warmup', type=float, default=0.05,
+                        help='seconds of calls before timing')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args))
+    results = run(args)
+    if args.output == '-':
+        json.dump(results, sys.stdout)
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Benchmark for the discovery entity filter over a large synthetic install.
+# $ python bench_filter.py [entity count]
+
+import os
+import sys
+import re
+import random
+import fnmatch
+import timeit
+sys.path.insert(0, '..')
+import haaska  # noqa: E402
+
+DOMAINS = ['light', 'switch', 'sensor', 'binary_sensor', 'media_player',
+           'climate', 'cover', 'lock', 'automation', 'script', 'group']
+ROOMS = ['kitchen', 'living_room', 'bedroom', 'garage', 'office', 'porch']
+
+
+def make_states(count, seed=1):
+    rnd = random.Random(seed)
+    states = []
+    for i in range(count):
+        domain = rnd.choice(DOMAINS)
+        room = rnd.choice(ROOMS)
+        attributes = {'friendly_name': '%s %s %d' % (room, domain, i),
+                      'area': room}
+        if rnd.random() < 0.05:
+            attributes['haaska_hidden'] = True
+        states.append({'entity_id': '%s.%s_%d' % (domain, room, i),
+                       'state': 'on', 'attributes': attributes})
+    return states
+
+
+CONFIG = {
+    'exposed_domains': ['light', 'switch', 'media_player', 'climate',
+                        'cover', 'lock', 'script', 'group'],
+    'expose_by_default': False,
+    'entity_overrides': {'light.porch_17': True, 'switch.garage_3': False},
+    'include_entities': (['light.*', 'switch.kitchen_*', 'climate.*',
+                          're:^media_player\\.(living_room|bedroom)_'] +
+                         ['cover.garage_%d' % i for i in range(200)]),
+    'exclude_entities': ['*_debug', 'light.garage_1?'],
+    'include_attributes': {'area': ['office']},
+    'exclude_attributes': {'area': 'porch'},
+}
+
+
+def naive_filter(config):
+    # Rules evaluated one by one against lists, as a straightforward
+    # implementation would.
+    def match(entity_id, patterns):
+        for p in patterns:
+            if p.startswith('re:'):
+                if re.match(p[3:], entity_id):
+                    return True
+            elif fnmatch.fnmatchcase(entity_id, p):
+                return True
+        return False
+
+    def attr_match(attributes, rules):
+        for attr, values in rules.items():
+            if not isinstance(values, list):
+                values = [values]
+            if attributes.get(attr) in values:
+                return True
+        return False
+
+    def predicate(x):
+        entity_id = x['entity_id']
+        if entity_id.split('.', 1)[0] not in config.exposed_domains:
+            return False
+        if entity_id in config.entity_overrides:
+            return config.entity_overrides[entity_id]
+        attr = x['attributes']
+        if match(entity_id, config.exclude_entities) or \
+                attr_match(attr, config.exclude_attributes):
+            return False
+        if 'haaska_hidden' in attr:
+            return not attr['haaska_hidden']
+        if match(entity_id, config.include_entities) or \
+                attr_match(attr, config.include_attributes):
+            return True
+        return config.expose_by_default
+    return predicate
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    states = make_states(count)
+    config = haaska.Configuration(optsDict=CONFIG)
+
+    compiled = haaska.EntityFilter(config)
+    naive = naive_filter(config)
+    assert [compiled(x) for x in states] == [naive(x) for x in states]
+
+    exposed = sum(1 for x in states if compiled(x))
+    print('%d entities, %d exposed' % (count, exposed))
+    for label, fn in (('compile', lambda: haaska.EntityFilter(config)),
+                      ('compiled', lambda: [x for x in states
+                                            if compiled(x)]),
+                      ('naive', lambda: [x for x in states if naive(x)])):
+        best = min(timeit.repeat(fn, number=1, repeat=5))
+        print('%-10s %9.3f ms' % (label, best * 1000.0))
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+    main()
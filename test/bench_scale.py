@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Discovery at increasing install sizes: time spent filtering, building
+# capabilities and in discovery as a whole, serially and spread over
+# --workers processes, peak memory and the size of the Discover response.
+# Each run appends one JSON record per scale to the output file so results
+# can be compared over time.
+# $ python bench_scale.py [--output bench_scale.jsonl] [--workers N]
+#                         [scale ...]
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import subprocess
+import tracemalloc
+sys.path.insert(0, '..')
+import haaska  # noqa: E402
+from synthetic_states import make_states  # noqa: E402
+
+SCALES = [1000, 10000, 50000]
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000.0
+
+
+def measure(count, config, repeat, workers):
+    states = make_states(count)
+    ha = haaska.HomeAssistant(config)
+    is_exposed = haaska.EntityFilter(config)
+    exposed = [x for x in states if is_exposed(x)]
+
+    def capabilities():
+        for x in exposed:
+            features = x['attributes'].get('supported_features', 0)
+            haaska.mk_entity(ha, x['entity_id'], features).get_capabilities()
+
+    def discover():
+        return haaska.build_endpoints(ha, states)
+
+    def discover_parallel():
+        return haaska.build_endpoints_parallel(ha, states, workers)
+
+    result = {
+        'entities': count,
+        'exposed': len(exposed),
+        'states_bytes': len(json.dumps(states)),
+        'filter_ms': best_of(lambda: [x for x in states if is_exposed(x)],
+                             repeat),
+        'capabilities_ms': best_of(capabilities, repeat),
+        'discovery_ms': best_of(discover, repeat),
+        'workers': workers,
+        'parallel_ms': best_of(discover_parallel, repeat),
+    }
+    assert discover_parallel() == discover()
+
+    tracemalloc.start()
+    endpoints = discover()
+    result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    response = {'event': {'header': {}, 'payload': {'endpoints': endpoints}}}
+    result['response_bytes'] = len(json.dumps(response))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scales', nargs='*', type=int, default=SCALES)
+    parser.add_argument('--output', default='bench_scale.jsonl',
+                        help='file to append results to, "-" for none')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int,
+                        default=len(os.sched_getaffinity(0)),
+                        help='processes for parallel discovery')
+    args = parser.parse_args()
+
+    config = haaska.Configuration(optsDict={})
+    run = {'benchmark': 'scale',
+           'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+           'revision': revision(),
+           'python': platform.python_version()}
+
+    print('%8s %8s %10s %10s %10s %10s %10s %10s %10s' % (
+        'entities', 'exposed', 'states', 'filter', 'capabs', 'discovery',
+        'parallel', 'peak mem', 'response'))
+    records = []
+    for count in args.scales:
+        result = measure(count, config, args.repeat, args.workers)
+        print('%8d %8d %9.1fM %8.1fms %8.1fms %8.1fms %8.1fms %9.1fM %9.1fM'
+              % (result['entities'], result['exposed'],
+                 result['states_bytes'] / 1e6, result['filter_ms'],
+                 result['capabilities_ms'], result['discovery_ms'],
+                 result['parallel_ms'], result['peak_bytes'] / 1e6,
+                 result['response_bytes'] / 1e6))
+        record = dict(run)
+        record.update(result)
+        records.append(record)
+
+    if args.output != '-':
+        with open(args.output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+    main()
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+# A minimal Home Assistant REST API for the unit tests: GETs are answered
+# from a dict of path -> (delay in seconds, JSON body), POSTs are recorded.
+
+import json
+import time
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class FakeHass(object):
+    def __init__(self, routes=None):
+        self.routes = dict(routes or {})
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                path = self.path[len('/api/'):]
+                fake.requests.append(('GET', path, None))
+                if path not in fake.routes:
+                    return self._send(404, {})
+                delay, body = fake.routes[path]
+                time.sleep(delay)
+                self._send(200, body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                fake.requests.append(('POST', self.path[len('/api/'):], body))
+                self._send(200, [])
+
+        class Server(socketserver.ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/api' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def count(self, method, path):
+        return sum(1 for m, p, _ in self.requests if m == method and p == path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+# A stand-in for the websocket-client module talking to Home Assistant's
+# WebSocket API: connections authenticate with the configured password and
+# call_service messages are answered with their service_data, straight away
+# or, with hold set, once the test calls answer().
+
+import json
+import queue
+import types
+
+
+class FakeWebSocket(object):
+    def __init__(self, server):
+        self.server = server
+        self.inbox = queue.Queue()
+        self.sent = []
+        self.closed = False
+        self.inbox.put(json.dumps({'type': 'auth_required'}))
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self):
+        msg = self.inbox.get()
+        if msg is None:
+            raise ConnectionResetError('connection closed')
+        return msg
+
+    def send(self, data):
+        msg = json.loads(data)
+        if self.closed:
+            raise BrokenPipeError('connection closed')
+        if msg['type'] == 'call_service' and self.server.failed_sends:
+            self.server.failed_sends -= 1
+            raise BrokenPipeError('send failed')
+        self.sent.append(msg)
+        if msg['type'] == 'auth':
+            ok = msg['api_password'] == self.server.password
+            self.inbox.put(json.dumps({
+                'type': 'auth_ok' if ok else 'auth_invalid',
+                'message': 'Invalid password'}))
+        elif msg['type'] == 'call_service':
+            self.server.calls.append((self, msg))
+            if not self.server.hold:
+                self.server.answer(msg['id'], conn=self)
+
+    def close(self):
+        self.closed = True
+        self.inbox.put(None)
+
+    def drop(self):
+        # The connection going away under the client
+        self.inbox.put(None)
+
+
+class FakeWebSocketServer(object):
+    def __init__(self, password=''):
+        self.password = password
+        self.connections = []
+        self.calls = []
+        self.hold = False
+        self.refuse = False
+        self.failed_sends = 0
+        self.module = types.SimpleNamespace(
+            create_connection=self.create_connection)
+
+    def create_connection(self, url, timeout, sslopt):
+        if self.refuse:
+            raise ConnectionRefusedError('refused')
+        conn = FakeWebSocket(self)
+        self.connections.append(conn)
+        return conn
+
+    def answer(self, msg_id, success=True, conn=None):
+        for c, msg in self.calls:
+            if msg['id'] == msg_id and (conn is None or c is conn):
+                break
+        else:
+            raise KeyError(msg_id)
+        reply = {'id': msg_id, 'type': 'result', 'success': success}
+        if success:
+            reply['result'] = msg['service_data']
+        else:
+            reply['error'] = {'code': 'not_found',
+                              'message': 'Service not found.'}
+        c.inbox.put(json.dumps(reply))
+
+    def services(self):
+        return [(msg['domain'], msg['service']) for _, msg in self.calls]
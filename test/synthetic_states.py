@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Generator for realistic Home Assistant /api/states payloads of any size.
+# Run directly to write a fixture, e.g. for make snapshot STATES=...
+# $ python synthetic_states.py [entity count] > states.json
+
+import sys
+import json
+import random
+
+# Relative frequency of each domain in a typical install; most entities
+# are sensors, which haaska never exposes but still has to filter out.
+DOMAIN_WEIGHTS = [
+    ('sensor', 30), ('binary_sensor', 12), ('light', 14), ('switch', 10),
+    ('automation', 6), ('media_player', 3), ('climate', 2), ('cover', 3),
+    ('lock', 1), ('fan', 1), ('script', 3), ('scene', 2), ('group', 3),
+    ('input_boolean', 3), ('input_number', 1), ('alert', 1),
+    ('device_tracker', 4), ('garage_door', 1)]
+
+ROOMS = ['kitchen', 'living_room', 'bedroom', 'guest_room', 'garage',
+         'office', 'porch', 'basement', 'attic', 'hallway', 'bathroom']
+
+# supported_features bits as Home Assistant sets them per domain
+FEATURES = {
+    'light': [1, 2, 8, 16, 32, 64, 128],
+    'media_player': [1, 2, 4, 8, 16, 32, 128, 256, 512, 1024, 2048, 4096],
+    'climate': [1, 2, 4, 8, 16, 64, 128],
+    'cover': [1, 2, 4, 8, 16, 32, 64, 128],
+    'fan': [1, 2, 4],
+}
+
+
+def features(rnd, domain):
+    bits = FEATURES.get(domain)
+    if not bits:
+        return None
+    mask = 0
+    for bit in bits:
+        if rnd.random() < 0.5:
+            mask |= bit
+    return mask
+
+
+def attributes(rnd, domain, room, i):
+    name = '%s %s %d' % (room.replace('_', ' ').title(),
+                         domain.replace('_', ' '), i)
+    attrs = {'friendly_name': name}
+    mask = features(rnd, domain)
+    if mask is not None:
+        attrs['supported_features'] = mask
+    if domain == 'light':
+        attrs.update(brightness=rnd.randint(0, 255), color_temp=370,
+                     min_mireds=153, max_mireds=500,
+                     rgb_color=[255, rnd.randint(0, 255), 0])
+    elif domain == 'media_player':
+        # Source and sound mode lists make these the largest states
+        attrs.update(volume_level=round(rnd.random(), 2),
+                     source_list=['Input %d' % n for n in range(30)],
+                     sound_mode_list=['Mode %d' % n for n in range(10)],
+                     media_title='Track %d' % rnd.randint(1, 999),
+                     entity_picture='/api/media_player_proxy/%s?token=%064x'
+                                    % (name, rnd.getrandbits(256)))
+    elif domain == 'climate':
+        attrs.update(unit_of_measurement=u'°C', temperature=21,
+                     current_temperature=20.5, min_temp=7, max_temp=35,
+                     operation_list=['heat', 'cool', 'auto', 'off'])
+    elif domain == 'sensor':
+        attrs.update(unit_of_measurement=rnd.choice(['W', 'kWh', '%',
+                                                     u'°C', 'lx']),
+                     device_class=rnd.choice(['power', 'energy', 'humidity',
+                                              'temperature']))
+        if rnd.random() < 0.05:
+            # Some integrations stuff whole forecasts into attributes
+            attrs['forecast'] = [{'datetime': '2026-10-%02dT00:00:00' % d,
+                                  'temperature': rnd.randint(0, 30),
+                                  'condition': 'cloudy'}
+                                 for d in range(1, 15)]
+    elif domain == 'group':
+        attrs['entity_id'] = ['light.%s_%d' % (room, n) for n in range(12)]
+    elif domain == 'input_number':
+        attrs.update(min=0, max=100, step=1)
+
+    # haaska's own attributes, as set through customize
+    if rnd.random() < 0.05:
+        attrs['haaska_hidden'] = rnd.random() < 0.5
+    if rnd.random() < 0.05:
+        attrs['haaska_name'] = 'Alexa %s' % name
+    if rnd.random() < 0.02:
+        attrs['haaska_desc'] = 'Custom description for %s' % name
+    return attrs
+
+
+def make_states(count, seed=1):
+    rnd = random.Random(seed)
+    domains = [d for d, _ in DOMAIN_WEIGHTS]
+    weights = [w for _, w in DOMAIN_WEIGHTS]
+    states = []
+    for i in range(count):
+        domain = rnd.choices(domains, weights)[0]
+        room = rnd.choice(ROOMS)
+        changed = '2026-10-%02dT%02d:%02d:%02d.%06d+00:00' % (
+            rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59),
+            rnd.randint(0, 59), rnd.randint(0, 999999))
+        states.append({
+            'entity_id': '%s.%s_%d' % (domain, room, i),
+            'state': rnd.choice(['on', 'off', 'unavailable', '21.5']),
+            'attributes': attributes(rnd, domain, room, i),
+            'last_changed': changed,
+            'last_updated': changed,
+            'context': {'id': '%032x' % rnd.getrandbits(128),
+                        'parent_id': None, 'user_id': None}})
+    return states
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    json.dump(make_states(count), sys.stdout)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for admission control toward Home Assistant.
+# $ cd test && python -m unittest test_admission
+
+import os
+import sys
+import time
+import threading
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+
+CONTROL, STATE, DISCOVERY = 0, 1, 2
+
+
+class LimiterTests(unittest.TestCase):
+    def test_unlimited(self):
+        limiter = haaska.Limiter()
+        for _ in range(100):
+            limiter.acquire(STATE, 0)
+
+    def test_concurrency(self):
+        limiter = haaska.Limiter(concurrency=2)
+        limiter.acquire(STATE, 0)
+        limiter.acquire(STATE, 0)
+        with self.assertRaises(haaska.Overloaded):
+            limiter.acquire(STATE, 0.01)
+        limiter.release()
+        limiter.acquire(STATE, 0)
+
+    def test_burst_then_rate(self):
+        limiter = haaska.Limiter(rate=20, burst=3)
+        for _ in range(3):
+            limiter.acquire(STATE, 0)
+        with self.assertRaises(haaska.Overloaded):
+            limiter.acquire(STATE, 0)
+        start = time.monotonic()
+        limiter.acquire(STATE, 1)
+        self.assertGreater(time.monotonic() - start, 0.02)
+
+    def test_priority_order(self):
+        limiter = haaska.Limiter(concurrency=1)
+        limiter.acquire(STATE, 0)
+        admitted = []
+
+        def wait(priority):
+            limiter.acquire(priority, 5)
+            admitted.append(priority)
+            limiter.release()
+
+        threads = []
+        for priority in (DISCOVERY, STATE, CONTROL):
+            threads.append(threading.Thread(target=wait, args=(priority,)))
+            threads[-1].start()
+            time.sleep(0.05)
+        limiter.release()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(admitted, [CONTROL, STATE, DISCOVERY])
+
+    def test_timed_out_waiter_leaves_the_queue(self):
+        limiter = haaska.Limiter(concurrency=1)
+        limiter.acquire(STATE, 0)
+        with self.assertRaises(haaska.Overloaded):
+            limiter.acquire(CONTROL, 0.01)
+        self.assertEqual(limiter.waiting, [])
+        limiter.release()
+        limiter.acquire(DISCOVERY, 0)
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+class FakeDynamoDB(object):
+    # Just enough of the DynamoDB client for SharedRateLimit
+    class exceptions(object):
+        ConditionalCheckFailedException = ConditionalCheckFailed
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def update_item(self, TableName, Key, UpdateExpression,
+                    ConditionExpression, ExpressionAttributeValues):
+        key = Key['window']['S']
+        rate = int(ExpressionAttributeValues[':rate']['N'])
+        with self.lock:
+            if self.items.get(key, 0) >= rate:
+                raise ConditionalCheckFailed()
+            self.items[key] = self.items.get(key, 0) + 1
+
+
+class SharedRateLimitTests(unittest.TestCase):
+    def test_rate_is_shared_between_containers(self):
+        dynamodb = FakeDynamoDB()
+        first = haaska.SharedRateLimit('t', 'http://hass/api', 3, dynamodb)
+        second = haaska.SharedRateLimit('t', 'http://hass/api', 3, dynamodb)
+        # Start at the beginning of a window so all of this falls in one
+        time.sleep(1 - time.time() % 1)
+        first.acquire(STATE, 0)
+        second.acquire(STATE, 0)
+        first.acquire(STATE, 0)
+        with self.assertRaises(haaska.Overloaded):
+            second.acquire(STATE, 0)
+        second.acquire(STATE, 1.5)
+        self.assertEqual(sorted(dynamodb.items.values()), [1, 3])
+
+    def test_unreachable_table_lets_requests_through(self):
+        dynamodb = FakeDynamoDB()
+        dynamodb.update_item = lambda **kwargs: 1 / 0
+        limit = haaska.SharedRateLimit('t', 'http://hass/api', 1, dynamodb)
+        limit.acquire(STATE, 0)
+        limit.acquire(STATE, 0)
+
+    def test_admission_uses_shared_limit(self):
+        config = haaska.Configuration(optsDict={
+            'url': 'http://hass/api', 'admission_table': 't',
+            'shared_requests_per_second': 1,
+            'admission_wait': {'state': 0}})
+        admission = haaska.Admission(config)
+        admission.shared.client = FakeDynamoDB()
+        deadline = haaska.Deadline(None)
+        time.sleep(1 - time.time() % 1)
+        admission.release(admission.acquire('light', STATE, deadline))
+        with self.assertRaises(haaska.Overloaded):
+            admission.acquire('light', STATE, deadline)
+
+
+if __name__ == '__main__':
+    unittest.main()
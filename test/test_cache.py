@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for the caches that outlive one invocation.
+# $ cd test && python -m unittest test_cache
+
+import os
+import sys
+import shutil
+import marshal
+import tempfile
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+
+class DiskCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = haaska.DiskCache(self.directory, 4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_round_trip(self):
+        value = [{'endpointId': 'light:a', 'cookie': {}}]
+        self.assertTrue(self.cache.put('discovery:x', value, 1234.5))
+        self.assertEqual(self.cache.get('discovery:x'), (1234.5, value))
+        self.assertIsNone(self.cache.get('discovery:y'))
+        self.assertTrue(all(f.endswith('.bin') for f in self.files()))
+
+    def test_other_format_version_is_ignored(self):
+        self.cache.put('k', [1, 2, 3])
+        path = self.cache._path('k')
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = haaska.DiskCache.HEADER
+        _, _, _, written = header.unpack_from(data)
+        with open(path, 'wb') as f:
+            f.write(header.pack(haaska.DiskCache.MAGIC,
+                                haaska.DiskCache.VERSION + 1,
+                                marshal.version, written) +
+                    data[header.size:])
+        self.assertIsNone(self.cache.get('k'))
+
+    def test_corrupt_entry_is_ignored(self):
+        self.cache.put('k', list(range(100)))
+        path = self.cache._path('k')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:haaska.DiskCache.HEADER.size + 3])
+        self.assertIsNone(self.cache.get('k'))
+        with open(path, 'wb') as f:
+            f.write(b'HA')
+        self.assertIsNone(self.cache.get('k'))
+
+    def test_oldest_entries_are_trimmed(self):
+        for i in range(6):
+            self.assertTrue(self.cache.put('k%d' % i, 'x' * 1000))
+            # Distinct modification times
+            os.utime(self.cache._path('k%d' % i), (i, i))
+        self.assertLessEqual(sum(os.path.getsize(
+            os.path.join(self.directory, f)) for f in self.files()), 4096)
+        self.assertIsNone(self.cache.get('k0'))
+        self.assertIsNotNone(self.cache.get('k5'))
+
+    def test_oversize_value_is_not_written(self):
+        self.assertFalse(self.cache.put('k', 'x' * 8192))
+        self.assertEqual(self.files(), [])
+
+
+class CachedTests(unittest.TestCase):
+    def setUp(self):
+        haaska._cached.items.clear()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        haaska._disk_caches.pop(self.directory, None)
+        shutil.rmtree(self.directory)
+
+    def test_memory_is_bounded(self):
+        haaska._cached.capacity = 4
+        self.addCleanup(setattr, haaska._cached, 'capacity', 128)
+        for i in range(5):
+            config = haaska.Configuration(optsDict={
+                'url': 'http://%d/api' % i, 'cache_dir': ''})
+            haaska.cache_put(config, 'discovery', [i])
+        self.assertEqual(len(haaska._cached), 4)
+        self.assertIsNone(haaska.cache_get(haaska.Configuration(optsDict={
+            'url': 'http://0/api', 'cache_dir': ''}), 'discovery'))
+
+    def test_restored_from_disk(self):
+        config = haaska.Configuration(optsDict={'cache_dir': self.directory})
+        haaska.cache_put(config, 'discovery', ['a'])
+        haaska._cached.items.clear()
+        self.assertEqual(haaska.cache_get(config, 'discovery'), ['a'])
+        self.assertIsNone(haaska.cache_get(config, 'discovery', max_age=-1))
+        self.assertIsNone(haaska.cache_get(config, 'known'))
+
+
+class DiscoveryCacheTests(unittest.TestCase):
+    def setUp(self):
+        haaska._cached.items.clear()
+        self.directory = tempfile.mkdtemp()
+        self.hass = FakeHass({'states': (0, [{
+            'entity_id': 'light.a', 'state': 'on',
+            'attributes': {'friendly_name': 'A'}}])})
+
+    def tearDown(self):
+        self.hass.close()
+        haaska._disk_caches.pop(self.directory, None)
+        shutil.rmtree(self.directory)
+
+    def discover(self, **opts):
+        opts.update({'url': self.hass.url, 'cache_dir': self.directory,
+                     'discovery_snapshot': ''})
+        config = haaska.Configuration(optsDict=opts)
+        haaska.discover_appliances(haaska.HomeAssistant(config))
+
+    def test_not_written_when_never_read(self):
+        self.discover()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(len(haaska._cached), 0)
+
+    def test_written_for_discovery_cache_ttl(self):
+        self.discover(discovery_cache_ttl=300)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_known_written_for_discovery_updates(self):
+        self.discover(discovery_updates=True)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for capturing directives and their Home Assistant traffic.
+# $ cd test && python -m unittest test_capture
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+# Values that must never appear in a capture
+SECRETS = ('s-endpoint-token', 's-payload-token', 's-grant-code',
+           's-grantee-token', 's-correlation', 's-lock-code', 's-ha-secret')
+
+
+def directive(namespace, name, endpoint=None, payload=None):
+    header = {'namespace': namespace, 'name': name, 'payloadVersion': '3',
+              'messageId': 'm', 'correlationToken': 's-correlation'}
+    d = {'header': header, 'payload': payload or {}}
+    if endpoint is not None:
+        d['endpoint'] = endpoint
+    return {'directive': d}
+
+
+class AnonymizeTests(unittest.TestCase):
+    def assertRedacted(self, record):
+        text = json.dumps(record)
+        for secret in SECRETS:
+            self.assertNotIn(secret, text)
+
+    def test_endpoint_token_and_correlation_token(self):
+        request = directive('Alexa.PowerController', 'TurnOn', endpoint={
+            'endpointId': 'light:a',
+            'scope': {'type': 'BearerToken', 'token': 's-endpoint-token'}})
+        record = haaska.anonymize(request)
+        self.assertRedacted(record)
+        d = record['directive']
+        self.assertEqual(d['endpoint']['scope'],
+                         {'type': 'BearerToken', 'token': 'REDACTED'})
+        self.assertEqual(d['header']['correlationToken'], 'REDACTED')
+        self.assertEqual(d['endpoint']['endpointId'], 'light:a')
+        self.assertEqual(d['header']['messageId'], 'm')
+
+    def test_payload_token(self):
+        request = directive('Alexa.Discovery', 'Discover', payload={
+            'scope': {'type': 'BearerToken', 'token': 's-payload-token'}})
+        self.assertRedacted(haaska.anonymize(request))
+
+    def test_accept_grant(self):
+        request = directive('Alexa.Authorization', 'AcceptGrant', payload={
+            'grant': {'type': 'OAuth2.AuthorizationCode',
+                      'code': 's-grant-code'},
+            'grantee': {'type': 'BearerToken', 'token': 's-grantee-token'}})
+        record = haaska.anonymize(request)
+        self.assertRedacted(record)
+        self.assertEqual(record['directive']['payload']['grant']['type'],
+                         'OAuth2.AuthorizationCode')
+
+    def test_lists(self):
+        self.assertEqual(haaska.anonymize([{'token': 'x'}, [{'code': 1}]]),
+                         [{'token': 'REDACTED'}, [{'code': 'REDACTED'}]])
+
+    def test_original_is_untouched(self):
+        request = directive('Alexa', 'ReportState')
+        haaska.anonymize(request)
+        self.assertEqual(request['directive']['header']['correlationToken'],
+                         's-correlation')
+
+
+class CapturedCallsTests(unittest.TestCase):
+    def setUp(self):
+        self.hass = FakeHass()
+        self.addCleanup(self.hass.close)
+        config = haaska.Configuration(optsDict={'url': self.hass.url,
+                                                'password': 's-ha-secret'})
+        self.ha = haaska.HomeAssistant(config)
+        self.ha.calls = []
+
+    def test_call_bodies_are_redacted(self):
+        self.ha.post('services/lock/unlock',
+                     {'entity_id': 'lock.door', 'code': 's-lock-code'},
+                     wait=True)
+        self.assertEqual(self.hass.requests[0][2]['code'], 's-lock-code')
+        call, = self.ha.calls
+        self.assertEqual(call['body'], {'entity_id': 'lock.door',
+                                        'code': 'REDACTED'})
+        self.assertEqual(call['method'], 'POST')
+        self.assertEqual(call['path'], 'services/lock/unlock')
+        record = haaska.capture_record(
+            directive('Alexa.LockController', 'Unlock'), self.ha.calls,
+            None, 0.01)
+        AnonymizeTests.assertRedacted(self, record)
+
+
+def response(name, error=None):
+    r = {'event': {'header': {'namespace': 'Alexa', 'name': name},
+                   'payload': {}}}
+    if error:
+        r['event']['payload']['type'] = error
+    return r
+
+
+class CaptureRecordTests(unittest.TestCase):
+    def test_calls_dropped(self):
+        calls = [{'method': 'GET', 'path': 'states/light.%d' % i}
+                 for i in range(haaska.CAPTURE_MAX_CALLS + 7)]
+        record = haaska.capture_record(directive('Alexa', 'ReportState'),
+                                       calls, response('StateReport'), 0.5)
+        self.assertEqual(len(record['calls']), haaska.CAPTURE_MAX_CALLS)
+        self.assertEqual(record['calls_dropped'], 7)
+        self.assertEqual(record['response'], 'Alexa.StateReport')
+        self.assertEqual(record['ms'], 500.0)
+
+    def test_nothing_dropped(self):
+        record = haaska.capture_record(directive('Alexa', 'ReportState'),
+                                       [], None, 0)
+        self.assertNotIn('calls_dropped', record)
+        self.assertNotIn('response', record)
+
+    def test_error(self):
+        record = haaska.capture_record(
+            directive('Alexa', 'ReportState'), [],
+            response('ErrorResponse', 'ENDPOINT_UNREACHABLE'), 0)
+        self.assertEqual(record['error'], 'ENDPOINT_UNREACHABLE')
+
+
+class CaptureWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'capture.jsonl')
+
+    def records(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return [json.loads(line)['n'] for line in f]
+
+    def test_rotation(self):
+        writer = haaska.CaptureWriter(self.filename, 110, 2)
+        for n in range(12):
+            writer.write({'n': n, 'pad': 'x' * 30})
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['capture.jsonl', 'capture.jsonl.1',
+                          'capture.jsonl.2'])
+        self.assertEqual(self.records('capture.jsonl'), [10, 11])
+        self.assertEqual(self.records('capture.jsonl.1'), [8, 9])
+        self.assertEqual(self.records('capture.jsonl.2'), [6, 7])
+
+    def test_no_backups(self):
+        writer = haaska.CaptureWriter(self.filename, 110, 0)
+        for n in range(5):
+            writer.write({'n': n, 'pad': 'x' * 30})
+        self.assertEqual(os.listdir(self.directory), ['capture.jsonl'])
+        self.assertEqual(self.records('capture.jsonl'), [4])
+
+    def test_stdout(self):
+        writer = haaska.CaptureWriter('-', 100, 2)
+        with mock.patch.object(sys, 'stdout', io.StringIO()) as out:
+            writer.write({'n': 1})
+        self.assertEqual(json.loads(out.getvalue()), {'n': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
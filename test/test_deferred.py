@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for DeferredResponse completion and event gateway tokens.
+# $ cd test && python -m unittest test_deferred
+
+import os
+import sys
+import unittest
+from unittest import mock
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+
+class CompleteDeferredTests(unittest.TestCase):
+    def setUp(self):
+        self.hass = FakeHass({
+            'states/cover.door': (0, {'entity_id': 'cover.door',
+                                      'state': 'open',
+                                      'attributes': {}}),
+        })
+        self.config = haaska.Configuration(optsDict={
+            'url': 'http://127.0.0.1:1/api',
+            'backends': {'garage': {'url': self.hass.url}},
+            'deferred_poll_interval': 0.01})
+
+    def tearDown(self):
+        self.hass.close()
+
+    def test_backend_endpoint(self):
+        ha = haaska.HomeAssistant(self.config)
+        job = {'endpoint': {'endpointId': 'garage#cover:door'},
+               'correlationToken': 'ct', 'action': 'TurnOn',
+               'states': ['open']}
+        with mock.patch.object(haaska, 'send_event') as send_event:
+            response = haaska.complete_deferred(ha, job)
+        send_event.assert_called_once_with(self.config, response)
+        header = response['event']['header']
+        self.assertEqual(header['name'], 'Response')
+        self.assertEqual(header['correlationToken'], 'ct')
+        self.assertEqual(response['event']['endpoint']['endpointId'],
+                         'garage#cover:door')
+
+
+class GatewayTokenTests(unittest.TestCase):
+    def setUp(self):
+        haaska._gateway_tokens.clear()
+
+    def token_response(self, url, timeout, data):
+        r = mock.Mock()
+        r.json.return_value = {'access_token': 'access-' +
+                               data['refresh_token'],
+                               'expires_in': 3600}
+        return r
+
+    def test_tokens_are_per_home(self):
+        base = haaska.Configuration(optsDict={'lwa_client_id': 'skill',
+                                              'lwa_refresh_token': 'a'})
+        other = base.derive({'lwa_refresh_token': 'b'})
+        with mock.patch.object(haaska.requests, 'post',
+                               side_effect=self.token_response) as post:
+            self.assertEqual(haaska.gateway_token(base), 'access-a')
+            self.assertEqual(haaska.gateway_token(other), 'access-b')
+            self.assertEqual(haaska.gateway_token(base), 'access-a')
+        self.assertEqual(post.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for the files written by tracing and profiling.
+# $ cd test && python -m unittest test_diagnostics
+
+import gc
+import io
+import os
+import sys
+import json
+import random
+import tracemalloc
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+
+
+class TraceFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'traces.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def trace(self, exporter):
+        tracer = haaska.Tracer(exporter)
+        with tracer.span('directive', **{'alexa.name': 'TurnOn'}):
+            with tracer.span('invoke'):
+                pass
+        tracer.flush()
+
+    def test_traces_are_rotated(self):
+        writer = haaska.CaptureWriter(self.filename, 2048, 2)
+        exporter = haaska.OTLPFileExporter(writer)
+        for _ in range(20):
+            self.trace(exporter)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['traces.jsonl', 'traces.jsonl.1', 'traces.jsonl.2'])
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            self.assertLessEqual(os.path.getsize(path), 2048)
+            with open(path) as f:
+                for line in f:
+                    spans = json.loads(line)['resourceSpans'][0][
+                        'scopeSpans'][0]['spans']
+                    self.assertEqual(len(spans), 2)
+
+
+class ProfileFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_newest_profiles_are_kept(self):
+        other = os.path.join(self.directory, 'other.prof')
+        open(other, 'w').close()
+        for i in range(5):
+            with haaska.Profiler('Alexa.Discovery.Discover', self.directory,
+                                 5, 3):
+                sum(range(1000))
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if path != other and os.path.getmtime(path) > 1000:
+                    # Distinct modification times, oldest first
+                    os.utime(path, (i, i))
+        profiles = [n for n in os.listdir(self.directory)
+                    if n.startswith('haaska-')]
+        self.assertEqual(len(profiles), 3)
+        self.assertTrue(os.path.exists(other))
+
+
+class SamplingTests(unittest.TestCase):
+    def test_rates(self):
+        self.assertFalse(haaska.sampled(0))
+        self.assertTrue(all(haaska.sampled(1) for _ in range(100)))
+        random.seed(1)
+        hits = sum(haaska.sampled(10) for _ in range(10000))
+        self.assertTrue(800 < hits < 1200, hits)
+
+    def test_modes_are_sampled_independently(self):
+        random.seed(2)
+        both = sum(haaska.sampled(2) and haaska.sampled(2)
+                   for _ in range(1000))
+        self.assertTrue(150 < both < 350, both)
+
+    def test_no_profiling_while_tracing_memory(self):
+        config = haaska.Configuration(optsDict={
+            'profile_filter': ['Alexa.*'], 'memory_filter': ['Alexa.*']})
+        memory = haaska.memory_tracer_for(config, 'Alexa', 'ReportState',
+                                          haaska.NullMetrics())
+        self.assertIsInstance(memory, haaska.MemoryTracer)
+        self.assertIsInstance(haaska.profiler_for(
+            config, 'Alexa', 'ReportState', memory), haaska._NullContext)
+        self.assertIsInstance(haaska.profiler_for(
+            config, 'Alexa', 'ReportState', haaska._NullContext()),
+            haaska.Profiler)
+
+
+class MemoryTracerTests(unittest.TestCase):
+    def test_report(self):
+        metrics = haaska.Metrics(stream=io.StringIO())
+        # Garbage left by earlier tests would otherwise be freed inside the
+        # traced block and offset the object counts
+        gc.collect()
+        with haaska.MemoryTracer('Alexa.ReportState', metrics, 3, 1):
+            held = [list(range(100)) for _ in range(1000)]
+        self.assertFalse(tracemalloc.is_tracing())
+        report = metrics.properties['memory']
+        self.assertGreater(report['peak_bytes'], 100 * 1000 * 8)
+        self.assertGreaterEqual(report['peak_bytes'],
+                                report['current_bytes'])
+        self.assertLessEqual(len(report['top_allocations']), 3)
+        self.assertGreaterEqual(report['object_growth']['list'], 1000)
+        self.assertEqual(metrics.values['memory_peak_bytes'],
+                         report['peak_bytes'])
+        self.assertEqual(metrics.units['memory_peak_bytes'], 'bytes')
+        del held
+
+    def test_leaves_running_tracemalloc_on(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        with haaska.MemoryTracer('x', haaska.NullMetrics(), 3, 1):
+            pass
+        self.assertTrue(tracemalloc.is_tracing())
+
+
+if __name__ == '__main__':
+    unittest.main()
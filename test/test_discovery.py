@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for cached, snapshot and incremental discovery.
+# $ cd test && python -m unittest test_discovery
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import marshal
+import unittest
+import concurrent.futures
+from unittest import mock
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+
+def light(entity_id, name=None):
+    return {'entity_id': entity_id, 'state': 'on',
+            'attributes': {'friendly_name': name or entity_id}}
+
+
+class WarmUpTests(unittest.TestCase):
+    def setUp(self):
+        haaska._cached.items.clear()
+        self.hass = FakeHass({'states': (0, [light('light.a')])})
+        self.config = haaska.Configuration(optsDict={
+            'url': self.hass.url, 'cache_dir': '', 'discovery_snapshot': '',
+            'discovery_cache_ttl': 300})
+
+    def tearDown(self):
+        self.hass.close()
+
+    def discover(self):
+        ha = haaska.HomeAssistant(self.config)
+        with mock.patch.object(haaska, 'get_executor') as get_executor:
+            endpoints = haaska.discover_appliances(ha)
+        get_executor.assert_not_called()
+        return [e['endpointId'] for e in endpoints]
+
+    def test_keep_warm_refreshes_cached_discovery(self):
+        self.assertEqual(self.discover(), ['light:a'])
+        self.hass.routes['states'] = (0, [light('light.a'), light('light.b')])
+        self.assertEqual(self.discover(), ['light:a'])
+        self.assertEqual(self.hass.count('GET', 'states'), 1)
+
+        haaska.warm_up(self.config, haaska.NullMetrics(),
+                       haaska.NullTracer(), haaska.Deadline(None))
+        self.assertEqual(self.discover(), ['light:a', 'light:b'])
+        self.assertEqual(self.hass.count('GET', 'states'), 2)
+
+    def test_known_endpoints_only_kept_for_discovery_updates(self):
+        self.discover()
+        self.assertIsNone(haaska.cache_get(self.config, 'known'))
+        self.config = self.config.derive({'url': self.hass.url,
+                                          'discovery_updates': True})
+        self.discover()
+        self.assertEqual(len(haaska.cache_get(self.config, 'known')), 1)
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        haaska._cached.items.clear()
+        haaska._snapshots.clear()
+        haaska._snapshot_served.clear()
+        self.directory = tempfile.mkdtemp()
+        self.hass = FakeHass({'states': (0, [light('light.a'),
+                                             light('light.b')])})
+        self.config = haaska.Configuration(optsDict={
+            'url': self.hass.url, 'cache_dir': '',
+            'discovery_snapshot': os.path.join(self.directory, 'd.json')})
+        snapshot = haaska.build_snapshot(self.config, [light('light.a')])
+        self.write(snapshot)
+
+    def tearDown(self):
+        self.hass.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, snapshot):
+        with open(self.config.discovery_snapshot, 'w') as f:
+            json.dump(snapshot, f)
+        haaska._snapshots.clear()
+
+    def discover(self, config=None):
+        ha = haaska.HomeAssistant(config or self.config)
+        return [e['endpointId'] for e in haaska.discover_appliances(ha)]
+
+    def test_only_cold_container_uses_snapshot(self):
+        self.assertEqual(self.discover(), ['light:a'])
+        self.assertEqual(self.hass.count('GET', 'states'), 0)
+        self.assertEqual(self.discover(), ['light:a', 'light:b'])
+        self.assertEqual(self.discover(), ['light:a', 'light:b'])
+        self.assertEqual(self.hass.count('GET', 'states'), 2)
+
+    def test_cached_results_expire(self):
+        config = self.config.derive({
+            'url': self.hass.url, 'cache_dir': '',
+            'discovery_snapshot': self.config.discovery_snapshot,
+            'discovery_cache_ttl': 300})
+        self.write(haaska.build_snapshot(config, [light('light.a')]))
+        self.assertEqual(self.discover(config), ['light:a'])
+        self.assertEqual(self.discover(config), ['light:a', 'light:b'])
+        self.assertEqual(self.discover(config), ['light:a', 'light:b'])
+        self.assertEqual(self.hass.count('GET', 'states'), 1)
+        key = 'discovery:' + haaska.config_digest(config)
+        written, endpoints = haaska._cached.get(key)
+        haaska._cached.put(key, (written - 301, endpoints))
+        self.discover(config)
+        self.assertEqual(self.hass.count('GET', 'states'), 2)
+
+    def test_old_snapshot_is_not_used(self):
+        snapshot = haaska.build_snapshot(self.config, [light('light.a')])
+        snapshot['created'] = '2020-01-01T00:00:00.00Z'
+        self.write(snapshot)
+        self.assertEqual(self.discover(), ['light:a', 'light:b'])
+        config = self.config.derive({
+            'url': self.hass.url, 'cache_dir': '',
+            'discovery_snapshot': self.config.discovery_snapshot,
+            'snapshot_max_age': 0})
+        snapshot['config'] = haaska.config_digest(config)
+        self.write(snapshot)
+        self.assertEqual(self.discover(config), ['light:a'])
+
+
+def endpoint(endpoint_id, name=None):
+    return {'endpointId': endpoint_id, 'friendlyName': name or endpoint_id}
+
+
+class DiscoveryDeltaTests(unittest.TestCase):
+    def known(self, *endpoints):
+        return {e['endpointId']: e for e in endpoints}
+
+    def test_added_changed_removed(self):
+        known = self.known(endpoint('light:a'), endpoint('light:b'),
+                           endpoint('light:c'))
+        changed, removed = haaska.discovery_delta(
+            known, [endpoint('light:a'), endpoint('light:b', 'Hall'),
+                    endpoint('light:d')])
+        self.assertEqual([e['endpointId'] for e in changed],
+                         ['light:b', 'light:d'])
+        self.assertEqual(removed, ['light:c'])
+
+    def test_unchanged(self):
+        known = self.known(endpoint('light:a'))
+        self.assertEqual(haaska.discovery_delta(known, [endpoint('light:a')]),
+                         ([], []))
+
+    def test_missing_backend_is_not_removed(self):
+        known = self.known(endpoint('light:a'), endpoint('garage#cover:door'))
+        changed, removed = haaska.discovery_delta(
+            known, [endpoint('light:a')], {'garage'})
+        self.assertEqual((changed, removed), ([], []))
+        changed, removed = haaska.discovery_delta(
+            known, [endpoint('garage#cover:door')], {None})
+        self.assertEqual((changed, removed), ([], []))
+
+
+class SyncDiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        haaska._cached.items.clear()
+        self.config = haaska.Configuration(optsDict={
+            'cache_dir': '', 'discovery_snapshot': '',
+            'discovery_updates': True})
+        self.ha = haaska.HomeAssistant(self.config)
+
+    def sync(self, endpoints, missing=()):
+        with mock.patch.object(haaska, 'send_event') as send_event:
+            result = haaska.sync_discovery(self.ha, endpoints, missing)
+        return result, [(c[0][1]['event']['header']['name'],
+                         c[0][1]['event']['payload']['endpoints'])
+                        for c in send_event.call_args_list]
+
+    def test_nothing_known(self):
+        self.assertEqual(self.sync([endpoint('light:a')]), (([], []), []))
+
+    def test_sends_changes_once(self):
+        haaska.cache_put(self.config, 'known',
+                         [endpoint('light:a'), endpoint('light:b')])
+        endpoints = [endpoint('light:a', 'Kitchen'), endpoint('light:c')]
+        (changed, removed), events = self.sync(endpoints)
+        self.assertEqual(events, [
+            ('AddOrUpdateReport', endpoints),
+            ('DeleteReport', [{'endpointId': 'light:b'}])])
+        self.assertEqual(removed, ['light:b'])
+        self.assertEqual(self.sync(endpoints), (([], []), []))
+        self.assertEqual(haaska.cache_get(self.config, 'known'), endpoints)
+
+    def test_large_changes_are_split(self):
+        haaska.cache_put(self.config, 'known', [])
+        endpoints = [endpoint('light:%d' % i) for i in range(
+            haaska.DISCOVERY_EVENT_ENDPOINTS + 1)]
+        _, events = self.sync(endpoints)
+        self.assertEqual([len(e) for _, e in events],
+                         [haaska.DISCOVERY_EVENT_ENDPOINTS, 1])
+
+    def test_failed_event_is_sent_again(self):
+        haaska.cache_put(self.config, 'known', [])
+        endpoints = [endpoint('light:a')]
+        error = haaska.requests.exceptions.HTTPError('503')
+        with mock.patch.object(haaska, 'send_event', side_effect=error):
+            with self.assertRaises(haaska.requests.exceptions.HTTPError):
+                haaska.sync_discovery(self.ha, endpoints)
+        _, events = self.sync(endpoints)
+        self.assertEqual(events, [('AddOrUpdateReport', endpoints)])
+
+    def test_disabled(self):
+        config = self.config.derive({'discovery_updates': False})
+        haaska.cache_put(config, 'known', [])
+        self.ha = haaska.HomeAssistant(config)
+        self.assertEqual(self.sync([endpoint('light:a')]), (([], []), []))
+
+
+def hang(ha, states, conn):
+    time.sleep(60)
+
+
+def fail(ha, states, conn):
+    conn.send_bytes(marshal.dumps((False, 'KeyError: boom')))
+
+
+class ParallelDiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        self.states = [light('light.l%d' % i, 'Light %d' % i)
+                       for i in range(2000)]
+        self.config = haaska.Configuration(optsDict={
+            'discovery_parallel_min': 1000, 'discovery_workers': 2,
+            'discovery_timeout': 1.0})
+        self.ha = haaska.HomeAssistant(self.config)
+        self.serial = haaska.build_endpoints(self.ha, self.states)
+
+    def test_same_as_serial(self):
+        self.assertEqual(haaska.discovery_workers(self.config, 2000), 2)
+        self.assertEqual(haaska.build_endpoints_parallel(
+            self.ha, self.states, 2), self.serial)
+        self.assertEqual(haaska.discover_backend(self.ha, self.states),
+                         self.serial)
+
+    def test_failed_worker_falls_back_to_serial(self):
+        with mock.patch.object(haaska, '_build_chunk', fail):
+            self.assertIsNone(haaska.build_endpoints_parallel(
+                self.ha, self.states, 2))
+            self.assertEqual(haaska.discover_backend(self.ha, self.states),
+                             self.serial)
+
+    def test_hung_worker_times_out(self):
+        start = time.monotonic()
+        with mock.patch.object(haaska, '_build_chunk', hang):
+            self.assertEqual(haaska.discover_backend(self.ha, self.states),
+                             self.serial)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_only_main_thread_forks(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            workers = pool.submit(haaska.discovery_workers, self.config,
+                                  2000).result()
+        self.assertEqual(workers, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
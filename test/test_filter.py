@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for deciding which entities are exposed to Alexa.
+# $ cd test && python -m unittest test_filter
+
+import os
+import sys
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+
+
+def entity(entity_id, **attributes):
+    return {'entity_id': entity_id, 'state': 'on', 'attributes': attributes}
+
+
+class EntityFilterTests(unittest.TestCase):
+    def exposed(self, x, **opts):
+        return haaska.EntityFilter(haaska.Configuration(optsDict=opts))(x)
+
+    def test_default(self):
+        self.assertTrue(self.exposed(entity('light.a')))
+        self.assertFalse(self.exposed(entity('light.a'),
+                                      expose_by_default=False))
+
+    def test_domain_comes_first(self):
+        self.assertFalse(self.exposed(
+            entity('sensor.a'), entity_overrides={'sensor.a': True}))
+        self.assertFalse(self.exposed(
+            entity('light.a'), exposed_domains=['switch'],
+            include_entities=['light.a']))
+
+    def test_override_beats_rules_and_attributes(self):
+        self.assertTrue(self.exposed(
+            entity('light.a', haaska_hidden=True),
+            entity_overrides={'light.a': True}, exclude_entities=['light.*']))
+        self.assertFalse(self.exposed(
+            entity('light.a'), entity_overrides={'light.a': False},
+            include_entities=['light.a']))
+
+    def test_exclude_beats_hidden_and_include(self):
+        self.assertFalse(self.exposed(
+            entity('light.a', haaska_hidden=False),
+            exclude_entities=['light.a'], include_entities=['light.a']))
+        self.assertFalse(self.exposed(
+            entity('light.a', area='garage'),
+            exclude_attributes={'area': 'garage'},
+            include_entities=['light.a']))
+
+    def test_hidden_beats_include(self):
+        self.assertFalse(self.exposed(entity('light.a', haaska_hidden=True),
+                                      include_entities=['light.a']))
+        self.assertFalse(self.exposed(entity('light.a', hidden=True),
+                                      include_entities=['light.a']))
+        # haaska_hidden wins over hidden
+        self.assertTrue(self.exposed(
+            entity('light.a', haaska_hidden=False, hidden=True)))
+        self.assertTrue(self.exposed(entity('light.a', hidden=False),
+                                     expose_by_default=False))
+
+    def test_include_beats_default(self):
+        opts = {'expose_by_default': False,
+                'include_entities': ['light.kitchen_*', 're:^switch\\.fan\\d$',
+                                     'light.hall'],
+                'include_attributes': {'area': ['kitchen', 'hall']}}
+        self.assertTrue(self.exposed(entity('light.kitchen_1'), **opts))
+        self.assertTrue(self.exposed(entity('switch.fan2'), **opts))
+        self.assertFalse(self.exposed(entity('switch.fan22'), **opts))
+        self.assertTrue(self.exposed(entity('light.hall'), **opts))
+        self.assertTrue(self.exposed(entity('light.x', area='hall'), **opts))
+        self.assertFalse(self.exposed(entity('light.x', area='attic'),
+                                      **opts))
+
+    def test_list_attributes_never_match(self):
+        self.assertTrue(self.exposed(entity('light.a', area=['garage']),
+                                     exclude_attributes={'area': 'garage'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
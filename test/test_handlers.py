@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline regression tests for directive handlers that used to fail.
+# $ cd test && python -m unittest test_handlers
+
+import os
+import sys
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+LIGHT = {'entity_id': 'light.kitchen', 'state': 'on',
+         'attributes': {'friendly_name': 'Kitchen', 'supported_features': 2,
+                        'brightness': 128, 'color_temp': 250}}
+CLIMATE = {'entity_id': 'climate.hallway', 'state': 'heat',
+           'attributes': {'friendly_name': 'Hallway',
+                          'unit_of_measurement': u'°C', 'temperature': 21,
+                          'current_temperature': 20.5, 'min_temp': 7,
+                          'max_temp': 23,
+                          'operation_list': ['heat', 'cool', 'off']}}
+TV = {'entity_id': 'media_player.tv', 'state': 'on',
+      'attributes': {'friendly_name': 'TV', 'volume_level': 0.4,
+                     'is_volume_muted': True}}
+
+
+class CheckValueTests(unittest.TestCase):
+    def test_in_range(self):
+        self.assertEqual(haaska.check_value(50, 0, 100), 50)
+        self.assertEqual(haaska.check_value(7.5, 7, 35), 7.5)
+
+    def test_clamped(self):
+        self.assertEqual(haaska.check_value(-5, 0, 100), 0)
+        self.assertEqual(haaska.check_value(150, 0, 100), 100)
+        self.assertEqual(haaska.check_value(100, 0, 100), 100)
+
+    def test_unbounded(self):
+        self.assertIsNone(haaska.check_value(None, 0, 100))
+        self.assertEqual(haaska.check_value(150), 150)
+        self.assertEqual(haaska.check_value(150, 10, 10), 150)
+
+
+class HandlerTests(unittest.TestCase):
+    def setUp(self):
+        routes = {'states': (0, [LIGHT, CLIMATE, TV])}
+        for state in (LIGHT, CLIMATE, TV):
+            routes['states/' + state['entity_id']] = (0, state)
+        self.hass = FakeHass(routes)
+        self.addCleanup(self.hass.close)
+        config = haaska.Configuration(optsDict={'url': self.hass.url})
+        self.ha = haaska.HomeAssistant(config)
+
+    def invoke(self, namespace, name, endpoint_id, payload):
+        endpoint = {'endpointId': endpoint_id,
+                    'scope': {'type': 'BearerToken', 'token': 't'}}
+        r = haaska.invoke(namespace, name, self.ha, payload, endpoint, 'ct')
+        self.assertNotEqual(r['event']['header']['name'], 'ErrorResponse',
+                            r['event']['payload'])
+        return {(p['namespace'], p['name']): p['value']
+                for p in r['context']['properties']}
+
+    def posts(self, service):
+        return [body for method, path, body in self.hass.requests
+                if method == 'POST' and path == 'services/' + service]
+
+    def test_set_color_temperature(self):
+        properties = self.invoke('Alexa.ColorTemperatureController',
+                                 'SetColorTemperature', 'light:kitchen',
+                                 {'colorTemperatureInKelvin': 4000})
+        self.assertEqual(properties[('Alexa.ColorTemperatureController',
+                                     'colorTemperatureInKelvin')], 4000)
+        self.assertEqual(self.posts('light/turn_on'),
+                         [{'entity_id': 'light.kitchen', 'color_temp': 250}])
+
+    def test_adjust_target_temperature(self):
+        properties = self.invoke(
+            'Alexa.ThermostatController', 'AdjustTargetTemperature',
+            'climate:hallway',
+            {'targetSetpointDelta': {'value': -1.5, 'scale': 'CELSIUS'}})
+        self.assertEqual(properties[('Alexa.ThermostatController',
+                                     'targetSetpoint')],
+                         {'value': 19.5, 'scale': 'CELSIUS'})
+        self.assertEqual(properties[('Alexa.ThermostatController',
+                                     'thermostatMode')], 'HEAT')
+        self.assertEqual(self.posts('climate/set_temperature'),
+                         [{'entity_id': 'climate.hallway',
+                           'temperature': 19.5, 'operation_mode': 'heat'}])
+
+    def test_adjust_target_temperature_is_clamped(self):
+        properties = self.invoke(
+            'Alexa.ThermostatController', 'AdjustTargetTemperature',
+            'climate:hallway',
+            {'targetSetpointDelta': {'value': 5, 'scale': 'CELSIUS'}})
+        self.assertEqual(properties[('Alexa.ThermostatController',
+                                     'targetSetpoint')]['value'], 23)
+
+    def test_set_volume(self):
+        properties = self.invoke('Alexa.Speaker', 'SetVolume',
+                                 'media_player:tv', {'volume': {'value': 30}})
+        self.assertEqual(properties[('Alexa.Speaker', 'volume')], 30)
+        self.assertIs(properties[('Alexa.Speaker', 'muted')], True)
+        self.assertEqual(self.posts('media_player/volume_set'),
+                         [{'entity_id': 'media_player.tv',
+                           'volume_level': 0.3}])
+
+    def test_adjust_volume(self):
+        properties = self.invoke('Alexa.Speaker', 'AdjustVolume',
+                                 'media_player:tv', {'volume': {'value': 70}})
+        self.assertEqual(properties[('Alexa.Speaker', 'volume')], 100)
+        self.assertEqual(self.posts('media_player/volume_set'),
+                         [{'entity_id': 'media_player.tv',
+                           'volume_level': 1.0}])
+
+    def test_set_mute(self):
+        properties = self.invoke('Alexa.Speaker', 'SetMute',
+                                 'media_player:tv', {'mute': {'value': False}})
+        self.assertEqual(properties[('Alexa.Speaker', 'volume')], 40)
+        self.assertIs(properties[('Alexa.Speaker', 'muted')], False)
+        self.assertEqual(self.posts('media_player/volume_mute'),
+                         [{'entity_id': 'media_player.tv',
+                           'is_volume_muted': False}])
+
+
+if __name__ == '__main__':
+    unittest.main()
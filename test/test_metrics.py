@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for the CloudWatch Embedded Metric Format log line.
+# $ cd test && python -m unittest test_metrics
+
+import io
+import os
+import sys
+import json
+import time
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.metrics = haaska.Metrics('haaska-test', self.stream)
+
+    def emitted(self):
+        self.metrics.emit()
+        line, = self.stream.getvalue().splitlines()
+        return json.loads(line)
+
+    def test_document(self):
+        self.metrics.set_dimensions(namespace='Alexa', name='TurnOn',
+                                    backend=None)
+        with self.metrics.timer('invoke'):
+            pass
+        self.metrics.add_time('ha_get', 12.34567)
+        self.metrics.add_time('ha_get', 1.0)
+        self.metrics.incr('ha_requests')
+        self.metrics.incr('ha_requests', 2)
+        self.metrics.incr('ha_rx_bytes', 2048)
+        self.metrics.set_property('memory', {'peak_bytes': 1})
+        before = int(time.time() * 1000)
+        doc = self.emitted()
+
+        aws = doc['_aws']
+        self.assertGreaterEqual(aws['Timestamp'], before)
+        directive, = aws['CloudWatchMetrics']
+        self.assertEqual(directive['Namespace'], 'haaska-test')
+        self.assertEqual(directive['Dimensions'], [['name', 'namespace']])
+        self.assertEqual(directive['Metrics'], [
+            {'Name': 'ha_get_ms', 'Unit': 'Milliseconds'},
+            {'Name': 'ha_requests', 'Unit': 'Count'},
+            {'Name': 'ha_rx_bytes', 'Unit': 'Bytes'},
+            {'Name': 'invoke_ms', 'Unit': 'Milliseconds'}])
+
+        self.assertEqual(doc['namespace'], 'Alexa')
+        self.assertEqual(doc['name'], 'TurnOn')
+        self.assertNotIn('backend', doc)
+        self.assertEqual(doc['ha_get_ms'], 13.346)
+        self.assertEqual(doc['ha_requests'], 3)
+        self.assertEqual(doc['ha_rx_bytes'], 2048)
+        self.assertGreaterEqual(doc['invoke_ms'], 0)
+        # Properties are logged but are not metrics
+        self.assertEqual(doc['memory'], {'peak_bytes': 1})
+        self.assertNotIn('memory', [m['Name'] for m in directive['Metrics']])
+
+    def test_every_metric_has_a_value(self):
+        self.metrics.incr('ha_requests')
+        self.metrics.add_time('config', 1.5)
+        doc = self.emitted()
+        for metric in doc['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            self.assertIn(metric['Name'], doc)
+        for dimension in doc['_aws']['CloudWatchMetrics'][0]['Dimensions'][0]:
+            self.assertIn(dimension, doc)
+
+    def test_null_metrics(self):
+        metrics = haaska.NullMetrics()
+        with metrics.timer('invoke'):
+            metrics.incr('ha_requests')
+        metrics.emit()
+
+
+if __name__ == '__main__':
+    unittest.main()
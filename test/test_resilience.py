@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for how haaska copes with a slow or failing Home Assistant.
+# $ cd test && python -m unittest test_resilience
+
+import os
+import sys
+import time
+import unittest
+import concurrent.futures
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+
+def light(entity_id):
+    return {'entity_id': entity_id, 'state': 'on',
+            'attributes': {'friendly_name': entity_id}}
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def test_opens_at_threshold(self):
+        breaker = haaska.CircuitBreaker(3, 60)
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow(lambda: self.fail('probed')))
+        breaker.record_failure()
+        self.assertEqual(breaker.state, haaska.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow(lambda: self.fail('probed')))
+
+    def test_success_resets_count(self):
+        breaker = haaska.CircuitBreaker(2, 60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, haaska.CircuitBreaker.CLOSED)
+
+    def test_zero_threshold_never_opens(self):
+        breaker = haaska.CircuitBreaker(0, 60)
+        for _ in range(10):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, haaska.CircuitBreaker.CLOSED)
+
+    def test_probe_after_reset_timeout(self):
+        breaker = haaska.CircuitBreaker(1, 0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertFalse(breaker.allow(lambda: False))
+        self.assertEqual(breaker.state, haaska.CircuitBreaker.OPEN)
+        # A failed probe starts another reset_timeout
+        self.assertFalse(breaker.allow(lambda: self.fail('probed')))
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow(lambda: True))
+        self.assertEqual(breaker.state, haaska.CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_unreachable_home_assistant(self):
+        hass = FakeHass({'states/light.x': (0, light('light.x')),
+                         '': (0, {'message': 'API running.'})})
+        url = hass.url
+        hass.close()
+        config = haaska.Configuration(optsDict={
+            'url': url, 'breaker_threshold': 2, 'breaker_reset_timeout': 60,
+            'get_retries': 0, 'hedge_requests': False})
+        ha = haaska.HomeAssistant(config)
+        for _ in range(2):
+            with self.assertRaises(
+                    haaska.requests.exceptions.ConnectionError):
+                ha.get('states/light.x')
+        with self.assertRaises(haaska.CircuitOpen):
+            ha.get('states/light.x')
+
+
+class LatencyModelTests(unittest.TestCase):
+    def test_no_estimate_before_min_samples(self):
+        model = haaska.LatencyModel(min_samples=3)
+        model.observe(0.02)
+        model.observe(0.02)
+        self.assertIsNone(model.hedge_delay())
+        self.assertIsNone(model.timeout(0.5))
+
+    def test_timeout_has_floor(self):
+        model = haaska.LatencyModel(min_samples=3)
+        for _ in range(3):
+            model.observe(0.02)
+        self.assertEqual(model.timeout(0.5), 0.5)
+        self.assertLess(model.hedge_delay(), 0.5)
+
+
+class BulkStatesTests(unittest.TestCase):
+    def setUp(self):
+        self.hass = FakeHass({
+            'states/light.x': (0.02, light('light.x')),
+            'states': (0.8, [light('light.x')]),
+        })
+        self.config = haaska.Configuration(optsDict={
+            'url': self.hass.url, 'min_read_timeout': 0.5})
+
+    def tearDown(self):
+        self.hass.close()
+
+    def test_states_not_held_to_entity_read_latency(self):
+        ha = haaska.HomeAssistant(self.config)
+        for _ in range(6):
+            ha.get('states/light.x')
+        self.assertIsNotNone(ha.latency.hedge_delay())
+
+        self.assertEqual(len(ha.get('states')), 1)
+        self.assertEqual(self.hass.count('GET', 'states'), 1)
+        self.assertEqual(ha.breaker.state, haaska.CircuitBreaker.CLOSED)
+        self.assertEqual(ha.latency.samples, 6)
+
+    def test_read_timeout_counts_once_retries_are_used_up(self):
+        self.hass.routes['states/light.slow'] = (0.3, light('light.slow'))
+        config = self.config.derive({'hedge_requests': False,
+                                     'get_retries': 2,
+                                     'retry_backoff': 0.01,
+                                     'breaker_threshold': 2,
+                                     'min_read_timeout': 0.1})
+        ha = haaska.HomeAssistant(config)
+        for _ in range(6):
+            ha.get('states/light.x')
+
+        with self.assertRaises(haaska.requests.exceptions.ReadTimeout):
+            ha.get('states/light.slow')
+        self.assertEqual(self.hass.count('GET', 'states/light.slow'), 3)
+        self.assertEqual(ha.breaker.failures, 1)
+        self.assertEqual(ha.breaker.state, haaska.CircuitBreaker.CLOSED)
+
+
+class FanOutTests(unittest.TestCase):
+    def setUp(self):
+        self.hass = FakeHass({
+            'states/light.x': (0.01, light('light.x')),
+            'states/light.slow': (0.2, light('light.slow')),
+        })
+
+    def tearDown(self):
+        self.hass.close()
+
+    def test_hedged_reads_from_a_full_fan_out_pool(self):
+        config = haaska.Configuration(optsDict={'url': self.hass.url})
+        ha = haaska.HomeAssistant(config)
+        for _ in range(6):
+            ha.get('states/light.x')
+        self.assertLess(ha.latency.hedge_delay(), 0.2)
+
+        # More hedging tasks than the fan-out pool has workers
+        futures = [haaska.get_executor().submit(ha.get, 'states/light.slow')
+                   for _ in range(12)]
+        done, _ = concurrent.futures.wait(futures, timeout=10)
+        self.assertEqual(len(done), 12)
+        for f in futures:
+            self.assertEqual(f.result()['entity_id'], 'light.slow')
+
+
+if __name__ == '__main__':
+    unittest.main()
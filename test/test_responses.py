@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for answering retried directives from remembered responses.
+# $ cd test && python -m unittest test_responses
+
+import os
+import sys
+import time
+import threading
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+
+
+def response(name='Response'):
+    return {'event': {'header': {'namespace': 'Alexa', 'name': name}}}
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = haaska.ResponseCache(8)
+
+    def test_hit(self):
+        cached, entry = self.cache.begin('m1')
+        self.assertIsNone(cached)
+        r = response()
+        self.cache.finish(entry, 'm1', r, 30)
+        self.assertEqual(self.cache.begin('m1'), (r, None))
+
+    def test_in_flight_retry_waits(self):
+        _, entry = self.cache.begin('m1')
+        r = response()
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(self.cache.begin('m1', 5)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+        self.cache.finish(entry, 'm1', r, 30)
+        waiter.join(5)
+        self.assertEqual(results, [(r, None)])
+
+    def test_in_flight_wait_times_out(self):
+        self.cache.begin('m1')
+        self.assertEqual(self.cache.begin('m1', 0.01), (None, None))
+
+    def test_error_not_cached(self):
+        _, entry = self.cache.begin('m1')
+        self.cache.finish(entry, 'm1', response('ErrorResponse'), 30)
+        cached, entry = self.cache.begin('m1')
+        self.assertIsNone(cached)
+        self.assertIsNotNone(entry)
+
+    def test_waiter_runs_again_after_error(self):
+        _, entry = self.cache.begin('m1')
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(self.cache.begin('m1', 5)))
+        waiter.start()
+        time.sleep(0.05)
+        self.cache.finish(entry, 'm1', None, 30)
+        waiter.join(5)
+        self.assertIsNone(results[0][0])
+        self.assertIsNotNone(results[0][1])
+
+    def test_capacity_evicts_oldest_finished(self):
+        for i in range(20):
+            _, entry = self.cache.begin('done%d' % i)
+            self.cache.finish(entry, 'done%d' % i, response(), 30)
+        running = [self.cache.begin('run%d' % i)[1] for i in range(5)]
+        self.assertTrue(all(e is not None for e in running))
+        self.assertEqual(len(self.cache.entries), 8)
+        self.assertEqual(list(self.cache.entries)[:3],
+                         ['done17', 'done18', 'done19'])
+
+    def test_running_entries_are_never_evicted(self):
+        running = [self.cache.begin('run%d' % i)[1] for i in range(12)]
+        self.assertEqual(len(self.cache.entries), 12)
+        # A retry of the first waits for it instead of running it again
+        self.assertEqual(self.cache.begin('run0', 0.01), (None, None))
+        for i, entry in enumerate(running):
+            self.cache.finish(entry, 'run%d' % i, response(), 30)
+        self.cache.begin('next')
+        self.assertEqual(len(self.cache.entries), 8)
+        self.assertEqual(self.cache.begin('run11')[0], response())
+
+    def test_ttl_expiry(self):
+        _, entry = self.cache.begin('m1')
+        self.cache.finish(entry, 'm1', response(), 0.05)
+        time.sleep(0.1)
+        cached, entry = self.cache.begin('m1')
+        self.assertIsNone(cached)
+        self.assertIsNotNone(entry)
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+class FakeDynamoDB(object):
+    # Just enough of the DynamoDB client for SharedResponses
+    class exceptions(object):
+        ConditionalCheckFailedException = ConditionalCheckFailed
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def put_item(self, TableName, Item, ConditionExpression=None,
+                 ExpressionAttributeValues=None):
+        key = Item['messageId']['S']
+        with self.lock:
+            current = self.items.get(key)
+            if ConditionExpression and current is not None:
+                now = int(ExpressionAttributeValues[':now']['N'])
+                if int(current['expires']['N']) >= now:
+                    raise ConditionalCheckFailed()
+            self.items[key] = dict(Item)
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        with self.lock:
+            item = self.items.get(Key['messageId']['S'])
+        return {'Item': item} if item is not None else {}
+
+    def delete_item(self, TableName, Key):
+        with self.lock:
+            self.items.pop(Key['messageId']['S'], None)
+
+
+class SharedResponsesTests(unittest.TestCase):
+    # Each SharedResponses stands for a different container
+    def setUp(self):
+        self.dynamodb = FakeDynamoDB()
+        self.first = haaska.SharedResponses('t', self.dynamodb)
+        self.second = haaska.SharedResponses('t', self.dynamodb)
+        self.second.POLL = 0.01
+
+    def test_hit_on_another_container(self):
+        self.assertEqual(self.first.begin('m1', 'k', 30), (None, True))
+        r = response()
+        self.first.finish('m1', 'k', r, 30)
+        self.assertEqual(self.second.begin('m1', 'k', 30), (r, False))
+
+    def test_in_flight_retry_waits(self):
+        self.first.begin('m1', 'k', 30)
+        r = response()
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(
+            self.second.begin('m1', 'k', 30, 5)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+        self.first.finish('m1', 'k', r, 30)
+        waiter.join(5)
+        self.assertEqual(results, [(r, False)])
+
+    def test_in_flight_wait_times_out(self):
+        self.first.begin('m1', 'k', 30)
+        self.assertEqual(self.second.begin('m1', 'k', 30, 0.05),
+                         (None, False))
+
+    def test_error_not_cached(self):
+        self.first.begin('m1', 'k', 30)
+        self.first.finish('m1', 'k', response('ErrorResponse'), 30)
+        self.assertEqual(self.dynamodb.items, {})
+        self.assertEqual(self.second.begin('m1', 'k', 30), (None, True))
+
+    def test_ttl_expiry(self):
+        self.first.begin('m1', 'k', 30)
+        self.first.finish('m1', 'k', response(), 30)
+        self.dynamodb.items['m1']['expires']['N'] = str(int(time.time()) - 1)
+        self.assertEqual(self.second.begin('m1', 'k', 30), (None, True))
+
+    def test_other_directive_with_same_message_id(self):
+        self.first.begin('m1', 'k', 30)
+        self.first.finish('m1', 'k', response(), 30)
+        self.assertEqual(self.second.begin('m1', 'other', 30, 0.05),
+                         (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
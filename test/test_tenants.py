@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for selecting a home's configuration in multi-tenant mode.
+# $ cd test && python -m unittest test_tenants
+
+import os
+import sys
+import unittest
+from unittest import mock
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+
+USERS = {'token-1': 'amzn1.account.HOME1', 'token-2': 'amzn1.account.HOME1',
+         'token-3': 'amzn1.account.HOME3'}
+
+
+def profile(url, timeout, headers):
+    r = mock.Mock()
+    token = headers['Authorization'][len('Bearer '):]
+    if token not in USERS:
+        r.status_code = 401
+    else:
+        r.status_code = 200
+        r.json.return_value = {'user_id': USERS[token], 'name': 'Someone'}
+    return r
+
+
+def directive(token):
+    return {'header': {}, 'payload': {},
+            'endpoint': {'endpointId': 'light:x',
+                         'scope': {'type': 'BearerToken', 'token': token}}}
+
+
+class TenantConfigTests(unittest.TestCase):
+    def setUp(self):
+        haaska._identities.items.clear()
+        haaska._tenant_configs.items.clear()
+        self.config = haaska.Configuration(optsDict={
+            'url': 'http://base/api', 'password': 'base-secret',
+            'lwa_refresh_token': 'base-refresh',
+            'tenants': {'amzn1.account.HOME1': {'url': 'http://home1/api',
+                                                'password': 'home1'}}})
+
+    def tenant_config(self, token):
+        return haaska.tenant_config(self.config, directive(token))
+
+    def test_refreshed_token_selects_same_home(self):
+        with mock.patch.object(haaska.requests, 'get',
+                               side_effect=profile) as get:
+            first = self.tenant_config('token-1')
+            self.assertEqual(first.url, 'http://home1/api')
+            self.assertIs(self.tenant_config('token-2'), first)
+            self.assertIs(self.tenant_config('token-1'), first)
+        self.assertEqual(get.call_count, 2)
+
+    def test_unknown_home(self):
+        with mock.patch.object(haaska.requests, 'get', side_effect=profile):
+            with self.assertRaises(haaska.UnknownTenant):
+                self.tenant_config('token-3')
+
+    def test_rejected_token(self):
+        with mock.patch.object(haaska.requests, 'get', side_effect=profile):
+            with self.assertRaises(haaska.UnknownTenant):
+                self.tenant_config('expired')
+
+    def test_lookup_failure_is_not_a_credential_error(self):
+        error = haaska.requests.exceptions.ConnectionError('down')
+        with mock.patch.object(haaska.requests, 'get', side_effect=error):
+            with self.assertRaises(haaska.TenantLookupFailed):
+                self.tenant_config('token-1')
+
+    def test_without_tenants(self):
+        config = haaska.Configuration(optsDict={})
+        self.assertIs(haaska.tenant_config(config, directive('any')), config)
+
+
+class DeriveTests(unittest.TestCase):
+    def test_credentials_are_not_inherited(self):
+        base = haaska.Configuration(optsDict={
+            'url': 'http://base/api', 'password': 'base-secret',
+            'lwa_refresh_token': 'r', 'event_gateway_token': 'g',
+            'connect_timeout': 1.5})
+        derived = base.derive({'url': 'http://other/api'})
+        self.assertEqual(derived.password, '')
+        self.assertIsNone(derived.lwa_refresh_token)
+        self.assertIsNone(derived.event_gateway_token)
+        self.assertEqual(derived.connect_timeout, 1.5)
+
+    def test_legacy_password_key_is_not_inherited(self):
+        base = haaska.Configuration(optsDict={'ha_passwd': 'base-secret'})
+        self.assertEqual(base.derive({}).password, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for the timeOfSample timestamps in responses.
+# $ cd test && python -m unittest test_timestamps
+
+import os
+import sys
+import datetime
+import itertools
+import unittest
+from unittest import mock
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+
+def strftime_timestamp(now):
+    # How get_utc_timestamp used to format the time
+    return datetime.datetime.strftime(
+        datetime.datetime.utcfromtimestamp(now),
+        '%Y-%m-%dT%H:%M:%S.%f')[:-4] + 'Z'
+
+
+class TimestampTests(unittest.TestCase):
+    def assertSameAsStrftime(self, now):
+        self.assertEqual(haaska.get_utc_timestamp(now),
+                         strftime_timestamp(now), now)
+
+    def test_every_hundredth(self):
+        for base in (0, 1760000000, 1767225599):
+            for n in range(200):
+                self.assertSameAsStrftime(base + n / 100)
+
+    def test_second_boundary(self):
+        base = 1767225599
+        for now in (base + 0.99, base + 1, base + 0.99, base + 1.01):
+            self.assertSameAsStrftime(now)
+        self.assertEqual(haaska.get_utc_timestamp(base + 0.99),
+                         '2025-12-31T23:59:59.99Z')
+        self.assertEqual(haaska.get_utc_timestamp(base + 1),
+                         '2026-01-01T00:00:00.00Z')
+
+    def test_near_995(self):
+        base = 1760000000
+        for fraction in (0.994, 0.9949999, 0.995, 0.9950001, 0.999,
+                         0.9999994, 0.9999995, 0.9999996, 0.0000004):
+            self.assertSameAsStrftime(base + fraction)
+        # Rounding to the microsecond carries into the next second
+        self.assertEqual(haaska.get_utc_timestamp(base + 0.9999996),
+                         '2025-10-09T08:53:21.00Z')
+
+    def test_default_is_now(self):
+        self.assertRegex(haaska.get_utc_timestamp(),
+                         r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d\dZ$')
+
+
+class TimeOfSampleTests(unittest.TestCase):
+    def setUp(self):
+        light = {'entity_id': 'light.kitchen', 'state': 'on',
+                 'attributes': {'friendly_name': 'Kitchen',
+                                'supported_features': 19,
+                                'brightness': 128, 'hs_color': [30, 50],
+                                'color_temp': 300}}
+        self.hass = FakeHass({'states': (0, [light]),
+                              'states/light.kitchen': (0, light)})
+        self.addCleanup(self.hass.close)
+        config = haaska.Configuration(optsDict={'url': self.hass.url})
+        self.ha = haaska.HomeAssistant(config)
+
+    def test_properties_share_one_time_of_sample(self):
+        # A clock that moves on every call would give each property its own
+        # time if they were sampled separately
+        clock = ('2026-01-01T00:00:%02d.00Z' % n for n in itertools.count())
+        endpoint = {'endpointId': 'light:kitchen',
+                    'scope': {'type': 'BearerToken', 'token': 't'}}
+        with mock.patch.object(haaska, 'get_utc_timestamp',
+                               side_effect=lambda: next(clock)):
+            r = haaska.invoke('Alexa', 'ReportState', self.ha, {}, endpoint,
+                              'ct')
+        properties = r['context']['properties']
+        self.assertGreater(len(properties), 2)
+        self.assertEqual({p['timeOfSample'] for p in properties},
+                         {'2026-01-01T00:00:00.00Z'})
+
+
+if __name__ == '__main__':
+    unittest.main()
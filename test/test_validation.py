@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for the schema compiler and Alexa v3 response validation.
+# $ cd test && python -m unittest test_validation
+
+import os
+import sys
+import unittest
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+import validation  # noqa: E402
+from validation import SchemaCompiler, ValidationError  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+
+
+def compiled(schema):
+    return SchemaCompiler().compile(schema)
+
+
+class SchemaCompilerTests(unittest.TestCase):
+    def assertInvalid(self, validate, value, path):
+        with self.assertRaises(ValidationError) as cm:
+            validate(value)
+        self.assertEqual(cm.exception.path, path)
+
+    def test_types(self):
+        validate = compiled({'type': ['integer', 'null']})
+        self.assertTrue(validate(3))
+        self.assertTrue(validate(None))
+        self.assertInvalid(validate, 3.5, '$')
+        self.assertInvalid(validate, True, '$')
+
+    def test_number_accepts_int_and_float(self):
+        validate = compiled({'type': 'number', 'minimum': 0, 'maximum': 1})
+        self.assertTrue(validate(1))
+        self.assertTrue(validate(0.5))
+        self.assertInvalid(validate, 1.5, '$')
+
+    def test_enum_and_pattern(self):
+        validate = compiled({'type': 'object', 'properties': {
+            'a': {'enum': ['x', 'y']},
+            'b': {'type': 'string', 'pattern': r'^\d+$'}}})
+        self.assertTrue(validate({'a': 'x', 'b': '12'}))
+        self.assertInvalid(validate, {'a': 'z'}, '$.a')
+        self.assertInvalid(validate, {'b': '1a'}, '$.b')
+
+    def test_required_and_additional_properties(self):
+        validate = compiled({'type': 'object', 'required': ['a'],
+                             'properties': {'a': {}},
+                             'additionalProperties': False})
+        self.assertTrue(validate({'a': 1}))
+        self.assertInvalid(validate, {}, '$')
+        self.assertInvalid(validate, {'a': 1, 'b': 2}, '$')
+
+    def test_items_path(self):
+        validate = compiled({'type': 'array', 'maxItems': 3,
+                             'items': {'type': 'object', 'properties': {
+                                 'n': {'type': 'integer'}}}})
+        self.assertTrue(validate([{'n': 1}, {}]))
+        self.assertInvalid(validate, [{'n': 1}, {'n': 'x'}], '$[1].n')
+        self.assertInvalid(validate, [{}] * 4, '$')
+
+    def test_switch(self):
+        validate = compiled({
+            'type': 'object',
+            'switch': {'on': ['kind'], 'field': 'value',
+                       'cases': {('int',): {'type': 'integer'},
+                                 ('str',): {'type': 'string'}}}})
+        self.assertTrue(validate({'kind': 'int', 'value': 1}))
+        self.assertTrue(validate({'kind': 'str', 'value': 'a'}))
+        self.assertTrue(validate({'kind': 'other', 'value': []}))
+        self.assertInvalid(validate, {'kind': 'int', 'value': 'a'}, '$.value')
+
+    def test_percent_in_path(self):
+        validate = compiled({'type': 'object', 'properties': {
+            '50%': {'type': 'integer'}}})
+        self.assertInvalid(validate, {'50%': 'x'}, '$.50%')
+
+
+def response(namespace, name, payload=None, properties=None):
+    r = {'event': {'header': {'namespace': namespace, 'name': name,
+                              'payloadVersion': '3', 'messageId': 'm',
+                              'correlationToken': 'ct'},
+                   'payload': payload or {}}}
+    if properties is not None:
+        r['context'] = {'properties': properties}
+    return r
+
+
+def request(namespace, name):
+    return {'directive': {'header': {'namespace': namespace, 'name': name,
+                                     'payloadVersion': '3',
+                                     'messageId': 'm'},
+                          'payload': {}}}
+
+
+class HeaderTests(unittest.TestCase):
+    def validate(self, directive, name, r):
+        return validation.validate_message(request(directive, name), r)
+
+    def test_discover(self):
+        r = response('Alexa.Discovery', 'Discover.Response',
+                     {'endpoints': []})
+        self.assertTrue(self.validate('Alexa.Discovery', 'Discover', r))
+        with self.assertRaises(ValidationError):
+            self.validate('Alexa.Discovery', 'Discover',
+                          response('Alexa', 'Response', {'endpoints': []}))
+
+    def test_report_state(self):
+        self.assertTrue(self.validate('Alexa', 'ReportState',
+                                      response('Alexa', 'StateReport')))
+        with self.assertRaises(ValidationError):
+            self.validate('Alexa', 'ReportState',
+                          response('Alexa', 'Response'))
+
+    def test_control(self):
+        self.assertTrue(self.validate('Alexa.PowerController', 'TurnOn',
+                                      response('Alexa', 'Response')))
+        self.assertTrue(self.validate(
+            'Alexa.PowerController', 'TurnOn',
+            response('Alexa', 'DeferredResponse',
+                     {'estimatedDeferralInSeconds': 7})))
+        with self.assertRaises(ValidationError):
+            self.validate('Alexa.PowerController', 'TurnOn',
+                          response('Alexa.PowerController', 'Response'))
+
+    def test_error(self):
+        r = response('Alexa', 'ErrorResponse',
+                     {'type': 'NO_SUCH_ENDPOINT', 'message': 'gone'})
+        self.assertTrue(self.validate('Alexa.Discovery', 'Discover', r))
+        r['event']['payload']['type'] = 'SOMETHING_ELSE'
+        with self.assertRaises(ValidationError):
+            self.validate('Alexa.PowerController', 'TurnOn', r)
+
+    def test_property_values(self):
+        prop = {'namespace': 'Alexa.PowerController', 'name': 'powerState',
+                'value': 'ON', 'timeOfSample': '2026-10-18T22:21:43.85Z',
+                'uncertaintyInMilliseconds': 200}
+        r = response('Alexa', 'Response', properties=[prop])
+        self.assertTrue(self.validate('Alexa.PowerController', 'TurnOn', r))
+        prop['value'] = 'DIM'
+        with self.assertRaises(ValidationError) as cm:
+            self.validate('Alexa.PowerController', 'TurnOn', r)
+        self.assertEqual(cm.exception.path, '$.context.properties[0].value')
+
+
+class HandlerResponseTests(unittest.TestCase):
+    # Responses haaska actually sends pass validation
+    def setUp(self):
+        light = {'entity_id': 'light.kitchen', 'state': 'on',
+                 'attributes': {'friendly_name': 'Kitchen',
+                                'supported_features': 1, 'brightness': 128}}
+        self.hass = FakeHass({'states': (0, [light]),
+                              'states/light.kitchen': (0, light),
+                              '': (0, {'message': 'API running.'})})
+        config = haaska.Configuration(optsDict={'url': self.hass.url})
+        self.ha = haaska.HomeAssistant(config)
+
+    def tearDown(self):
+        self.hass.close()
+
+    def check(self, namespace, name, payload=None, endpoint_id=None):
+        endpoint = None
+        if endpoint_id:
+            endpoint = {'endpointId': endpoint_id,
+                        'scope': {'type': 'BearerToken', 'token': 't'}}
+        r = haaska.invoke(namespace, name, self.ha, payload or {}, endpoint,
+                          'ct')
+        self.assertTrue(validation.validate_message(
+            request(namespace, name), r))
+        return r
+
+    def test_discover(self):
+        r = self.check('Alexa.Discovery', 'Discover')
+        self.assertEqual(r['event']['header']['namespace'], 'Alexa.Discovery')
+        self.assertEqual(len(r['event']['payload']['endpoints']), 1)
+
+    def test_report_state(self):
+        self.check('Alexa', 'ReportState', endpoint_id='light:kitchen')
+
+    def test_set_brightness(self):
+        self.check('Alexa.BrightnessController', 'SetBrightness',
+                   {'brightness': 40}, 'light:kitchen')
+
+    def test_error(self):
+        r = self.check('Alexa.PowerController', 'TurnOn',
+                       endpoint_id='nowhere#light:kitchen')
+        self.assertEqual(r['event']['header']['name'], 'ErrorResponse')
+
+
+if __name__ == '__main__':
+    unittest.main()
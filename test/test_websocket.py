@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Offline tests for service calls over the Home Assistant WebSocket API.
+# $ cd test && python -m unittest test_websocket
+
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+sys.path.insert(0, '..')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'local')
+import haaska  # noqa: E402
+from fake_hass import FakeHass  # noqa: E402
+from fake_websocket import FakeWebSocketServer  # noqa: E402
+
+
+class ServiceCallsTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebSocketServer('secret')
+        patcher = mock.patch.dict(sys.modules,
+                                  {'websocket': self.server.module})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config = haaska.Configuration(optsDict={
+            'url': 'http://hass:8123/api', 'password': 'secret'})
+        self.calls = haaska.ServiceCalls(self.config)
+        self.addCleanup(self.calls.close)
+
+    def call(self, service, data):
+        return self.calls.call('light', service, data, 1)
+
+    def test_url_and_authentication(self):
+        self.assertEqual(self.calls.url, 'ws://hass:8123/api/websocket')
+        self.call('turn_on', {})
+        self.assertEqual(self.server.connections[0].sent[0],
+                         {'type': 'auth', 'api_password': 'secret'})
+
+    def test_pipelined_calls_are_matched_by_id(self):
+        self.server.hold = True
+        futures = [self.call('turn_on', {'n': i}) for i in range(3)]
+        # All sent on one connection before any answer
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(len(self.server.calls), 3)
+        self.assertFalse(any(f.done() for f in futures))
+        for _, msg in reversed(self.server.calls):
+            self.server.answer(msg['id'])
+        self.assertEqual([f.result(5) for f in futures],
+                         [{'n': 0}, {'n': 1}, {'n': 2}])
+
+    def test_failed_call(self):
+        self.server.hold = True
+        future = self.call('explode', {})
+        self.server.answer(self.server.calls[0][1]['id'], success=False)
+        with self.assertRaises(haaska.WebSocketError):
+            future.result(5)
+
+    def test_lost_connection_fails_pending_calls(self):
+        self.server.hold = True
+        futures = [self.call('turn_on', {}), self.call('turn_off', {})]
+        self.server.connections[0].drop()
+        for future in futures:
+            with self.assertRaises(haaska.ConnectionLost):
+                future.result(5)
+        # The next call reconnects
+        self.server.hold = False
+        self.assertEqual(self.call('turn_on', {'x': 1}).result(5), {'x': 1})
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_idle_connection_is_replaced(self):
+        self.call('turn_on', {}).result(5)
+        self.calls.last_used -= haaska.ServiceCalls.IDLE_TIMEOUT + 1
+        self.call('turn_on', {}).result(5)
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertTrue(self.server.connections[0].closed)
+
+    def test_send_is_retried_once_on_a_new_connection(self):
+        self.call('turn_on', {}).result(5)
+        self.server.failed_sends = 1
+        self.assertEqual(self.call('turn_off', {'y': 2}).result(5), {'y': 2})
+        self.assertEqual(self.server.services(),
+                         [('light', 'turn_on'), ('light', 'turn_off')])
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_send_failing_twice_raises(self):
+        self.server.failed_sends = 2
+        with self.assertRaises(haaska.WebSocketError):
+            self.call('turn_on', {})
+        self.assertEqual(self.server.calls, [])
+
+    def test_rejected_password(self):
+        self.calls.password = 'wrong'
+        with self.assertRaises(haaska.WebSocketError):
+            self.call('turn_on', {})
+        # No new attempt for a while
+        with self.assertRaises(haaska.WebSocketError):
+            self.call('turn_on', {})
+        self.assertEqual(len(self.server.connections), 1)
+
+
+class WebSocketPostTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebSocketServer()
+        patcher = mock.patch.dict(sys.modules,
+                                  {'websocket': self.server.module})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hass = FakeHass()
+        self.addCleanup(self.hass.close)
+        config = haaska.Configuration(optsDict={'url': self.hass.url,
+                                                'websocket': True})
+        self.ha = haaska.HomeAssistant(config)
+        self.addCleanup(self.ha.service_calls.close)
+
+    def post(self, wait):
+        return self.ha.post('services/light/turn_on',
+                            {'entity_id': 'light.a'}, wait=wait)
+
+    def test_no_wait(self):
+        self.server.hold = True
+        start = time.monotonic()
+        self.assertIsNone(self.post(False))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.server.services(), [('light', 'turn_on')])
+        self.assertEqual(self.hass.requests, [])
+
+    def test_wait(self):
+        self.assertEqual(self.post(True), {'entity_id': 'light.a'})
+        self.assertEqual(self.hass.requests, [])
+
+    def test_falls_back_to_rest_when_sending_fails(self):
+        self.server.failed_sends = 2
+        self.post(True)
+        self.assertEqual(self.server.calls, [])
+        self.assertEqual(self.hass.requests,
+                         [('POST', 'services/light/turn_on',
+                           {'entity_id': 'light.a'})])
+
+    def test_falls_back_to_rest_when_unreachable(self):
+        self.server.refuse = True
+        self.post(True)
+        self.post(True)
+        self.assertEqual(self.hass.count('POST', 'services/light/turn_on'),
+                         2)
+
+    def test_other_posts_use_rest(self):
+        self.ha.post('events/haaska', {}, wait=True)
+        self.assertEqual(self.server.connections, [])
+        self.assertEqual(self.hass.count('POST', 'events/haaska'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,426 @@
+# coding: utf-8
+
+# Copyright (c) 2015 Michael Auchter <a@phire.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Validation of Alexa Smart Home v3 responses.
+#
+# The schemas below describe the parts of the v3 message format haaska
+# produces, using a small subset of JSON Schema. Rather than interpreting
+# them for every message, each schema is compiled once into the source of a
+# plain Python function (type checks, set lookups and precompiled regexes)
+# which is cached per directive type, so validation is cheap enough to leave
+# enabled in production.
+
+import re
+
+ENDPOINT_ID = {'type': 'string',
+               'pattern': r'^[a-zA-Z0-9_\-=#;:?@&]{1,256}$'}
+TIMESTAMP = {'type': 'string',
+             'pattern': r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$'}
+PERCENT = {'type': 'integer', 'minimum': 0, 'maximum': 100}
+TEMPERATURE = {
+    'type': 'object',
+    'required': ['value', 'scale'],
+    'properties': {
+        'value': {'type': 'number'},
+        'scale': {'enum': ['CELSIUS', 'FAHRENHEIT', 'KELVIN']}
+    }
+}
+
+PROPERTY_VALUES = {
+    ('Alexa.PowerController', 'powerState'): {'enum': ['ON', 'OFF']},
+    ('Alexa.BrightnessController', 'brightness'): PERCENT,
+    ('Alexa.PercentageController', 'percentage'): PERCENT,
+    ('Alexa.PowerLevelController', 'powerLevel'): PERCENT,
+    ('Alexa.ColorTemperatureController', 'colorTemperatureInKelvin'): {
+        'type': 'integer', 'minimum': 1000, 'maximum': 10000},
+    ('Alexa.ThermostatController', 'targetSetpoint'): TEMPERATURE,
+    ('Alexa.ThermostatController', 'thermostatMode'): {
+        'enum': ['AUTO', 'COOL', 'HEAT', 'ECO', 'OFF', 'CUSTOM']},
+    ('Alexa.TemperatureSensor', 'temperature'): TEMPERATURE,
+    ('Alexa.LockController', 'lockState'): {
+        'enum': ['LOCKED', 'UNLOCKED', 'JAMMED']},
+    ('Alexa.Speaker', 'volume'): PERCENT,
+    ('Alexa.Speaker', 'muted'): {'type': 'boolean'},
+    ('Alexa.EndpointHealth', 'connectivity'): {
+        'type': 'object',
+        'required': ['value'],
+        'properties': {'value': {'enum': ['OK', 'UNREACHABLE']}}
+    },
+}
+
+CONTEXT_PROPERTY = {
+    'type': 'object',
+    'required': ['namespace', 'name', 'value', 'timeOfSample',
+                 'uncertaintyInMilliseconds'],
+    'properties': {
+        'namespace': {'type': 'string'},
+        'name': {'type': 'string'},
+        'timeOfSample': TIMESTAMP,
+        'uncertaintyInMilliseconds': {'type': 'integer', 'minimum': 0}
+    },
+    'additionalProperties': False,
+    'switch': {
+        'on': ['namespace', 'name'],
+        'field': 'value',
+        'cases': PROPERTY_VALUES
+    }
+}
+
+HEADER = {
+    'type': 'object',
+    'required': ['namespace', 'name', 'payloadVersion', 'messageId'],
+    'properties': {
+        'namespace': {'type': 'string', 'pattern': r'^Alexa(\.\w+)*$'},
+        'name': {'type': 'string', 'minLength': 1},
+        'payloadVersion': {'enum': ['3']},
+        'messageId': {'type': 'string', 'minLength': 1, 'maxLength': 128},
+        'correlationToken': {'type': ['string', 'null']}
+    }
+}
+
+ERROR_PAYLOAD = {
+    'type': 'object',
+    'required': ['type', 'message'],
+    'properties': {
+        'type': {'enum': [
+            'ALREADY_IN_OPERATION', 'BRIDGE_UNREACHABLE', 'ENDPOINT_BUSY',
+            'ENDPOINT_LOW_POWER', 'ENDPOINT_UNREACHABLE',
+            'EXPIRED_AUTHORIZATION_CREDENTIAL', 'FIRMWARE_OUT_OF_DATE',
+            'HARDWARE_MALFUNCTION', 'INTERNAL_ERROR',
+            'INVALID_AUTHORIZATION_CREDENTIAL', 'INVALID_DIRECTIVE',
+            'INVALID_VALUE', 'NO_SUCH_ENDPOINT',
+            'NOT_SUPPORTED_IN_CURRENT_MODE', 'NOT_IN_OPERATION',
+            'POWER_LEVEL_NOT_SUPPORTED',
+            'RATE_LIMIT_EXCEEDED', 'TEMPERATURE_VALUE_OUT_OF_RANGE',
+            'VALUE_OUT_OF_RANGE']},
+        'message': {'type': 'string'}
+    }
+}
+
+CAPABILITY = {
+    'type': 'object',
+    'required': ['type', 'interface', 'version'],
+    'properties': {
+        'type': {'enum': ['AlexaInterface']},
+        'interface': {'type': 'string', 'pattern': r'^Alexa(\.\w+)*$'},
+        'version': {'enum': ['3']},
+        'properties': {
+            'type': 'object',
+            'properties': {
+                'supported': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'required': ['name'],
+                        'properties': {'name': {'type': 'string'}}
+                    }
+                },
+                'proactivelyReported': {'type': 'boolean'},
+                'retrievable': {'type': 'boolean'}
+            }
+        }
+    }
+}
+
+DISCOVERED_ENDPOINT = {
+    'type': 'object',
+    'required': ['endpointId', 'manufacturerName', 'friendlyName',
+                 'description', 'displayCategories', 'capabilities'],
+    'properties': {
+        'endpointId': ENDPOINT_ID,
+        'manufacturerName': {'type': 'string', 'minLength': 1,
+                             'maxLength': 128},
+        'friendlyName': {'type': 'string', 'minLength': 1, 'maxLength': 128},
+        'description': {'type': 'string', 'minLength': 1, 'maxLength': 128},
+        'displayCategories': {
+            'type': 'array',
+            'minItems': 1,
+            'items': {'enum': [
+                'ACTIVITY_TRIGGER', 'CAMERA', 'DOOR', 'LIGHT', 'OTHER',
+                'SCENE_TRIGGER', 'SMARTLOCK', 'SMARTPLUG', 'SPEAKER', 'SWITCH',
+                'TEMPERATURE_SENSOR', 'THERMOSTAT', 'TV']}
+        },
+        'capabilities': {'type': 'array', 'items': CAPABILITY}
+    }
+}
+
+
+def header_schema(namespace, name):
+    header = dict(HEADER)
+    header['properties'] = dict(HEADER['properties'],
+                                namespace={'enum': [namespace]},
+                                name={'enum': [name]})
+    return header
+
+
+def response_schema(payload, header, properties=True):
+    event = {
+        'type': 'object',
+        'required': ['header', 'payload'],
+        'properties': {
+            'header': header_schema(*header),
+            'payload': payload,
+            'endpoint': {
+                'type': 'object',
+                'required': ['endpointId'],
+                'properties': {'endpointId': ENDPOINT_ID}
+            }
+        }
+    }
+    schema = {
+        'type': 'object',
+        'required': ['event'],
+        'properties': {'event': event},
+        'additionalProperties': False
+    }
+    if properties:
+        schema['properties']['context'] = {
+            'type': 'object',
+            'required': ['properties'],
+            'properties': {
+                'properties': {'type': 'array', 'items': CONTEXT_PROPERTY}
+            }
+        }
+    return schema
+
+
+DISCOVER_PAYLOAD = {
+    'type': 'object',
+    'required': ['endpoints'],
+    'properties': {
+        'endpoints': {'type': 'array', 'maxItems': 300,
+                      'items': DISCOVERED_ENDPOINT}
+    }
+}
+
+DEFERRED_PAYLOAD = {
+    'type': 'object',
+    'properties': {
+        'estimatedDeferralInSeconds': {'type': 'integer', 'minimum': 0}
+    },
+    'additionalProperties': False
+}
+
+# Payload schema and whether context properties are allowed, per response
+# header (namespace, name)
+RESPONSES = {
+    ('Alexa.Discovery', 'Discover.Response'): (DISCOVER_PAYLOAD, False),
+    ('Alexa', 'ErrorResponse'): (ERROR_PAYLOAD, False),
+    ('Alexa', 'DeferredResponse'): (DEFERRED_PAYLOAD, False),
+    ('Alexa', 'StateReport'): ({'type': 'object'}, True),
+    ('Alexa', 'Response'): ({'type': 'object'}, True),
+}
+
+
+def expected_header(namespace, name, response_name):
+    # The response header a directive must be answered with. Any directive
+    # may fail, and control directives may be deferred; otherwise the
+    # directive alone decides it, whatever the response claims to be.
+    if response_name == 'ErrorResponse':
+        return ('Alexa', 'ErrorResponse')
+    if namespace == 'Alexa.Discovery' and name == 'Discover':
+        return ('Alexa.Discovery', 'Discover.Response')
+    if name == 'ReportState':
+        return ('Alexa', 'StateReport')
+    if response_name == 'DeferredResponse':
+        return ('Alexa', 'DeferredResponse')
+    return ('Alexa', 'Response')
+
+
+class ValidationError(Exception):
+    def __init__(self, path, message):
+        Exception.__init__(self, '%s: %s' % (path, message))
+        self.path = path
+        self.message = message
+
+
+_MISSING = object()
+
+_TYPE_CHECKS = {
+    'object': 'type(%s) is dict',
+    'array': 'type(%s) is list',
+    'string': 'type(%s) is str',
+    'integer': 'type(%s) is int',
+    'number': '(type(%s) is int or type(%s) is float)',
+    'boolean': 'type(%s) is bool',
+    'null': '%s is None',
+}
+
+
+class SchemaCompiler(object):
+    def __init__(self):
+        self.lines = []
+        self.consts = {'ValidationError': ValidationError,
+                       '_MISSING': _MISSING}
+        self.nvars = 0
+
+    def const(self, value):
+        name = '_c%d' % len(self.consts)
+        self.consts[name] = value
+        return name
+
+    def var(self, prefix='v'):
+        self.nvars += 1
+        return '%s%d' % (prefix, self.nvars)
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def fail(self, depth, path, message):
+        fmt, args = path
+        if args:
+            expr = '%r %% (%s,)' % (fmt, ', '.join(args))
+        else:
+            expr = repr(fmt % ())
+        self.emit(depth, 'raise ValidationError(%s, %r)' % (expr, message))
+
+    def compile(self, schema, name='validate'):
+        self.emit(0, 'def %s(v0):' % name)
+        self.node(schema, 'v0', ('$', ()), 1)
+        self.emit(1, 'return True')
+        namespace = dict(self.consts)
+        exec(compile('\n'.join(self.lines), '<schema %s>' % name, 'exec'),
+             namespace)
+        return namespace[name]
+
+    def source(self):
+        return '\n'.join(self.lines)
+
+    def node(self, schema, v, path, depth):
+        types = schema.get('type')
+        if types is not None:
+            if not isinstance(types, list):
+                types = [types]
+            check = ' or '.join(_TYPE_CHECKS[t].replace('%s', v)
+                                for t in types)
+            self.emit(depth, 'if not (%s):' % check)
+            self.fail(depth + 1, path, 'expected %s' % ' or '.join(types))
+
+        if 'enum' in schema:
+            self.emit(depth, 'if %s not in %s:' % (
+                v, self.const(frozenset(schema['enum']))))
+            self.fail(depth + 1, path, 'expected one of %s' %
+                      ', '.join(sorted(schema['enum'])))
+
+        if 'pattern' in schema:
+            regex = self.const(re.compile(schema['pattern']))
+            self.emit(depth, 'if type(%s) is str and not %s.search(%s):' % (
+                v, regex, v))
+            self.fail(depth + 1, path, 'does not match %s' %
+                      schema['pattern'])
+
+        for key, op, message in (('minLength', '<', 'too short'),
+                                 ('maxLength', '>', 'too long'),
+                                 ('minItems', '<', 'too few items'),
+                                 ('maxItems', '>', 'too many items')):
+            if key in schema:
+                self.emit(depth, 'if len(%s) %s %d:' % (v, op, schema[key]))
+                self.fail(depth + 1, path, message)
+
+        for key, op in (('minimum', '<'), ('maximum', '>')):
+            if key in schema:
+                self.emit(depth, 'if %s %s %r:' % (v, op, schema[key]))
+                self.fail(depth + 1, path, 'out of range')
+
+        for key in schema.get('required', []):
+            self.emit(depth, 'if %r not in %s:' % (key, v))
+            self.fail(depth + 1, path, 'missing %s' % key)
+
+        properties = dict(schema.get('properties', {}))
+        if 'switch' in schema:
+            # Validate one field with a schema picked by the values of others
+            properties.pop(schema['switch']['field'], None)
+        for key, sub in sorted(properties.items()):
+            child = self.var()
+            self.emit(depth, '%s = %s.get(%r, _MISSING)' % (child, v, key))
+            self.emit(depth, 'if %s is not _MISSING:' % child)
+            self.block(sub, child, self.subpath(path, '.' + key), depth + 1)
+
+        if schema.get('additionalProperties') is False:
+            allowed = set(schema.get('properties', {}).keys())
+            if 'switch' in schema:
+                allowed.add(schema['switch']['field'])
+            k = self.var('k')
+            self.emit(depth, 'for %s in %s:' % (k, v))
+            self.emit(depth + 1, 'if %s not in %s:' % (
+                k, self.const(frozenset(allowed))))
+            self.fail(depth + 2, path, 'unexpected property')
+
+        if 'switch' in schema:
+            self.switch(schema['switch'], v, path, depth)
+
+        if 'items' in schema:
+            i = self.var('i')
+            item = self.var()
+            self.emit(depth, 'for %s, %s in enumerate(%s):' % (i, item, v))
+            fmt, args = path
+            self.block(schema['items'], item,
+                       (fmt + '[%d]', args + (i,)), depth + 1)
+
+    def switch(self, switch, v, path, depth):
+        cases = sorted(switch['cases'].items())
+        index = self.const({key: n for n, (key, _) in enumerate(cases)})
+        field = switch['field']
+        selector = ', '.join('%s.get(%r)' % (v, k) for k in switch['on'])
+        n = self.var('n')
+        child = self.var()
+        self.emit(depth, '%s = %s.get((%s,), -1)' % (n, index, selector))
+        self.emit(depth, '%s = %s.get(%r)' % (child, v, field))
+        for pos, (key, sub) in enumerate(cases):
+            self.emit(depth, '%s %s == %d:' % ('if' if pos == 0 else 'elif',
+                                               n, pos))
+            self.block(sub, child, self.subpath(path, '.' + field), depth + 1)
+
+    def block(self, schema, v, path, depth):
+        start = len(self.lines)
+        self.node(schema, v, path, depth)
+        if len(self.lines) == start:
+            self.emit(depth, 'pass')
+
+    @staticmethod
+    def subpath(path, suffix):
+        fmt, args = path
+        return (fmt + suffix.replace('%', '%%'), args)
+
+
+_compiled = {}
+_validators = {}
+
+
+def get_validator(namespace, name, response_name):
+    key = (namespace, name, response_name)
+    if key not in _validators:
+        header = expected_header(namespace, name, response_name)
+        if header not in _compiled:
+            payload, properties = RESPONSES[header]
+            schema = response_schema(payload, header, properties)
+            _compiled[header] = SchemaCompiler().compile(
+                schema, 'validate_' + header[1].replace('.', '_'))
+        _validators[key] = _compiled[header]
+    return _validators[key]
+
+
+def validate_message(request, response):
+    header = request['directive']['header']
+    validator = get_validator(header.get('namespace'), header.get('name'),
+                              response['event']['header'].get('name'))
+    return validator(response)